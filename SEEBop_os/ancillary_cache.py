@@ -0,0 +1,408 @@
+# ===============================================================================
+# Copyright 2019 Gabriel Parrish, Matt Schauer and Gabriel Senay
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import os
+import sys
+import json
+import time
+import errno
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+import numpy as np
+# ============= standard library imports ========================
+
+"""LRU cache of the dekadal Tmax/dT and daily ETo rasters already warped onto a Landsat scene grid.
+
+Entries are keyed by the product, the period, the source raster (its path, size and modification time, see
+source_id()) and the grid. A grid is a (projection, geotransform, xsize, ysize) tuple. Scenes of the same WRS-2
+path/row are on the same 30 m lattice but their extents shift a little from date to date, so entries are loaded on a
+padded grid and any later scene grid that falls inside it on the same lattice is served as a view of the cached
+array.
+
+AncillaryCache lives inside one process. SharedAncillaryStore is the same cache shared by the worker processes of a
+batch: entries are .npy files on a RAM backed folder (/dev/shm) that every worker maps read only, so the node holds
+one copy of each warped input however many workers use it."""
+
+# pixels added on every side of a scene grid when an entry is loaded (300 * 30 m = 9 km)
+DEFAULT_PAD = 300
+
+# edge length in pixels of the largest Landsat scene grid, WRS-2 scenes are about 7800 x 7900 pixels at 30 m
+SCENE_SIZE = 8000
+
+# number of ancillary inputs of a scene (Tmax, dT and ETo)
+SCENE_ENTRIES = 3
+
+
+def scene_budget(scenes, pad=DEFAULT_PAD):
+    """
+    :param scenes: number of scenes whose inputs should fit
+    :return: bytes of the float32 Tmax, dT and ETo entries of that many scenes, each on a padded scene grid
+     (about 300 MB per entry with the default pad)
+    """
+    return scenes * SCENE_ENTRIES * 4 * (SCENE_SIZE + 2 * pad) ** 2
+
+
+# default memory budget of the process wide cache, the inputs of two scenes (about 1.8 GB)
+DEFAULT_MAX_BYTES = scene_budget(2)
+
+
+def pad_grid(grid, pad):
+    """
+    :param grid: (projection, geotransform, xsize, ysize)
+    :param pad: pixels to add on each side
+    :return: the grid grown by pad pixels on each side
+    """
+    projection, gt, xsize, ysize = grid
+    padded_gt = (gt[0] - pad * gt[1], gt[1], gt[2], gt[3] - pad * gt[5], gt[4], gt[5])
+    return projection, padded_gt, xsize + 2 * pad, ysize + 2 * pad
+
+
+def source_id(path):
+    """
+    :return: (path, size, modification time) of the raster an entry is loaded from. /vsi paths and the like have
+     no size or modification time.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return path, None, None
+    return os.path.abspath(path), stat.st_size, stat.st_mtime
+
+
+def subgrid_window(outer, inner, tolerance=1e-6, contained=True):
+    """
+    Find where the inner grid sits inside the outer one.
+    :param contained: if False inner may also overlap or cover outer, offsets can then be negative or run past it
+    :return: (xoff, yoff, xsize, ysize) of inner in outer pixel coordinates, or None if inner is not on the same
+     lattice or (when contained) not fully inside outer
+    """
+    outer_proj, ogt, oxsize, oysize = outer
+    inner_proj, igt, ixsize, iysize = inner
+    if outer_proj != inner_proj or tuple(ogt[1:3]) != tuple(igt[1:3]) or tuple(ogt[4:]) != tuple(igt[4:]):
+        return None
+    xoff = (igt[0] - ogt[0]) / ogt[1]
+    yoff = (igt[3] - ogt[3]) / ogt[5]
+    if abs(xoff - round(xoff)) > tolerance or abs(yoff - round(yoff)) > tolerance:
+        return None
+    xoff = int(round(xoff))
+    yoff = int(round(yoff))
+    if contained and (xoff < 0 or yoff < 0 or xoff + ixsize > oxsize or yoff + iysize > oysize):
+        return None
+    return xoff, yoff, ixsize, iysize
+
+
+class AncillaryCache(object):
+    """
+    Least recently used cache of ancillary arrays keyed by (product, period, source, grid). The period is the dekad
+    for Tmax and dT and the day of year for ETo, the source is the source_id() of the raster. Thread safe.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, pad=DEFAULT_PAD):
+        """
+        :param max_bytes: memory budget. Least recently used entries are evicted beyond it. 0 disables the cache.
+        :param pad: pixels added on each side of the scene grid when an entry is loaded
+        """
+        self.max_bytes = max_bytes
+        self.pad = pad
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, product, period, grid, loader, source=None):
+        """
+        :param product: 'tmax', 'dt' or 'eto'
+        :param period: dekad or day of year string
+        :param grid: (projection, geotransform, xsize, ysize) of the scene
+        :param loader: callable taking a grid and returning the float32 ancillary array on that grid
+        :param source: path of the raster the loader reads. Its path, size and modification time are part of the
+         key, so a rewritten or replaced input is loaded again.
+        :return: read only array on the scene grid
+        """
+        source = source_id(source) if source is not None else None
+        with self._lock:
+            for key, arr in self._entries.items():
+                if key[:3] != (product, period, source):
+                    continue
+                window = subgrid_window(key[3], grid)
+                if window is not None:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    xoff, yoff, xsize, ysize = window
+                    return arr[yoff:yoff + ysize, xoff:xoff + xsize]
+            self.misses += 1
+
+        # load outside the lock so other threads are not held up by the warp
+        padded = pad_grid(grid, self.pad)
+        arr = loader(padded)
+        arr.flags.writeable = False
+
+        with self._lock:
+            if arr.nbytes <= self.max_bytes:
+                key = (product, period, source, padded)
+                if key not in self._entries:
+                    self._entries[key] = arr
+                    self.nbytes += arr.nbytes
+                while self.nbytes > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self.nbytes -= evicted.nbytes
+        return arr[self.pad:self.pad + grid[3], self.pad:self.pad + grid[2]]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return 'AncillaryCache({} entries, {:.1f} MB, {} hits, {} misses)'.format(
+            len(self._entries), self.nbytes / 1e6, self.hits, self.misses)
+
+
+_process_cache = None
+
+
+def process_cache():
+    """
+    :return: the cache shared by every scene run in this process. Pool workers keep it between scenes.
+    """
+    global _process_cache
+    if _process_cache is None:
+        _process_cache = AncillaryCache()
+    return _process_cache
+
+
+def shared_root():
+    """
+    :return: a new folder for a SharedAncillaryStore, on /dev/shm (shared memory) when the system has it, otherwise
+     in the temp folder (then the OS page cache is what is shared). Never under the scratch folder, whose scene
+     folders outlive the store.
+    """
+    parent = '/dev/shm' if os.path.isdir('/dev/shm') and sys.platform.startswith('linux') else None
+    return tempfile.mkdtemp(prefix='ssebop_ancillary_', dir=parent)
+
+
+class SharedAncillaryStore(object):
+    """
+    Ancillary cache shared between processes through read only memory mapped .npy files. Same get() interface as
+    AncillaryCache so it can be handed to load_ancillary(). The first worker that needs an entry warps it while
+    holding a lock file, the others wait for it and map it. The lock of a worker that died (or that has held it for
+    longer than the timeout) is taken over by the next worker that needs the entry. The store pickles to its folder,
+    so it can be passed to pool workers.
+    """
+
+    def __init__(self, root, max_bytes=scene_budget(4), pad=DEFAULT_PAD, timeout=900):
+        """
+        :param root: folder of the entries, see shared_root()
+        :param max_bytes: budget of the entries on disk (RAM when root is on /dev/shm). The least recently used
+         entries are removed beyond it, workers that still map them keep their pages until they are done.
+        :param pad: pixels added on each side of the scene grid when an entry is loaded
+        :param timeout: seconds after which the lock of an entry another worker is loading is taken over, even if
+         that worker is still alive
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self.pad = pad
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._mapped = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_mapped'] = {}
+        return state
+
+    def get(self, product, period, grid, loader, source=None):
+        """
+        :param product: 'tmax', 'dt' or 'eto'
+        :param period: dekad or day of year string
+        :param grid: (projection, geotransform, xsize, ysize) of the scene
+        :param loader: callable taking a grid and returning the float32 ancillary array on that grid
+        :param source: path of the raster the loader reads. Its path, size and modification time are part of the
+         key, so a rewritten or replaced input is loaded again.
+        :return: read only array on the scene grid, a view of the shared entry
+        """
+        source = _digest(source_id(source) if source is not None else None)
+        found = self._find(product, period, source, grid)
+        if found is not None:
+            self.hits += 1
+            return found
+        self.misses += 1
+
+        padded = pad_grid(grid, self.pad)
+        path = os.path.join(self.root, '{}_{}_{}_{}.npy'.format(product, period, source, _grid_digest(padded)))
+        lock = path + '.lock'
+        while True:
+            fd = self._lock(lock)
+            if fd is not None:
+                break
+            # another worker is loading the same entry
+            if os.path.exists(path + '.json'):
+                try:
+                    return self._view(path, padded, grid)
+                except (IOError, OSError):
+                    # evicted in the meantime, load it again
+                    pass
+            time.sleep(0.2)
+
+        try:
+            arr = loader(padded)
+            self._evict(arr.nbytes)
+            tmp = path + '.tmp.npy'
+            np.save(tmp, arr)
+            os.replace(tmp, path)
+            # the grid sidecar is written last, its presence marks a complete entry
+            with open(path + '.json.tmp', 'w') as wfile:
+                json.dump({'product': product, 'period': period, 'source': source, 'grid': padded}, wfile)
+            os.replace(path + '.json.tmp', path + '.json')
+        finally:
+            os.close(fd)
+            os.remove(lock)
+        return self._view(path, padded, grid)
+
+    def _lock(self, lock):
+        """
+        :return: file descriptor of the lock of an entry, or None while another live worker holds it. The lock
+         holds the pid of its owner and the time it was taken. A lock whose owner died, or older than the
+         timeout, is taken over.
+        """
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        else:
+            os.write(fd, json.dumps({'pid': os.getpid(), 'time': time.time()}).encode('utf-8'))
+            return fd
+
+        try:
+            with open(lock, 'r') as rfile:
+                content = rfile.read()
+            owner = json.loads(content)
+        except (IOError, OSError):
+            # released in the meantime
+            return None
+        except ValueError:
+            # not written yet, or the owner died right after creating it
+            try:
+                owner = {'pid': None, 'time': os.path.getmtime(lock)}
+            except OSError:
+                return None
+        if _pid_alive(owner['pid']) and time.time() - owner['time'] < self.timeout:
+            return None
+        try:
+            # only break the lock that was read, not one another waiter has taken over since
+            with open(lock, 'r') as rfile:
+                if rfile.read() == content:
+                    os.remove(lock)
+        except (IOError, OSError):
+            pass
+        return None
+
+    def _find(self, product, period, source, grid):
+        prefix = '{}_{}_{}_'.format(product, period, source)
+        for name in os.listdir(self.root):
+            if not (name.startswith(prefix) and name.endswith('.npy.json')):
+                continue
+            path = os.path.join(self.root, name[:-5])
+            try:
+                with open(path + '.json', 'r') as rfile:
+                    meta = json.load(rfile)
+            except (IOError, OSError, ValueError):
+                continue
+            outer = _grid_from_json(meta['grid'])
+            if subgrid_window(outer, grid) is not None:
+                try:
+                    return self._view(path, outer, grid)
+                except (IOError, OSError):
+                    # evicted in the meantime
+                    continue
+        return None
+
+    def _view(self, path, outer, grid):
+        if path not in self._mapped:
+            self._mapped[path] = np.load(path, mmap_mode='r')
+        # the sidecar time is the last use of the entry, see _evict()
+        os.utime(path + '.json', None)
+        xoff, yoff, xsize, ysize = subgrid_window(outer, grid)
+        return self._mapped[path][yoff:yoff + ysize, xoff:xoff + xsize]
+
+    def _evict(self, incoming):
+        # least recently used first, by the time of the sidecar
+        entries = []
+        for name in os.listdir(self.root):
+            if name.endswith('.npy.json'):
+                path = os.path.join(self.root, name[:-5])
+                try:
+                    entries.append((os.path.getmtime(path + '.json'), os.path.getsize(path), path))
+                except OSError:
+                    continue
+        total = sum(e[1] for e in entries) + incoming
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            for p in (path + '.json', path):
+                try:
+                    os.remove(p)
+                except OSError:
+                    # still mapped on Windows
+                    pass
+            total -= size
+
+    @property
+    def nbytes(self):
+        return sum(os.path.getsize(os.path.join(self.root, n)) for n in os.listdir(self.root) if n.endswith('.npy'))
+
+    def close(self):
+        """
+        Remove the store. Called by the parent once the batch is done.
+        """
+        self._mapped.clear()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def __repr__(self):
+        return 'SharedAncillaryStore({}, {:.1f} MB)'.format(self.root, self.nbytes / 1e6)
+
+
+def _pid_alive(pid):
+    if pid is None or sys.platform.startswith('win'):
+        # unknown owner, or Windows where os.kill() would terminate the process: only the age of a lock is checked
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _digest(value):
+    return hashlib.sha1(json.dumps(value).encode('utf-8')).hexdigest()[:16]
+
+
+def _grid_digest(grid):
+    return _digest(grid)
+
+
+def _grid_from_json(grid):
+    projection, gt, xsize, ysize = grid
+    return projection, tuple(gt), xsize, ysize
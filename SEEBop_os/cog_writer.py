@@ -0,0 +1,238 @@
+# ===============================================================================
+# Copyright 2019 Gabriel Parrish, Matt Schauer and Gabriel Senay
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import os
+import numpy as np
+from osgeo import gdal
+# ============= standard library imports ========================
+
+"""Writer for the NDVI, LST, ETf and ETa products as tiled, compressed Cloud Optimized GeoTIFFs with internal
+overviews, optionally stored as scaled int16.
+
+Blocks are written to a tiled float32 working file next to the output (or in GDAL's /vsimem/ in-memory file system),
+which stays readable while the scene is being processed (the ETf pass reads the LST back). close() then converts it
+to the final COG in one sequential pass. A product that is only needed during the scene can live entirely in
+/vsimem/ and be discard()ed instead.
+
+The final output is only ever renamed into place, so a product path that exists always holds a complete product
+even if the process died while writing it."""
+
+# folder of GDAL's in-memory file system
+VSIMEM = '/vsimem'
+
+
+# nodata of float32 products (the ArcGIS 32 bit float nodata)
+FLOAT_NODATA = float(np.finfo(np.float32).min)
+
+# nodata of scaled int16 products
+INT16_NODATA = -32768
+
+# (scale, offset) of the scaled int16 encoding, value = stored * scale + offset
+PRODUCT_SCALING = {'NDVI': (0.0001, 0.),
+                   'LST': (0.01, 200.),
+                   'ETf': (0.0001, 0.),
+                   'ETa': (0.001, 0.)}
+
+# block size of the working files and of the COG tiles
+WORK_BLOCKSIZE = 256
+COG_BLOCKSIZE = 512
+
+
+def create_tiled(path, grid, data_type=gdal.GDT_Float32, nodata=FLOAT_NODATA, options=None):
+    """
+    Create a single band tiled GeoTIFF
+    :param path: string output path
+    :param grid: (projection, geotransform, xsize, ysize)
+    :return: gdal dataset open for writing
+    """
+    projection, gt, xsize, ysize = grid
+    creation_options = ['TILED=YES', 'BLOCKXSIZE={}'.format(WORK_BLOCKSIZE), 'BLOCKYSIZE={}'.format(WORK_BLOCKSIZE),
+                        'BIGTIFF=IF_SAFER']
+    if options:
+        creation_options += options
+    driver = gdal.GetDriverByName('GTiff')
+    ds = driver.Create(path, xsize, ysize, 1, data_type, options=creation_options)
+    if ds is None:
+        raise IOError("Can't create {}".format(path))
+    ds.SetGeoTransform(gt)
+    ds.SetProjection(projection)
+    ds.GetRasterBand(1).SetNoDataValue(nodata)
+    return ds
+
+
+def encode_int16(arr, scale, offset, out=None):
+    """
+    Scale a float block to int16. NaN and values outside the int16 range become INT16_NODATA.
+    """
+    scaled = np.round((arr - offset) / scale)
+    with np.errstate(invalid='ignore'):
+        bad = ~np.isfinite(scaled) | (scaled <= INT16_NODATA) | (scaled > 32767)
+    scaled[bad] = INT16_NODATA
+    if out is None:
+        return scaled.astype(np.int16)
+    np.copyto(out, scaled, casting='unsafe')
+    return out
+
+
+def translate_cog(src_path, path, compress='DEFLATE'):
+    """
+    Copy a tiled GeoTIFF to a Cloud Optimized GeoTIFF with internal overviews and a predictor suited to its type
+    (floating point predictor for float32, horizontal differencing for int16)
+    """
+    if gdal.GetDriverByName('COG') is not None:
+        options = ['COMPRESS={}'.format(compress), 'PREDICTOR=YES', 'BLOCKSIZE={}'.format(COG_BLOCKSIZE),
+                   'OVERVIEWS=AUTO', 'RESAMPLING=AVERAGE', 'NUM_THREADS=ALL_CPUS', 'BIGTIFF=IF_SAFER']
+        out = gdal.Translate(path, src_path, format='COG', creationOptions=options)
+    else:
+        # GDAL < 3.1: build the overviews on the source and copy them in front of the full resolution data
+        src = gdal.Open(src_path, gdal.GA_Update)
+        src.BuildOverviews('AVERAGE', [2, 4, 8, 16, 32])
+        src = None
+        float_type = gdal.Open(src_path).GetRasterBand(1).DataType == gdal.GDT_Float32
+        options = ['TILED=YES', 'BLOCKXSIZE={}'.format(COG_BLOCKSIZE), 'BLOCKYSIZE={}'.format(COG_BLOCKSIZE),
+                   'COMPRESS={}'.format(compress), 'PREDICTOR={}'.format(3 if float_type else 2),
+                   'COPY_SRC_OVERVIEWS=YES', 'BIGTIFF=IF_SAFER']
+        out = gdal.Translate(path, src_path, format='GTiff', creationOptions=options)
+    if out is None:
+        raise IOError("Can't write {}".format(path))
+    out = None
+
+
+class ProductWriter(object):
+    """
+    Block by block writer of one output product
+    """
+
+    def __init__(self, path, grid, product, cog=True, scaled=False, compress='DEFLATE', work_dir=None,
+                 resume=False):
+        """
+        :param path: string path of the final output
+        :param grid: (projection, geotransform, xsize, ysize)
+        :param product: 'NDVI', 'LST', 'ETf' or 'ETa', selects the int16 scaling
+        :param cog: if True the output is a Cloud Optimized GeoTIFF, otherwise a plain tiled GeoTIFF
+        :param scaled: if True store the product as int16 with the PRODUCT_SCALING scale/offset metadata
+        :param compress: DEFLATE, ZSTD (if GDAL was built with it), LZW...
+        :param work_dir: folder of the working files, e.g. VSIMEM to keep them in memory (an uncompressed float32
+         copy of the product). Default next to the output.
+        :param resume: reopen the working file an interrupted run left next to the output instead of creating it,
+         see run_manifest.SceneCheckpoint. Raises IOError if there is no such file, the product must then be
+         written again from the start.
+        """
+        self.path = path
+        self.grid = grid
+        self.product = product
+        self.cog = cog
+        self.scaled = scaled
+        self.compress = compress
+        if work_dir is None:
+            self.work_path = path + '.part.tif'
+        else:
+            self.work_path = '{}/{}_{}.part.tif'.format(work_dir, id(self), os.path.basename(path))
+        self.work_dir = work_dir
+        # an unscaled plain GeoTIFF next to the output is written compressed and renamed to the output at close()
+        self.renamed = not (cog or scaled) and work_dir is None
+        options = ['COMPRESS={}'.format(compress), 'PREDICTOR=3'] if self.renamed else None
+        if resume:
+            if not os.path.exists(self.work_path):
+                raise IOError('There is no working file {} to resume'.format(self.work_path))
+            self.ds = gdal.Open(self.work_path, gdal.GA_Update)
+            if self.ds is None:
+                raise IOError("Can't open {}".format(self.work_path))
+        else:
+            self.ds = create_tiled(self.work_path, grid, options=options)
+        self.band = self.ds.GetRasterBand(1)
+
+    def write(self, arr, window):
+        """
+        Write a float32 block. NaN in arr are replaced with the nodata value in place.
+        """
+        np.copyto(arr, FLOAT_NODATA, where=np.isnan(arr))
+        self.band.WriteArray(arr, window[0], window[1])
+
+    def read(self, window, out=None):
+        """
+        Read a float32 block back with nodata as NaN
+        """
+        xoff, yoff, xcount, ycount = window
+        if out is None:
+            out = np.empty((ycount, xcount), dtype=np.float32)
+        self.band.ReadAsArray(xoff, yoff, xcount, ycount, buf_obj=out)
+        np.copyto(out, np.nan, where=out == FLOAT_NODATA)
+        return out
+
+    def flush(self):
+        self.ds.FlushCache()
+
+    def close(self):
+        """
+        Finish the output: scale to int16 and/or convert to a COG into a temporary file, rename it to the output,
+        then remove the working files
+        """
+        self.flush()
+        if self.renamed:
+            self.ds = self.band = None
+            os.replace(self.work_path, self.path)
+            return self.path
+
+        src_path = self.work_path
+        if self.scaled:
+            src_path = (self.path if self.work_dir is None else self.work_path) + '.int16.tif'
+            self._write_int16(src_path)
+        self.ds = self.band = None
+
+        tmp_path = self.path + '.tmp.tif'
+        if self.cog:
+            translate_cog(src_path, tmp_path, self.compress)
+        else:
+            translate = gdal.Translate(tmp_path, src_path, format='GTiff', creationOptions=[
+                'TILED=YES', 'COMPRESS={}'.format(self.compress), 'PREDICTOR={}'.format(2 if self.scaled else 3),
+                'BIGTIFF=IF_SAFER'])
+            if translate is None:
+                raise IOError("Can't write {}".format(tmp_path))
+            translate = None
+        os.replace(tmp_path, self.path)
+
+        for p in {self.work_path, src_path}:
+            gdal.GetDriverByName('GTiff').Delete(p)
+        return self.path
+
+    def discard(self):
+        """
+        Drop a product that was only needed while the scene was processed, nothing is written to the output
+        """
+        self.ds = self.band = None
+        gdal.GetDriverByName('GTiff').Delete(self.work_path)
+
+    def _write_int16(self, int16_path):
+        scale, offset = PRODUCT_SCALING[self.product]
+        ds = create_tiled(int16_path, self.grid, data_type=gdal.GDT_Int16, nodata=INT16_NODATA)
+        band = ds.GetRasterBand(1)
+        band.SetScale(scale)
+        band.SetOffset(offset)
+        xsize, ysize = self.grid[2], self.grid[3]
+        # one row of working blocks at a time
+        for yoff in range(0, ysize, WORK_BLOCKSIZE):
+            window = (0, yoff, xsize, min(WORK_BLOCKSIZE, ysize - yoff))
+            band.WriteArray(encode_int16(self.read(window), scale, offset), 0, yoff)
+        ds.FlushCache()
+        ds = None
+
+
+def decode_int16(arr, scale, offset):
+    """
+    :return: float32 values of a scaled int16 block with nodata as NaN
+    """
+    out = arr.astype(np.float32) * scale + offset
+    out[arr == INT16_NODATA] = np.nan
+    return out
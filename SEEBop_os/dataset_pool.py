@@ -0,0 +1,124 @@
+# ===============================================================================
+# Copyright 2019 Gabriel Parrish
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from osgeo import gdal
+# ============= standard library imports ========================
+
+"""Process wide pool of open GDAL datasets for the small reads of the point extraction scripts.
+
+Opening a raster (and parsing its header) costs about as much as reading a pixel of it, more so on a network file
+system, and the same daily raster is read for every station. DatasetPool keeps the datasets open between reads,
+keyed by path and modification time so a rewritten file is opened again, and least recently used handles are closed
+beyond a count. Only the handles are pooled, the callers read the windows they need through them.
+
+A GDAL dataset must not be used by two threads at once, so a handle is checked out by one thread at a time and a
+second thread reading the same file gets a handle of its own. The count bounds the idle handles only: at most
+max_datasets plus one per thread reading at that moment are open."""
+
+# default number of idle datasets kept open
+DEFAULT_MAX_DATASETS = 64
+
+
+def _modified(path):
+    # /vsi paths and the like have no modification time
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+class DatasetPool(object):
+    """
+    Least recently used pool of open datasets, keyed by (path, modification time). Thread safe.
+    """
+
+    def __init__(self, max_datasets=DEFAULT_MAX_DATASETS):
+        """
+        :param max_datasets: idle datasets kept open, the least recently used are closed beyond it. The datasets
+         checked out at the time are not counted.
+        """
+        self.max_datasets = max_datasets
+        self.hits = 0
+        self.misses = 0
+        # (path, mtime) -> list of idle datasets, least recently returned first
+        self._idle = OrderedDict()
+        self._nidle = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def checkout(self, path):
+        """
+        Borrow an open dataset of a raster, e.g. with pool.checkout(path) as ds: ...
+        The dataset is only used by the calling thread until the with block ends.
+        """
+        key = (path, _modified(path))
+        ds = None
+        with self._lock:
+            handles = self._idle.get(key)
+            if handles:
+                ds = handles.pop()
+                self._nidle -= 1
+                if not handles:
+                    del self._idle[key]
+                self.hits += 1
+            else:
+                self.misses += 1
+        if ds is None:
+            # open outside the lock so other threads are not held up
+            ds = gdal.Open(path)
+            if ds is None:
+                raise IOError("Can't open the datasource from {}".format(path))
+        try:
+            yield ds
+        finally:
+            with self._lock:
+                self._idle.setdefault(key, []).append(ds)
+                self._idle.move_to_end(key)
+                self._nidle += 1
+                while self._nidle > self.max_datasets:
+                    oldest = next(iter(self._idle))
+                    self._idle[oldest].pop(0)
+                    self._nidle -= 1
+                    if not self._idle[oldest]:
+                        del self._idle[oldest]
+
+    def clear(self):
+        """
+        Close every idle dataset
+        """
+        with self._lock:
+            self._idle.clear()
+            self._nidle = 0
+
+    def __repr__(self):
+        return 'DatasetPool({} open, {} hits, {} misses)'.format(self._nidle, self.hits, self.misses)
+
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+
+def process_pool():
+    """
+    :return: the dataset pool shared by every reader of this process
+    """
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = DatasetPool()
+    return _process_pool
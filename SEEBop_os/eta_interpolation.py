@@ -0,0 +1,335 @@
+# ===============================================================================
+# Copyright 2019 Gabriel Parrish, Matt Schauer and Gabriel Senay
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import os
+import re
+from collections import OrderedDict
+from datetime import datetime, date, timedelta
+import numpy as np
+from osgeo import gdal
+# ============= standard library imports ========================
+from SEEBop_os.ssebop_engine import TILE_SIZE, ancillary_paths, block_windows, read_planned, scene_grid, \
+    open_product, read_product_block
+from SEEBop_os.cog_writer import ProductWriter
+from SEEBop_os.warp_plan import PLAN_FOLDER, process_plans
+
+"""Daily, monthly and seasonal ETa from the per overpass ETf rasters.
+
+Between two clear overpasses of a pixel ETf is interpolated day by day, linearly or with a monotone cubic, and
+multiplied by that day's ETo_daily/eto<jdate>.tif. Cloudy (nodata) ETf pixels are skipped, so the gap of a pixel
+runs from its last clear overpass to its next one. Before the first and after the last clear overpass the nearest
+ETf is held constant.
+
+The series is streamed day by day over the whole grid. GapState holds, per pixel, the previous and the next clear
+ETf (value and date, and for the cubic the tangent at the start of the gap), so any day is interpolated from those
+two frames alone. When a day is an overpass the pixels clear on it move on to their next clear overpass, read from
+the ETf products that follow. Every ETo day is read once, resampled nearest neighbour through the warp plan of the
+scene runs (see ssebop_engine.read_planned()) so the interpolated ETa matches the scene ETa. Memory is a fixed
+number of float32 frames of the grid (the gap state, the ETo day, one month and one season accumulator) whatever
+the number of days and overpasses. Monthly and daily outputs are written as soon as they are complete."""
+
+INTERPOLATION_METHODS = ('linear', 'spline')
+
+# ETf range of the SSEBop products
+ETF_MAX = 1.05
+
+# per overpass ETf products, e.g. etf20040703.tif (a mosaic) or etf20040703_033037.tif (a scene). The working files
+# of cog_writer (.part.tif, .tmp.tif, .int16.tif) don't match.
+ETF_NAME = re.compile(r'^etf\d{8}(_\d{6})?\.tif$')
+
+def etf_date(path):
+    """
+    :param path: ETf product path, e.g. Outputs/ETf/etf20040703.tif or etf20040703_033037.tif
+    :return: date of the overpass
+    """
+    return datetime.strptime(re.search(r'\d{8}', os.path.basename(path)).group(), '%Y%m%d').date()
+
+
+def month_key(day):
+    return day.strftime('%Y%m')
+
+
+class EToSeries(object):
+    """
+    Daily ETo rasters on the target grid, resampled nearest neighbour through a warp plan as in the scene runs
+    """
+
+    def __init__(self, aux_inputdir, grid, k=1, plans=None):
+        """
+        :param k: k factor applied to ETo, as in the scene runs
+        :param plans: warp_plan.WarpPlanCache, default the plans saved in Inputs/warp_plans
+        """
+        self.aux_inputdir = aux_inputdir
+        self.grid = grid
+        self.k = float(k)
+        self.plans = process_plans(os.path.join(aux_inputdir, PLAN_FOLDER)) if plans is None else plans
+
+    def read(self, day):
+        """
+        :return: float32 ETo of the day on the whole grid, times k, NaN where ETo is nodata
+        """
+        path = ancillary_paths(self.aux_inputdir, day.strftime('%Y%m%d'))['eto']
+        if not os.path.exists(path):
+            raise IOError('no ETo input {} for {}'.format(path, day))
+        eto = read_planned(path, self.grid, self.plans)
+        if self.k != 1.:
+            eto *= self.k
+        return eto
+
+
+class Overpasses(object):
+    """
+    The ETf products in date order, the products of the same day (several path/rows) read as one frame
+    """
+
+    def __init__(self, etf_paths, grid):
+        """
+        :param etf_paths: ETf product paths
+        :param grid: (projection, geotransform, xsize, ysize) the products are read on
+        """
+        by_day = OrderedDict()
+        for path in sorted(etf_paths, key=etf_date):
+            by_day.setdefault(etf_date(path), []).append(open_product(path, grid))
+        self.days = list(by_day)
+        self.products = list(by_day.values())
+        self.window = (0, 0, grid[2], grid[3])
+        self._buffer = np.empty((grid[3], grid[2]), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.days)
+
+    def read(self, i, out):
+        """
+        :return: float32 ETf frame of overpass i, NaN where cloudy or nodata. Where path/rows of the day overlap the
+         last clear one wins.
+        """
+        out.fill(np.nan)
+        for product in self.products[i]:
+            frame = read_product_block(product, self.window, self._buffer)
+            np.copyto(out, frame, where=np.isfinite(frame))
+        return out
+
+
+def hermite_slopes(secant, previous):
+    """
+    Tangent at the start of a gap for the monotone cubic (Fritsch-Carlson): the harmonic mean of the previous and
+    current secants where they have the same sign, 0 where the series turns. The tangent at the end of the gap is
+    the current secant, the next overpass is not known yet.
+    """
+    slopes = secant.copy()
+    known = np.isfinite(previous)
+    same = known & (previous * secant > 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slopes[same] = 2. / (1. / previous[same] + 1. / secant[same])
+    slopes[known & ~same] = 0.
+    return slopes
+
+
+class GapState(object):
+    """
+    Previous and next clear overpass of every pixel of the grid
+    """
+
+    def __init__(self, overpasses, method):
+        """
+        :param overpasses: Overpasses
+        :param method: 'linear' or 'spline'
+        """
+        shape = overpasses.window[3], overpasses.window[2]
+        self.overpasses = overpasses
+        self.method = method
+        self.prev_value = np.full(shape, np.nan, dtype=np.float32)
+        self.prev_day = np.zeros(shape, dtype=np.int32)
+        self.next_value = np.full(shape, np.nan, dtype=np.float32)
+        self.next_day = np.zeros(shape, dtype=np.int32)
+        # secant of the gap from the previous to the next clear overpass, and for the cubic the tangent at its start
+        self.secant = np.full(shape, np.nan, dtype=np.float32)
+        self.slope = np.full(shape, np.nan, dtype=np.float32) if method == 'spline' else None
+        self._frame = np.empty(shape, dtype=np.float32)
+        self._find_next(np.ones(shape, dtype=np.bool_), 0)
+
+    def seen(self):
+        """
+        :return: boolean frame, True where the pixel has at least one clear overpass
+        """
+        return np.isfinite(self.prev_value) | np.isfinite(self.next_value)
+
+    def advance(self, i):
+        """
+        Move the pixels that are clear on overpass i on to their next clear overpass. Called once the day of the
+        overpass is accumulated.
+        """
+        moving = self.next_day == self.overpasses.days[i].toordinal()
+        moving &= np.isfinite(self.next_value)
+        if not moving.any():
+            return
+        self.prev_value[moving] = self.next_value[moving]
+        self.prev_day[moving] = self.next_day[moving]
+        self.next_value[moving] = np.nan
+        self._find_next(moving, i + 1)
+
+        span = (self.next_day[moving] - self.prev_day[moving]).astype(np.float32)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            secant = (self.next_value[moving] - self.prev_value[moving]) / span
+        if self.slope is not None:
+            self.slope[moving] = hermite_slopes(secant, self.secant[moving])
+        self.secant[moving] = secant
+
+    def etf(self, t, window, out):
+        """
+        :param t: day ordinal, after the previous and at most the next clear overpass of every pixel
+        :param window: (xoff, yoff, xcount, ycount) of the block
+        :return: float32 ETf of the pixels of the block on day t, NaN where the pixel is never clear
+        """
+        xoff, yoff, xcount, ycount = window
+        rows, cols = slice(yoff, yoff + ycount), slice(xoff, xoff + xcount)
+        v0, v1 = self.prev_value[rows, cols], self.next_value[rows, cols]
+        # before the first clear overpass the next one is held, after the last the previous one
+        np.copyto(out, v1)
+        np.copyto(out, v0, where=np.isfinite(v0))
+        gap = np.isfinite(v0) & np.isfinite(v1)
+        if not gap.any():
+            return out
+        v0, v1 = v0[gap], v1[gap]
+        t0 = self.prev_day[rows, cols][gap]
+        secant = self.secant[rows, cols][gap]
+        if self.slope is None:
+            out[gap] = v0 + secant * (t - t0)
+        else:
+            h = (self.next_day[rows, cols][gap] - t0).astype(np.float32)
+            m0 = self.slope[rows, cols][gap]
+            s = (t - t0) / h
+            s2 = s * s
+            s3 = s2 * s
+            etf_t = ((2 * s3 - 3 * s2 + 1) * v0 + (s3 - 2 * s2 + s) * h * m0 +
+                     (-2 * s3 + 3 * s2) * v1 + (s3 - s2) * h * secant)
+            out[gap] = np.clip(etf_t, 0, ETF_MAX)
+        return out
+
+    def _find_next(self, pending, first):
+        # read the overpasses from first on until every pending pixel has found a clear one
+        pending = pending.copy()
+        for i in range(first, len(self.overpasses)):
+            if not pending.any():
+                break
+            frame = self.overpasses.read(i, self._frame)
+            found = pending & np.isfinite(frame)
+            self.next_value[found] = frame[found]
+            self.next_day[found] = self.overpasses.days[i].toordinal()
+            pending &= ~found
+
+
+def output_file(output, folder, name):
+    """
+    :return: path of an output in a sub folder of output, the folder is created if needed
+    """
+    outfolder = os.path.join(output, folder)
+    if not os.path.exists(outfolder):
+        os.makedirs(outfolder)
+    return os.path.join(outfolder, name)
+
+
+def write_frame(path, arr, grid, tile_size, options):
+    """
+    Write a whole grid float32 array as a product. NaN in arr are replaced with the nodata value in place.
+    """
+    writer = ProductWriter(path, grid, 'ETa', **options)
+    for xoff, yoff, xcount, ycount in block_windows(grid[2], grid[3], tile_size):
+        writer.write(arr[yoff:yoff + ycount, xoff:xoff + xcount], (xoff, yoff, xcount, ycount))
+    return writer.close()
+
+
+def interpolate_eta(etf_paths, aux_inputdir, output, start=None, end=None, method='linear', k=1, grid=None,
+                    tile_size=TILE_SIZE, daily=False, cog=True, scaled=False, compress='DEFLATE'):
+    """
+    Interpolate the ETf of a series of overpasses to daily ETa and write the monthly and seasonal totals.
+    :param etf_paths: list of ETf products (any order), or a folder holding them, e.g. Outputs/ETf
+    :param aux_inputdir: folder with the ETo_daily inputs
+    :param output: root of the output folders, the totals go to ETa_monthly, ETa_seasonal (and ETa_daily)
+    :param start: first day of the period, default the first day of the month of the first overpass
+    :param end: last day of the period, default the last day of the month of the last overpass
+    :param method: 'linear' or 'spline' (monotone cubic) interpolation of ETf between clear overpasses
+    :param k: k factor applied to ETo
+    :param grid: (projection, geotransform, xsize, ysize) of the outputs, default the grid of the first ETf
+    :param tile_size: edge of the blocks each day is computed and written in
+    :param daily: if True also write a daily ETa raster for every day of the period
+    :return: dict of 'YYYYMM' -> monthly ETa path, plus 'season' -> seasonal ETa path
+    """
+    if method not in INTERPOLATION_METHODS:
+        raise ValueError('method must be one of {}'.format(INTERPOLATION_METHODS))
+    if isinstance(etf_paths, str):
+        etf_paths = [os.path.join(etf_paths, name) for name in os.listdir(etf_paths) if ETF_NAME.match(name)]
+    etf_paths = sorted(etf_paths, key=etf_date)
+    if not etf_paths:
+        raise ValueError('no ETf rasters to interpolate')
+    if start is None:
+        start = etf_date(etf_paths[0]).replace(day=1)
+    if end is None:
+        last = etf_date(etf_paths[-1])
+        end = (last.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+    if grid is None:
+        grid = scene_grid(gdal.Open(etf_paths[0]))
+    print('interpolating {} ETf overpasses to daily ETa from {} to {} ({})'.format(len(etf_paths), start, end,
+                                                                               method))
+
+    overpasses = Overpasses(etf_paths, grid)
+    state = GapState(overpasses, method)
+    never_clear = ~state.seen()
+    eto = EToSeries(aux_inputdir, grid, k)
+    overpass_index = {day.toordinal(): i for i, day in enumerate(overpasses.days)}
+
+    options = {'cog': cog, 'scaled': scaled, 'compress': compress}
+    shape = (grid[3], grid[2])
+    month = np.zeros(shape, dtype=np.float32)
+    season = np.zeros(shape, dtype=np.float32)
+    etf_day = np.empty(shape, dtype=np.float32)
+    paths = {}
+
+    # overpasses before the period only set the previous clear ETf of the pixels
+    first_day = min(start, overpasses.days[0])
+    for t in range(first_day.toordinal(), end.toordinal() + 1):
+        day = date.fromordinal(t)
+        if day >= start:
+            eto_day = eto.read(day)
+            eta_day = np.full(shape, np.nan, dtype=np.float32) if daily else None
+            for window in block_windows(grid[2], grid[3], tile_size):
+                xoff, yoff, xcount, ycount = window
+                rows, cols = slice(yoff, yoff + ycount), slice(xoff, xoff + xcount)
+                etf = state.etf(t, window, etf_day[rows, cols])
+                clear = np.isfinite(etf)
+                eta = etf * eto_day[rows, cols]
+                month[rows, cols][clear] += eta[clear]
+                season[rows, cols][clear] += eta[clear]
+                if daily:
+                    eta_day[rows, cols] = eta
+            if daily:
+                write_frame(output_file(output, 'ETa_daily', 'eta{}.tif'.format(day.strftime('%Y%m%d'))), eta_day,
+                            grid, tile_size, options)
+
+            if t == end.toordinal() or (day + timedelta(days=1)).month != day.month:
+                key = month_key(day)
+                print('writing the ETa of {}'.format(key))
+                month[never_clear] = np.nan
+                paths[key] = write_frame(output_file(output, 'ETa_monthly', 'eta_monthly_{}.tif'.format(key)),
+                                         month, grid, tile_size, options)
+                month.fill(0)
+
+        if t in overpass_index:
+            state.advance(overpass_index[t])
+
+    print('writing the seasonal ETa')
+    season[never_clear] = np.nan
+    paths['season'] = write_frame(output_file(output, 'ETa_seasonal', 'eta_seasonal_{}_{}.tif'.format(
+        start.strftime('%Y%m%d'), end.strftime('%Y%m%d'))), season, grid, tile_size, options)
+    return paths
@@ -0,0 +1,218 @@
+# ===============================================================================
+# Copyright 2019 Gabriel Parrish
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import os
+import re
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+from osgeo import gdal
+# ============= standard library imports ========================
+from utils.os_utils import windows_path_fix
+
+"""Pixel-major store of a daily GridMET archive for fast point time series.
+
+The daily archive is one raster per day (<root>/<year>/eto<YYYY><doy>.tif), so the series of one pixel is spread
+over thousands of files and a station extraction opens every one of them. build_cube() rechunks the archive once
+into a (time, y, x) cube whose chunks are long in time and small in space, as Zarr (a .zarr folder) or NetCDF4 (a
+.nc file, needs netCDF4). The cube is written strip by strip of whole chunk rows, as many as fit a memory budget, so
+every chunk is written exactly once and every daily raster is opened once per strip rather than once per chunk row.
+
+GridmetCube then reads the whole daily series of any point from the one or two chunks holding its pixel. The time
+axis is contiguous from the first to the last day of the archive, missing days are NaN."""
+
+# days per chunk, 20 years of daily values by default so a full series is one or two chunk reads
+TIME_CHUNK = 7305
+
+# rows and columns per chunk
+SPACE_CHUNK = 16
+
+# memory budget of the strip of days read at once by build_cube()
+STRIP_BYTES = 2 * 1024 ** 3
+
+
+def daily_files(root, variable='eto'):
+    """
+    Find the daily rasters of an archive
+    :param root: folder of the archive, searched recursively (e.g. the year folders of the GridMET ETo)
+    :param variable: file name prefix, the files are <variable><YYYY><doy>.tif or <variable><YYYYMMDD>.tif
+    :return: dict of date -> path
+    """
+    pattern = re.compile(r'^{}(\d{{4}})(\d{{3}}|\d{{4}})\.tif$'.format(re.escape(variable)))
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            match = pattern.match(name)
+            if match:
+                year, day = match.groups()
+                fmt = '%Y%j' if len(day) == 3 else '%Y%m%d'
+                files[datetime.strptime(year + day, fmt).date()] = os.path.join(dirpath, name)
+    return files
+
+
+def _read_rows(path, yoff, rows, out):
+    ds = gdal.Open(path)
+    if ds is None:
+        raise IOError("Can't open the datasource from {}".format(path))
+    band = ds.GetRasterBand(1)
+    band.ReadAsArray(0, yoff, ds.RasterXSize, rows, buf_obj=out)
+    nodata = band.GetNoDataValue()
+    if nodata is not None:
+        out[out == nodata] = np.nan
+    return out
+
+
+def _create(cube_path, variable, shape, chunks, attrs):
+    if cube_path.endswith('.nc'):
+        # optional dependency, only needed for NetCDF cubes
+        import netCDF4
+        ds = netCDF4.Dataset(cube_path, 'w')
+        for dim, size in zip(('time', 'y', 'x'), shape):
+            ds.createDimension(dim, size)
+        data = ds.createVariable(variable, 'f4', ('time', 'y', 'x'), zlib=True, chunksizes=chunks,
+                                 fill_value=np.float32(np.nan))
+        ds.setncatts(attrs)
+        return ds, data
+    # optional dependency, only needed for Zarr cubes
+    import zarr
+    group = zarr.open_group(cube_path, mode='w')
+    data = group.create_dataset(variable, shape=shape, chunks=chunks, dtype='f4', fill_value=np.nan)
+    group.attrs.update(attrs)
+    return group, data
+
+
+def build_cube(root, cube_path, variable='eto', time_chunk=TIME_CHUNK, space_chunk=SPACE_CHUNK,
+               strip_bytes=STRIP_BYTES):
+    """
+    Rechunk a daily raster archive into a pixel-major cube
+    :param root: folder of the daily rasters, see daily_files()
+    :param cube_path: output cube, a .zarr folder or a .nc file
+    :param variable: file name prefix of the rasters and name of the cube variable
+    :param time_chunk: days per chunk
+    :param space_chunk: rows and columns per chunk
+    :param strip_bytes: memory budget of the strip read at once, time_chunk * rows * raster width floats. The strip
+     is a whole number of chunk rows, at least one whatever the budget.
+    :return: cube_path
+    """
+    files = daily_files(root, variable)
+    if not files:
+        raise ValueError('no {} rasters in {}'.format(variable, root))
+    start, end = min(files), max(files)
+    paths = [files.get(start + timedelta(days=i)) for i in range((end - start).days + 1)]
+    print('{} days from {} to {}, {} missing'.format(len(paths), start, end, len(paths) - len(files)))
+
+    ref = gdal.Open(files[start])
+    xsize, ysize = ref.RasterXSize, ref.RasterYSize
+    attrs = {'variable': variable, 'start_date': start.isoformat(), 'geotransform': list(ref.GetGeoTransform()),
+             'projection': ref.GetProjection()}
+    ref = None
+    time_chunk = min(time_chunk, len(paths))
+    store, data = _create(cube_path, variable, (len(paths), ysize, xsize), (time_chunk, space_chunk, space_chunk),
+                          attrs)
+
+    # every daily raster is opened once per strip, so read as many chunk rows at once as the budget allows
+    row_bytes = time_chunk * xsize * np.dtype(np.float32).itemsize
+    strip_rows = max(1, strip_bytes // (row_bytes * space_chunk)) * space_chunk
+
+    strip = None
+    for yoff in range(0, ysize, strip_rows):
+        rows = min(strip_rows, ysize - yoff)
+        print('rows {} to {} of {}'.format(yoff, yoff + rows, ysize))
+        for toff in range(0, len(paths), time_chunk):
+            days = paths[toff:toff + time_chunk]
+            if strip is None or strip.shape != (len(days), rows, xsize):
+                strip = np.empty((len(days), rows, xsize), dtype=np.float32)
+            for i, path in enumerate(days):
+                if path is None:
+                    strip[i] = np.nan
+                else:
+                    _read_rows(path, yoff, rows, strip[i])
+            data[toff:toff + len(days), yoff:yoff + rows, :] = strip
+
+    if cube_path.endswith('.nc'):
+        store.close()
+    return cube_path
+
+
+class GridmetCube(object):
+    """
+    Reader of the daily series of points from a cube made by build_cube()
+    """
+
+    def __init__(self, cube_path):
+        """
+        :param cube_path: .zarr folder or .nc file
+        """
+        self.path = cube_path
+        if cube_path.endswith('.nc'):
+            import netCDF4
+            self.store = netCDF4.Dataset(cube_path, 'r')
+            attrs = {name: self.store.getncattr(name) for name in self.store.ncattrs()}
+            self.data = self.store.variables[attrs['variable']]
+            self.data.set_auto_mask(False)
+        else:
+            import zarr
+            self.store = zarr.open_group(cube_path, mode='r')
+            attrs = dict(self.store.attrs)
+            self.data = self.store[attrs['variable']]
+        self.variable = attrs['variable']
+        self.geotransform = [float(v) for v in attrs['geotransform']]
+        self.projection = attrs['projection']
+        self.dates = pd.date_range(attrs['start_date'], periods=self.data.shape[0], freq='D')
+
+    def pixel(self, x, y):
+        """
+        :return: (row, col) of the pixel of a point, None if it is outside the cube
+        """
+        gt = self.geotransform
+        col = int(np.floor((x - gt[0]) / gt[1]))
+        row = int(np.floor((y - gt[3]) / gt[5]))
+        if 0 <= row < self.data.shape[1] and 0 <= col < self.data.shape[2]:
+            return row, col
+        return None
+
+    def series(self, x, y):
+        """
+        :param x: x coordinate of the point in the cube's coordinate system (lon for GridMET)
+        :param y: y coordinate (lat)
+        :return: pandas Series of the daily values indexed by date, NaN if the point is outside the cube
+        """
+        pixel = self.pixel(x, y)
+        if pixel is None:
+            values = np.full(len(self.dates), np.nan, dtype=np.float32)
+        else:
+            values = np.asarray(self.data[:, pixel[0], pixel[1]], dtype=np.float32)
+        return pd.Series(values, index=self.dates, name=self.variable)
+
+    def points(self, xs, ys, names=None):
+        """
+        :param names: column names, default the point numbers
+        :return: pandas DataFrame of the daily values, one column per point
+        """
+        names = range(len(xs)) if names is None else names
+        return pd.DataFrame({name: self.series(x, y) for name, x, y in zip(names, xs, ys)}, index=self.dates)
+
+    def close(self):
+        if self.path.endswith('.nc'):
+            self.store.close()
+
+
+def run():
+    gridmet_ETo_root = windows_path_fix(r'Z:\Data\ReferenceET\USA\Gridmet\Daily\ETo')
+    cube_path = windows_path_fix(r'Z:\Data\ReferenceET\USA\Gridmet\Daily\eto_daily.zarr')
+    build_cube(gridmet_ETo_root, cube_path)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,95 @@
+# ===============================================================================
+# Copyright 2019 Gabriel Parrish, Matt Schauer and Gabriel Senay
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import os
+import tarfile
+from osgeo import gdal
+# ============= standard library imports ========================
+from SEEBop_os.ssebop_engine import match_scene_files, parse_mtl, parse_scene_name, scene_pathrow, ssebop_scene, \
+    TILE_SIZE
+from SEEBop_os.pipeline_profile import NULL_PROFILE
+
+"""Reads the Landsat bands SSEBop needs straight out of the scene .tar.gz with GDAL's /vsitar/ handler, so nothing is
+unpacked to scratch. Only the red, NIR, thermal and BQA bands and the MTL file are ever touched."""
+
+
+def vsitar_path(tarball, member):
+    """
+    :param tarball: string path to the .tar.gz
+    :param member: name of the file inside the archive
+    :return: GDAL virtual path to the member, e.g. /vsitar/D:/scenes/LC08_....tar.gz/LC08_..._B4.TIF
+    """
+    return '/vsitar/{}/{}'.format(os.path.abspath(tarball).replace('\\', '/'), member)
+
+
+def archive_paths(tarball):
+    """
+    Find the scene files SSEBop needs inside the archive and read the _MTL.txt out of it without writing to disk.
+    Both go through GDAL's /vsitar/ handler, which scans the archive once and keeps its listing for the band reads
+    that follow, instead of gunzipping it again in Python.
+    :param tarball: string path to the Landsat .tar.gz
+    :return: tuple of (dict of 'red', 'nir', 'thermal', 'qa' -> /vsitar/ path, dict of the parsed MTL)
+    """
+    scenedate, landsat_number = parse_scene_name(os.path.basename(tarball))
+    names = gdal.ReadDirRecursive(vsitar_path(tarball, '').rstrip('/'))
+    if not names:
+        raise IOError("Can't list the files of {}".format(tarball))
+    members = match_scene_files([name for name in names if not name.endswith('/')], landsat_number)
+    mtl = parse_mtl(read_vsi_text(vsitar_path(tarball, members.pop('mtl'))).splitlines())
+    return {k: vsitar_path(tarball, v) for k, v in members.items()}, mtl
+
+
+def read_vsi_text(path):
+    """
+    :param path: any path of GDAL's virtual file systems, e.g. /vsitar/...
+    :return: the content of the file as a string
+    """
+    vsifile = gdal.VSIFOpenL(path, 'rb')
+    if vsifile is None:
+        raise IOError("Can't open {}".format(path))
+    try:
+        gdal.VSIFSeekL(vsifile, 0, 2)
+        size = gdal.VSIFTellL(vsifile)
+        gdal.VSIFSeekL(vsifile, 0, 0)
+        return gdal.VSIFReadL(1, size, vsifile).decode('utf-8')
+    finally:
+        gdal.VSIFCloseL(vsifile)
+
+
+def read_archive_mtl(tarball):
+    """
+    Stream only the _MTL.txt out of a scene archive. Members are read in order and decompression stops as soon as
+    the metadata is found.
+    :param tarball: string path to the Landsat .tar.gz
+    :return: dict of the parsed MTL
+    """
+    with tarfile.open(tarball, mode='r|*') as tar:
+        for member in tar:
+            if member.name.lower().endswith('_mtl.txt'):
+                return parse_mtl(tar.extractfile(member).read().decode('utf-8').splitlines())
+    raise IOError('no _MTL.txt in {}'.format(tarball))
+
+
+def process_archive(tarball, aux_inputdir, output, k=1, tile_size=TILE_SIZE, **kwargs):
+    """
+    Run SSEBop on a scene tarball without unpacking it.
+    :param tarball: string path to the Landsat .tar.gz
+    :param kwargs: further options of ssebop_engine.ssebop_scene() (debug, cache, cog, scaled, compress, profile)
+    :return: tuple of (scenedate, cfactor, number of pixels the c-factor was computed from)
+    """
+    scenedate, landsat_number = parse_scene_name(os.path.basename(tarball))
+    with (kwargs.get('profile') or NULL_PROFILE).stage('metadata'):
+        paths, mtl = archive_paths(tarball)
+    return ssebop_scene(paths, mtl, scenedate, landsat_number, aux_inputdir, output, k=k, tile_size=tile_size,
+                        pathrow=scene_pathrow(os.path.basename(tarball)), **kwargs)
@@ -0,0 +1,272 @@
+# ===============================================================================
+# Copyright 2019 Gabriel Parrish, Matt Schauer and Gabriel Senay
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import os
+import re
+import math
+import numpy as np
+from osgeo import gdal, osr
+# ============= standard library imports ========================
+from SEEBop_os.ssebop_engine import PRODUCTS, TILE_SIZE, block_windows, open_product, output_path, \
+    read_product_block, scene_grid
+from SEEBop_os.ancillary_cache import subgrid_window
+from SEEBop_os.cog_writer import ProductWriter
+
+"""Same date path/row mosaics of the SSEBop products.
+
+Every scene is written as Outputs/<product>/<product><date>_<pathrow>.tif. mosaic_outputs() groups them by date and
+writes one basin wide raster per product and day to Outputs/Mosaic/<product>/<product><date>.tif. All the days share
+one basin grid (the union of the scene grids on the lattice of the first scene) so the mosaics stack for the ETa
+interpolation.
+
+The merge is windowed: the scenes are opened on the basin grid as VRTs (a plain window when they are on the same
+lattice, a warp otherwise) and for every block one scene is chosen per pixel by the overlap rule, then the same
+choice is applied to every product the scenes of the day have (all four, or e.g. only ETf and ETa when the scenes
+were run with fewer outputs). Blocks go straight into the tiled working file of a COG writer, the full
+mosaic is never held in memory."""
+
+# clearest: where several scenes are clear, the scene with the larger clear fraction wins
+# max_ndvi: the scene with the highest NDVI wins (a greenest pixel composite)
+OVERLAP_RULES = ('clearest', 'max_ndvi')
+
+# products whose nodata is the cloud mask, the first one the scenes have decides the 'clearest' rule
+CLEAR_KEYS = ('LST', 'ETf', 'ETa')
+
+MOSAIC_FOLDER = 'Mosaic'
+
+SCENE_PRODUCT = re.compile(r'^[a-z]+(\d{8})_(\d{6})\.tif$')
+
+
+def scene_products(output):
+    """
+    Find the per scene products of an output folder
+    :return: dict of scenedate -> pathrow -> product -> path of the products each scene has
+    """
+    scenes = {}
+    for cat in PRODUCTS:
+        folder = os.path.join(output, cat)
+        if not os.path.isdir(folder):
+            continue
+        for name in os.listdir(folder):
+            match = SCENE_PRODUCT.match(name)
+            if match and name.startswith(cat.lower()):
+                scenedate, pathrow = match.groups()
+                scenes.setdefault(scenedate, {}).setdefault(pathrow, {})[cat] = os.path.join(folder, name)
+    return scenes
+
+
+def common_products(scenes):
+    """
+    :param scenes: dict of pathrow -> product -> path of one day
+    :return: the products every scene of the day has, in PRODUCTS order
+    """
+    return [cat for cat in PRODUCTS if all(cat in products for products in scenes.values())]
+
+
+def key_product(scenes, rule):
+    """
+    :return: the product the overlap rule picks the scenes of a day by
+    """
+    cats = common_products(scenes)
+    if rule == 'max_ndvi':
+        if 'NDVI' not in cats:
+            raise ValueError("the 'max_ndvi' rule needs the NDVI of every scene, run the scenes with NDVI among "
+                             "the outputs or mosaic with 'clearest'")
+        return 'NDVI'
+    for cat in CLEAR_KEYS:
+        if cat in cats:
+            return cat
+    raise ValueError("the 'clearest' rule needs one of {} for every scene".format(', '.join(CLEAR_KEYS)))
+
+
+def grid_bounds(grid, projection=None):
+    """
+    :param projection: WKT to express the bounds in, default the projection of the grid
+    :return: (xmin, ymin, xmax, ymax) of a north up grid
+    """
+    src_proj, gt, xsize, ysize = grid
+    xmin, ymax = gt[0], gt[3]
+    xmax = xmin + gt[1] * xsize
+    ymin = ymax + gt[5] * ysize
+    if projection is None or projection == src_proj:
+        return xmin, ymin, xmax, ymax
+
+    src_srs = osr.SpatialReference(wkt=src_proj)
+    dst_srs = osr.SpatialReference(wkt=projection)
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        src_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        dst_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    transform = osr.CoordinateTransformation(src_srs, dst_srs)
+    # corners and edge midpoints, a UTM scene is slightly rotated in the neighbouring zone
+    xs = (xmin, (xmin + xmax) / 2, xmax)
+    ys = (ymin, (ymin + ymax) / 2, ymax)
+    points = [transform.TransformPoint(x, y)[:2] for x in xs for y in ys]
+    return (min(p[0] for p in points), min(p[1] for p in points),
+            max(p[0] for p in points), max(p[1] for p in points))
+
+
+def union_grid(grids):
+    """
+    :param grids: list of (projection, geotransform, xsize, ysize)
+    :return: grid covering all of them on the projection and pixel lattice of the first one
+    """
+    projection, gt = grids[0][0], grids[0][1]
+    bounds = [grid_bounds(g, projection) for g in grids]
+    xmin = gt[0] + math.floor((min(b[0] for b in bounds) - gt[0]) / gt[1]) * gt[1]
+    xmax = gt[0] + math.ceil((max(b[2] for b in bounds) - gt[0]) / gt[1]) * gt[1]
+    ymax = gt[3] + math.floor((max(b[3] for b in bounds) - gt[3]) / gt[5]) * gt[5]
+    ymin = gt[3] + math.ceil((min(b[1] for b in bounds) - gt[3]) / gt[5]) * gt[5]
+    xsize = int(round((xmax - xmin) / gt[1]))
+    ysize = int(round((ymin - ymax) / gt[5]))
+    return projection, (xmin, gt[1], gt[2], ymax, gt[4], gt[5]), xsize, ysize
+
+
+def clear_fraction(path, size=256):
+    """
+    :return: fraction of the pixels of a product that are not nodata, from a decimated read (the COG overviews)
+    """
+    ds = gdal.Open(path)
+    band = ds.GetRasterBand(1)
+    arr = band.ReadAsArray(buf_xsize=min(size, ds.RasterXSize), buf_ysize=min(size, ds.RasterYSize))
+    nodata = band.GetNoDataValue()
+    valid = np.isfinite(arr) if nodata is None else (arr != nodata) & np.isfinite(arr)
+    return float(valid.mean())
+
+
+def footprint(path, grid):
+    """
+    :return: (xoff, yoff, xsize, ysize) of a product in grid pixel coordinates, or None if it is not on the lattice
+     of the grid
+    """
+    return subgrid_window(grid, scene_grid(gdal.Open(path)), contained=False)
+
+
+def overlaps(a, b):
+    """
+    :return: True if two (xoff, yoff, xsize, ysize) windows overlap. None (unknown footprint) always overlaps.
+    """
+    if a is None or b is None:
+        return True
+    return a[0] < b[0] + b[2] and b[0] < a[0] + a[2] and a[1] < b[1] + b[3] and b[1] < a[1] + a[3]
+
+
+def mosaic_date(scenedate, scenes, grid, output, rule='clearest', tile_size=TILE_SIZE, cog=True, scaled=False,
+                compress='DEFLATE'):
+    """
+    Mosaic the products of the scenes of one day
+    :param scenedate: YYYYMMDD string
+    :param scenes: dict of pathrow -> product -> path, as from scene_products()
+    :param grid: basin grid of the mosaics
+    :param output: root of the output folders
+    :param rule: 'clearest' or 'max_ndvi', see OVERLAP_RULES
+    :return: dict of product -> mosaic path, for the products every scene of the day has
+    """
+    if rule not in OVERLAP_RULES:
+        raise ValueError('rule must be one of {}'.format(OVERLAP_RULES))
+    cats = common_products(scenes)
+    key = key_product(scenes, rule)
+    pathrows = sorted(scenes)
+    if rule == 'clearest':
+        # LST (and ETf, ETa) are nodata exactly where the scene is cloudy or outside its footprint
+        pathrows.sort(key=lambda pr: clear_fraction(scenes[pr][key]), reverse=True)
+    sources = [{cat: open_product(scenes[pr][cat], grid) for cat in cats} for pr in pathrows]
+    footprints = [footprint(scenes[pr][key], grid) for pr in pathrows]
+    print('mosaicking the {} of {} scenes of {}: {}'.format(', '.join(cats), len(pathrows), scenedate,
+                                                           ', '.join(pathrows)))
+
+    mosaic_dir = os.path.join(output, MOSAIC_FOLDER)
+    paths = {cat: output_path(mosaic_dir, cat, scenedate) for cat in cats}
+    writers = {cat: ProductWriter(paths[cat], grid, cat, cog=cog, scaled=scaled, compress=compress)
+               for cat in cats}
+
+    block = out = choice = best = None
+    for window in block_windows(grid[2], grid[3], tile_size):
+        shape = (window[3], window[2])
+        if block is None or block.shape != shape:
+            block = np.empty(shape, dtype=np.float32)
+            out = np.empty(shape, dtype=np.float32)
+            choice = np.empty(shape, dtype=np.int16)
+            best = np.empty(shape, dtype=np.float32)
+        present = [i for i, f in enumerate(footprints) if overlaps(f, window)]
+
+        # pick a scene per pixel from the key product
+        choice.fill(-1)
+        best.fill(-np.inf)
+        for i in present:
+            value = read_product_block(sources[i][key], window, block)
+            with np.errstate(invalid='ignore'):
+                if rule == 'clearest':
+                    better = (choice < 0) & np.isfinite(value)
+                else:
+                    better = value > best
+            choice[better] = i
+            best[better] = value[better]
+
+        for cat in cats:
+            out.fill(np.nan)
+            for i in present:
+                chosen = choice == i
+                if chosen.any():
+                    np.copyto(out, read_product_block(sources[i][cat], window, block), where=chosen)
+            writers[cat].write(out, window)
+
+    for writer in writers.values():
+        writer.close()
+    return paths
+
+
+def is_current(paths, scenes, grid):
+    """
+    :return: True if all the mosaics exist on the basin grid and are newer than every scene product they are made of
+    """
+    if not all(os.path.exists(p) for p in paths.values()):
+        return False
+    if scene_grid(gdal.Open(next(iter(paths.values())))) != tuple(grid):
+        return False
+    oldest = min(os.path.getmtime(p) for p in paths.values())
+    return all(os.path.getmtime(p) <= oldest for products in scenes.values() for p in products.values())
+
+
+def mosaic_outputs(output, rule='clearest', tile_size=TILE_SIZE, grid=None, overwrite=False, **kwargs):
+    """
+    Mosaic the scene products of every date in an output folder onto one basin grid
+    :param output: root of the output folders
+    :param rule: 'clearest' or 'max_ndvi', see OVERLAP_RULES
+    :param grid: basin grid, default the union of all the scene grids
+    :param overwrite: if False dates whose mosaics are newer than their scene products are skipped
+    :param kwargs: cog, scaled, compress options of the mosaics
+    :return: dict of scenedate -> product -> mosaic path
+    """
+    scenes = scene_products(output)
+    if not scenes:
+        print('no scene products to mosaic in {}'.format(output))
+        return {}
+    if grid is None:
+        grid = union_grid([scene_grid(gdal.Open(next(iter(products.values()))))
+                           for pathrows in scenes.values() for products in pathrows.values()])
+    print('basin grid of {} x {} pixels'.format(grid[2], grid[3]))
+
+    mosaics = {}
+    for scenedate in sorted(scenes):
+        cats = common_products(scenes[scenedate])
+        if not cats:
+            print('the scenes of {} have no product in common, not mosaicked'.format(scenedate))
+            continue
+        paths = {cat: os.path.join(output, MOSAIC_FOLDER, cat, cat.lower() + scenedate + '.tif') for cat in cats}
+        if not overwrite and is_current(paths, scenes[scenedate], grid):
+            print('mosaic of {} is up to date'.format(scenedate))
+        else:
+            paths = mosaic_date(scenedate, scenes[scenedate], grid, output, rule, tile_size, **kwargs)
+        mosaics[scenedate] = paths
+    return mosaics
@@ -0,0 +1,210 @@
+# ===============================================================================
+# Copyright 2019 Gabriel Parrish, Matt Schauer and Gabriel Senay
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+# ============= standard library imports ========================
+
+"""Per stage timing and memory instrumentation of the scene pipeline.
+
+A SceneProfile accumulates wall time, CPU time, bytes read and written and the peak resident memory of named stages
+(extract, metadata, read, cloud_mask, ndvi, lst, cfactor, etf, eta, write...). Stages that run once per block are
+summed over the blocks. The scheduler writes one JSON line per scene to Outputs/pipeline_profile.jsonl and prints a
+summary table at the end of a batch: a stage whose CPU time is well below its wall time is waiting on I/O.
+
+CPU time and I/O counters are per process and include GDAL's own threads. Bytes are the read()/write() volume from
+/proc/self/io (Linux only, including page cache hits) and peak RSS comes from /proc/self/status or getrusage. When the
+blocks of a scene run on several threads the spans of concurrent blocks overlap, so the stages can add up to more
+wall time than the scene took."""
+
+PROFILE_NAME = 'pipeline_profile.jsonl'
+
+# order of the stages in the summary table, stages not listed here come after them
+STAGES = ('extract', 'metadata', 'ancillary', 'read', 'cloud_mask', 'ndvi', 'lst', 'cfactor', 'etf', 'eta',
+          'write')
+
+
+def io_counters():
+    """
+    :return: tuple of (bytes read, bytes written) by this process so far, or (None, None) if unavailable
+    """
+    try:
+        with open('/proc/self/io', 'r') as rfile:
+            counters = dict(line.split(':') for line in rfile)
+        return int(counters['rchar']), int(counters['wchar'])
+    except (IOError, OSError, KeyError, ValueError):
+        return None, None
+
+
+def peak_rss():
+    """
+    :return: peak resident memory of this process in bytes, or None if unavailable
+    """
+    try:
+        with open('/proc/self/status', 'r') as rfile:
+            for line in rfile:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def reset_peak_rss():
+    """
+    Reset the peak RSS high water mark (Linux only) so a pool worker reports the peak of each scene rather than of
+    its whole lifetime. Elsewhere the peak stays cumulative.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as wfile:
+            wfile.write('5')
+    except (IOError, OSError):
+        pass
+
+
+class SceneProfile(object):
+    """
+    Accumulated spans of the stages of one scene
+    """
+
+    def __init__(self, scene_id):
+        """
+        :param scene_id: name the scene is reported under, e.g. the tarball name
+        """
+        self.scene_id = scene_id
+        self.stages = {}
+        self._lock = threading.Lock()
+        self.started = datetime.now().isoformat()
+        reset_peak_rss()
+        self._wall0 = time.perf_counter()
+        self._cpu0 = time.process_time()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time a stage, e.g. with profile.stage('ndvi'): ... Repeated spans of the same stage are summed.
+        """
+        read0, written0 = io_counters()
+        cpu0 = time.process_time()
+        wall0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall0
+            cpu = time.process_time() - cpu0
+            read1, written1 = io_counters()
+            rss = peak_rss()
+            # blocks of a scene may run on several threads
+            with self._lock:
+                span = self.stages.setdefault(name, {'calls': 0, 'wall': 0., 'cpu': 0., 'bytes_read': 0,
+                                                     'bytes_written': 0, 'peak_rss': None})
+                span['calls'] += 1
+                span['wall'] += wall
+                span['cpu'] += cpu
+                if read0 is not None:
+                    span['bytes_read'] += read1 - read0
+                    span['bytes_written'] += written1 - written0
+                if rss is not None:
+                    span['peak_rss'] = max(rss, span['peak_rss'] or 0)
+
+    def record(self):
+        """
+        :return: JSON serialisable dict of the scene and its stages
+        """
+        return {'scene': self.scene_id,
+                'started': self.started,
+                'wall': time.perf_counter() - self._wall0,
+                'cpu': time.process_time() - self._cpu0,
+                'peak_rss': peak_rss(),
+                'pid': os.getpid(),
+                'stages': self.stages}
+
+
+class NullProfile(object):
+    """
+    Stand in for a SceneProfile when the pipeline is not instrumented
+    """
+
+    @contextmanager
+    def stage(self, name):
+        yield
+
+
+NULL_PROFILE = NullProfile()
+
+
+def write_profiles(output, records):
+    """
+    Append one JSON line per scene to Outputs/pipeline_profile.jsonl
+    :param output: root of the output folders
+    :param records: list of SceneProfile.record() dicts
+    """
+    with open(os.path.join(output, PROFILE_NAME), 'a') as wfile:
+        for record in records:
+            wfile.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def stage_totals(records):
+    """
+    :param records: list of SceneProfile.record() dicts
+    :return: dict of stage -> wall, cpu, bytes_read and bytes_written summed over the scenes and the largest peak_rss
+    """
+    totals = {}
+    for record in records:
+        for name, span in record['stages'].items():
+            total = totals.setdefault(name, {'wall': 0., 'cpu': 0., 'bytes_read': 0, 'bytes_written': 0,
+                                             'peak_rss': 0})
+            for key in ('wall', 'cpu', 'bytes_read', 'bytes_written'):
+                total[key] += span[key]
+            total['peak_rss'] = max(total['peak_rss'], span['peak_rss'] or 0)
+    return totals
+
+
+def ordered_stages(names):
+    """
+    :return: the stage names in pipeline order
+    """
+    return [s for s in STAGES if s in names] + sorted(s for s in names if s not in STAGES)
+
+
+def summary_table(records):
+    """
+    :param records: list of SceneProfile.record() dicts
+    :return: string table of the stages summed over the scenes
+    """
+    totals = stage_totals(records)
+    wall_sum = sum(t['wall'] for t in totals.values()) or 1.
+    header = '{:<12}{:>10}{:>10}{:>7}{:>8}{:>11}{:>11}{:>11}'.format('stage', 'wall s', 'cpu s', 'cpu%', 'share',
+                                                                    'read MB', 'write MB', 'peak MB')
+    lines = ['{} scenes'.format(len(records)), header, '-' * len(header)]
+    for name in ordered_stages(totals):
+        t = totals[name]
+        lines.append('{:<12}{:>10.1f}{:>10.1f}{:>7.0f}{:>7.0f}%{:>11.1f}{:>11.1f}{:>11.1f}'.format(
+            name, t['wall'], t['cpu'], 100 * t['cpu'] / t['wall'] if t['wall'] else 0, 100 * t['wall'] / wall_sum,
+            t['bytes_read'] / 1e6, t['bytes_written'] / 1e6, t['peak_rss'] / 1e6))
+    return '\n'.join(lines)
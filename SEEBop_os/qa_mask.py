@@ -0,0 +1,110 @@
+# ===============================================================================
+# Copyright 2019 Gabriel Parrish, Matt Schauer and Gabriel Senay
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import numpy as np
+# ============= standard library imports ========================
+
+"""Lookup table decoding of the Landsat quality band into a clear-sky mask.
+
+The cloud mask used to keep only the pixels whose BQA was exactly 672 (Landsat 5/7) or 2720 (Landsat 8), so a clear
+pixel with e.g. a "not determined" snow confidence was thrown away. Here the QA bits are decoded by rules instead:
+every rule caps the value of one bit field (a flag or a 2 bit confidence level), and a pixel is clear when all the
+fields are within their caps. The rules are evaluated once for the 65,536 possible QA values into a boolean lookup
+table, after which masking a block is a single lut[qa] gather."""
+
+# bit fields of the quality bands as (first bit, number of bits)
+QA_LAYOUTS = {
+    # Collection 1 BQA. Bit 1 is terrain occlusion on Landsat 8 and dropped pixel on Landsat 4-7, cirrus
+    # confidence is 0 (not determined) on Landsat 4-7.
+    'C1': {'fill': (0, 1), 'occlusion': (1, 1), 'saturation': (2, 2), 'cloud': (4, 1),
+           'cloud_confidence': (5, 2), 'shadow_confidence': (7, 2), 'snow_confidence': (9, 2),
+           'cirrus_confidence': (11, 2)},
+    # Collection 2 QA_PIXEL
+    'C2': {'fill': (0, 1), 'dilated_cloud': (1, 1), 'cirrus': (2, 1), 'cloud': (3, 1), 'shadow': (4, 1),
+           'snow': (5, 1), 'clear': (6, 1), 'water': (7, 1), 'cloud_confidence': (8, 2),
+           'shadow_confidence': (10, 2), 'snow_confidence': (12, 2), 'cirrus_confidence': (14, 2)}}
+
+# file suffix of the quality band of each collection
+QA_BANDS = {'C1': 'BQA', 'C2': 'QA_PIXEL'}
+
+# confidence levels of the 2 bit fields
+NONE, LOW, MEDIUM, HIGH = 0, 1, 2, 3
+
+# default rules, field -> highest value a clear pixel may have. Water is not masked.
+DEFAULT_RULES = {
+    'C1': {'fill': 0, 'occlusion': 0, 'saturation': 0, 'cloud': 0, 'cloud_confidence': LOW,
+           'shadow_confidence': LOW, 'snow_confidence': LOW, 'cirrus_confidence': LOW},
+    'C2': {'fill': 0, 'dilated_cloud': 0, 'cirrus': 0, 'cloud': 0, 'shadow': 0, 'snow': 0}}
+
+# lookup tables already built, by (collection, rules)
+_LUTS = {}
+
+
+def mtl_collection(mtl):
+    """
+    :param mtl: dict from ssebop_engine.parse_mtl()
+    :return: 'C1' or 'C2', the layout of the scene's quality band
+    """
+    return 'C2' if mtl.get('COLLECTION_NUMBER', '01').lstrip('0') == '2' else 'C1'
+
+
+def field_values(qa, bit, width):
+    """
+    :return: value of the bit field (bit, width) of the QA values
+    """
+    return (qa >> bit) & ((1 << width) - 1)
+
+
+def build_lut(collection='C1', rules=None):
+    """
+    :param collection: 'C1' or 'C2', see QA_LAYOUTS
+    :param rules: dict of field -> highest value of a clear pixel, default DEFAULT_RULES of the collection
+    :return: boolean array of 65,536 entries, True for the clear QA values
+    """
+    if collection not in QA_LAYOUTS:
+        raise ValueError('collection must be one of {}'.format(sorted(QA_LAYOUTS)))
+    layout = QA_LAYOUTS[collection]
+    if rules is None:
+        rules = DEFAULT_RULES[collection]
+    unknown = set(rules) - set(layout)
+    if unknown:
+        raise ValueError('unknown {} QA fields: {}'.format(collection, ', '.join(sorted(unknown))))
+
+    values = np.arange(2 ** 16, dtype=np.uint16)
+    lut = np.ones(values.shape, dtype=np.bool_)
+    for field, highest in rules.items():
+        lut &= field_values(values, *layout[field]) <= highest
+    return lut
+
+
+def clear_lut(collection='C1', rules=None):
+    """
+    Like build_lut() but the tables are built once per process and shared, don't modify the result.
+    """
+    if rules is None:
+        rules = DEFAULT_RULES.get(collection, {})
+    # the rules as given, {} (nothing masked) must not share the table of the default rules
+    key = (collection, tuple(sorted(rules.items())))
+    if key not in _LUTS:
+        _LUTS[key] = build_lut(collection, rules)
+    return _LUTS[key]
+
+
+def clear_mask(qa, collection='C1', rules=None, out=None):
+    """
+    :param qa: integer QA block
+    :param out: optional boolean array of the shape of qa to write the mask into
+    :return: boolean array, True where the pixel is clear
+    """
+    return np.take(clear_lut(collection, rules), qa, out=out, mode='clip')
@@ -15,58 +15,93 @@
 import os
 import gdal
 import ogr
+import osr
 import sys
+import struct
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from dateutil import relativedelta
 from datetime import date, datetime
 import pandas as pd
+from SEEBop_os.dataset_pool import process_pool
 
 # for the local machine
 os.environ['GDAL_DATA'] = r'C:\Users\gparrish\AppData\Local\conda\conda\envs\gdal_env\Library\share\gdal'
 """This script stores functions related to reading and writing raster data using GDAL"""
 
+def read_points(point_path, field='id', columns=(), dst_srs=None, engine=None):
+    """
+    Read the ids, coordinates and attributes of a point layer in a single pass
+    :param point_path: string path to a point shapefile
+    :param field: id field
+    :param columns: further attribute fields to read, e.g. ['Elevation']
+    :param dst_srs: optional coordinate system to reproject all the points to at once, e.g. 'EPSG:4326' or the WKT
+     of a raster
+    :param engine: 'pyogrio' reads the layer in one batch with pyogrio, 'ogr' walks its features with OGR. None uses
+     pyogrio when it is installed.
+    :return: dict of 'id', 'x', 'y' and the columns -> NumPy arrays, one entry per feature
+    """
+    fields = [field] + [c for c in columns if c != field]
+    if engine is None:
+        try:
+            import pyogrio
+            engine = 'pyogrio'
+        except ImportError:
+            engine = 'ogr'
+
+    if engine == 'pyogrio':
+        from pyogrio.raw import read
+        # (meta, geometry, field data), newer versions also return the fids before the geometry
+        result = read(point_path, columns=fields)
+        meta, geometry, field_data = result[0], result[-2], result[-1]
+        values = dict(zip(meta['fields'], field_data))
+        # x and y follow the byte order flag and the geometry type of the WKB points
+        xy = [struct.unpack_from('<dd' if g[0] == 1 else '>dd', g, 5) for g in geometry]
+        src_srs = meta['crs']
+    elif engine == 'ogr':
+        datasource_obj = ogr.Open(point_path, 0)
+        if datasource_obj is None:
+            raise IOError("cannot open {}".format(point_path))
+        layer_obj = datasource_obj.GetLayer()
+        values = {name: [] for name in fields}
+        xy = []
+        for feature in layer_obj:
+            geometry = feature.GetGeometryRef()
+            xy.append((geometry.GetX(), geometry.GetY()))
+            for name in fields:
+                values[name].append(feature.GetField(name))
+        spatial_ref = layer_obj.GetSpatialRef()
+        src_srs = spatial_ref.ExportToWkt() if spatial_ref is not None else None
+        datasource_obj = None
+    else:
+        raise ValueError("engine must be 'pyogrio' or 'ogr'")
+    xy = np.array(xy, dtype=np.float64).reshape(-1, 2)
+
+    if dst_srs is not None and len(xy):
+        if not src_srs:
+            raise ValueError('{} has no coordinate system to reproject from'.format(point_path))
+        src = osr.SpatialReference()
+        src.SetFromUserInput(src_srs)
+        dst = osr.SpatialReference()
+        dst.SetFromUserInput(dst_srs)
+        if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+            src.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            dst.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        transform = osr.CoordinateTransformation(src, dst)
+        xy = np.array(transform.TransformPoints(xy.tolist()), dtype=np.float64)[:, :2]
+
+    points = {'id': np.asarray(values[field]), 'x': xy[:, 0], 'y': xy[:, 1]}
+    for name in columns:
+        points[name] = np.asarray(values[name])
+    print("there are {} features".format(len(xy)))
+    return points
+
 def val_extract(point_path, field='id', other_field='Elevation'):
 
     """For extracting other characteristics from a shapefile and saving to a dict. To be used in conjunction with x_y extract"""
 
-    # get an appropriate driver
-    driver = ogr.GetDriverByName('ESRI Shapefile')
-
-    # open the shapefile. Use 0 for read-only mode.
-    datasource_obj = driver.Open(point_path, 0)
-    if datasource_obj is None:
-        print("cannot open {}".format(point_path))
-        sys.exit(1)
-
-    # get the layer object from the datasource
-    layer_obj = datasource_obj.GetLayer()
-
-    # get the features in the layer
-    feature_count = layer_obj.GetFeatureCount()
-
-    print("there are {} features".format(feature_count))
-
-    # # get the feature of the shapefile. You can loop through features, but there should only be one.
-    # feature = layer_obj.GetFeature(2)
-
-    feature_dict = {}
-    for i in range(1, feature_count + 1, 1):
-        feature = layer_obj.GetNextFeature()
-
-        # you could get a features 'fields' like feature.GetField('id')
-        field_value = feature.GetField(field)
-
-        print("field -> {}".format(field_value))
-        other_value = feature.GetField(other_field)
-
-        feature_dict[field_value] = other_value
-
-        # housekeeping
-        feature.Destroy()  # always destroy the feature before the datasource
-
-    # housekeeping
-    datasource_obj.Destroy()
-
-    return feature_dict
+    points = read_points(point_path, field=field, columns=[other_field])
+    return dict(zip(points['id'].tolist(), points[other_field].tolist()))
 
 def x_y_extract(point_path, field='id'):
     """
@@ -74,54 +109,8 @@ def x_y_extract(point_path, field='id'):
     :param point_path: string path to point shapefile
     :return:
     """
-    # get an appropriate driver
-    driver = ogr.GetDriverByName('ESRI Shapefile')
-
-    # open the shapefile. Use 0 for read-only mode.
-    datasource_obj = driver.Open(point_path, 0)
-    if datasource_obj is None:
-        print("cannot open {}".format(point_path))
-        sys.exit(1)
-
-    # get the layer object from the datasource
-    layer_obj = datasource_obj.GetLayer()
-
-    # get the features in the layer
-    feature_count = layer_obj.GetFeatureCount()
-
-    print("there are {} features".format(feature_count))
-
-    # # get the feature of the shapefile. You can loop through features, but there should only be one.
-    # feature = layer_obj.GetFeature(2)
-
-    feature_dict = {}
-    for i in range(1, feature_count+1, 1):
-
-        feature = layer_obj.GetNextFeature()
-
-        # you could get a features 'fields' like feature.GetField('id')
-        field_value = feature.GetField(field)
-
-        # print("field -> {}".format(field_value))
-
-        # but we just want the geometry of the feature
-        geometry = feature.GetGeometryRef()
-
-        # get the x and y
-        x = geometry.GetX()
-        y = geometry.GetY()
-
-        # print("x -> {}, y -> {}".format(x, y))
-
-        feature_dict[field_value] = (x, y)
-
-        # housekeeping
-        feature.Destroy()  # always destroy the feature before the datasource
-
-    # housekeeping
-    datasource_obj.Destroy()
-
-    return feature_dict
+    points = read_points(point_path, field=field)
+    return dict(zip(points['id'].tolist(), zip(points['x'].tolist(), points['y'].tolist())))
 
 def raster_extract(raster_path, x, y, arc=True):
     """
@@ -135,18 +124,25 @@ def raster_extract(raster_path, x, y, arc=True):
     # don't forget to register
     gdal.AllRegister()
 
-    # open the raster datasource
-    datasource_obj = gdal.Open(raster_path)
-    if datasource_obj is None:
+    # open the raster datasource, or borrow it from the pool of open datasets
+    try:
+        with process_pool().checkout(raster_path) as datasource_obj:
+            value = _extract_pixel(datasource_obj, x, y)
+    except IOError:
         print("Can't open the datasource from {}".format(raster_path))
         sys.exit(1)
+    # print "VALUE {}".format(value)
+
+    # # housekeeping
+    # datasource_obj.Destroy()
+
+    return value
 
+def _extract_pixel(datasource_obj, x, y):
     # get the size of image (for reading)
     rows = datasource_obj.RasterYSize
     cols = datasource_obj.RasterXSize
 
-    # print('rows and cols \n', rows, cols)
-
     # get georefference info to eventually calculate the offset:
     transform = datasource_obj.GetGeoTransform()
     xOrigin = transform[0]
@@ -155,38 +151,113 @@ def raster_extract(raster_path, x, y, arc=True):
     width_of_pixel = transform[1]
     height_of_pixel = transform[5]
 
-    # print('widht and height \n', width_of_pixel, height_of_pixel)
-
-    # read in a band (only one band)
-    band = datasource_obj.GetRasterBand(1)
-    # ReadAsArray(xoffset, yoffset, xcount, ycount)
-    data = band.ReadAsArray(0, 0, cols, rows)
-
-    # print('shape:', data.shape)
-
     # get the offsets so you can read the data from the correct position in the array.
     print(x, xOrigin, width_of_pixel)
     print(y, yOrigin, height_of_pixel)
     x_offset = int((x - xOrigin) / width_of_pixel)
     y_offset = int((y - yOrigin) / height_of_pixel)
 
-    # print('offset\n',x_offset, y_offset)
-
-    # is this a [rows, columns] thing?
-    try:
-        value = data[y_offset, x_offset]
-    except IndexError:
+    # same pixel as indexing the whole band [rows, columns] would give: negative offsets count from the far edge
+    if -rows <= y_offset < rows and -cols <= x_offset < cols:
+        x_offset %= cols
+        y_offset %= rows
+    else:
         print('INDEX ERROR, ASSUMING that we are using mini-models and that the array is 3X3 and taking center value')
-        value = data[1, 1]
-    # print "VALUE {}".format(value)
+        x_offset, y_offset = 1, 1
 
-    # # housekeeping
-    # datasource_obj.Destroy()
+    # read in only the pixel of the point, ReadAsArray(xoffset, yoffset, xcount, ycount)
+    return datasource_obj.GetRasterBand(1).ReadAsArray(x_offset, y_offset, 1, 1)[0, 0]
 
-    return value
+def sample_points(raster_path, xs, ys, band=1, like_extract=False):
+    """
+    Sample a raster at many points at once. The raster is opened once, the coordinates are converted to pixel
+    offsets in one vectorized step and only the blocks holding a point are read, each of them once.
+    :param raster_path: string path to the raster
+    :param xs: x coordinates of the points, in the coordinate system of the raster (e.g. from x_y_extract)
+    :param ys: y coordinates of the points
+    :param band: band number
+    :param like_extract: if True return the values raster_extract() gives for each point: in the data type of the
+     band, and a point past the raster edges takes the value of pixel (1, 1)
+    :return: array of the raster values at the points (nodata is not masked), otherwise as floats with NaN for the
+     points outside the raster
+    """
+    with process_pool().checkout(raster_path) as datasource_obj:
+        return _sample_dataset(datasource_obj, xs, ys, band, like_extract)
+
+def _sample_dataset(datasource_obj, xs, ys, band, like_extract=False):
+    rows = datasource_obj.RasterYSize
+    cols = datasource_obj.RasterXSize
+    transform = datasource_obj.GetGeoTransform()
+    band_obj = datasource_obj.GetRasterBand(band)
+
+    # pixel offsets of all the points
+    x_offsets = (np.asarray(xs, dtype=np.float64) - transform[0]) / transform[1]
+    y_offsets = (np.asarray(ys, dtype=np.float64) - transform[3]) / transform[5]
+    if like_extract:
+        # truncated as int() does, negative offsets count from the far edge as indexing the whole band did
+        x_offsets = np.trunc(x_offsets).astype(np.int64)
+        y_offsets = np.trunc(y_offsets).astype(np.int64)
+        past = ~((x_offsets >= -cols) & (x_offsets < cols) & (y_offsets >= -rows) & (y_offsets < rows))
+        x_offsets = np.where(past, 1, x_offsets % cols)
+        y_offsets = np.where(past, 1, y_offsets % rows)
+    else:
+        x_offsets = np.floor(x_offsets).astype(np.int64)
+        y_offsets = np.floor(y_offsets).astype(np.int64)
+    inside = np.flatnonzero((x_offsets >= 0) & (x_offsets < cols) & (y_offsets >= 0) & (y_offsets < rows))
+
+    # group the points by the block they fall in
+    block_xsize, block_ysize = band_obj.GetBlockSize()
+    blocks_across = (cols + block_xsize - 1) // block_xsize
+    block_ids = (y_offsets[inside] // block_ysize) * blocks_across + x_offsets[inside] // block_xsize
+    order = np.argsort(block_ids, kind='stable')
+    block_ids, starts = np.unique(block_ids[order], return_index=True)
+
+    dtype = np.float64 if band_obj.DataType == gdal.GDT_Float64 else np.float32
+    values = np.full(len(x_offsets), np.nan, dtype=dtype)
+    for i, (block_id, points) in enumerate(zip(block_ids, np.split(inside[order], starts[1:]))):
+        block_row, block_col = divmod(int(block_id), blocks_across)
+        xoff, yoff = block_col * block_xsize, block_row * block_ysize
+        # ReadAsArray(xoffset, yoffset, xcount, ycount)
+        data = band_obj.ReadAsArray(xoff, yoff, min(block_xsize, cols - xoff), min(block_ysize, rows - yoff))
+        if like_extract and i == 0:
+            # every point is inside, keep the data type of the band
+            values = np.empty(len(x_offsets), dtype=data.dtype)
+        values[points] = data[y_offsets[points] - yoff, x_offsets[points] - xoff]
+    return values
+
+def gridmet_paths(root, dt_start, dt_end):
+    """
+    :param root: folder of the daily GridMET ETo, <root>/<year>/eto<YYYY><doy>.tif
+    :return: lists of the paths and the datetimes of the days from dt_start to dt_end
+    """
+    gridmet_fileseries = []
+    dt_series = []
+    for i in range((dt_end - dt_start).days + 1):
+        dt = dt_start + relativedelta.relativedelta(days=i)
+        year_dir = '{}'.format(dt.year)
+        filename = 'eto{}{}.tif'.format(dt.year, dt.strftime('%j'))
+        gridmet_fileseries.append(os.path.join(root, year_dir, filename))
+        dt_series.append(dt)
+    return gridmet_fileseries, dt_series
+
+def parse_elevation(elev, meters=True):
+    """
+    :param elev: elevation attribute of a point, a number or a string like '1520 ft'
+    :param meters: False if the elevations are in feet
+    :return: elevation in meters
+    """
+    if type(elev) == int or type(elev) == float:
+        pass
+    else:
+        elev = ''.join(c for c in elev if c.isdigit())
+    elev = int(elev)
+    if not meters:
+        # convert feet to meters
+        elev *= 0.3048
+    return elev
 
 def gridmet_extract_point(root, shape_root, shape_name, start, end, output_root, field='id',
-                          elevation_field='Elevation', elevation_meters=True):
+                          elevation_field='Elevation', elevation_meters=True, cube=None):
     """
     writes a csv for each field present in a point shapefile
     :param shape_root:
@@ -194,6 +265,9 @@ def gridmet_extract_point(root, shape_root, shape_name, start, end, output_root,
     :param start:
     :param end:
     :param output_root:
+    :param cube: optional path to a pixel-major cube of the archive made by gridmet_cube.build_cube(). The series
+     are then read from it instead of from the daily rasters under root, as float32 with NaN for the points outside
+     the archive.
     :return:
     """
     dt_start = datetime(start[0], start[1], start[2])
@@ -204,50 +278,36 @@ def gridmet_extract_point(root, shape_root, shape_name, start, end, output_root,
     shape_path = os.path.join(shape_root, shape_name)
     # shape_path = r'Z:/Users/Gabe/UpperRioGrandeBasin/Shapefiles/testpoint_extract.shp'
 
-    x_y_dict = x_y_extract(point_path=shape_path, field=field)
-    # x_y_dict = x_y_extract(point_path=shape_path, field='id')
-    elev_dict = val_extract(point_path=shape_path, field=field, other_field=elevation_field)
+    # ids, coordinates and elevations in one read of the shapefile
+    points = read_points(shape_path, field=field, columns=[elevation_field])
 
-    print('xy dict \n', x_y_dict)
     print('days', interval_td.days)
 
-    gridmet_fileseries = []
-    dt_series = []
-    for i in range(interval_td.days + 1):
-        dt = dt_start + relativedelta.relativedelta(days=i)
-        year_dir = '{}'.format(dt.year)
-        # if dt.year >= 2012:
-        #     filename = 'eto{}{:02d}{:02d}.tif'.format(dt.year, dt.month, dt.day)
-        #     print('filename: {}'.format(filename))
-        # else:
-        print(dt.strftime('%j'))
-        filename = 'eto{}{}.tif'.format(dt.year, dt.strftime('%j'))
-
-        eto_path = os.path.join(root, year_dir, filename)
-        gridmet_fileseries.append(eto_path)
-        dt_series.append(dt)
-
-    for k, v in x_y_dict.items():
-        elev = elev_dict[k]
-        if type(elev) == int or type(elev) == float:
-            pass
-        else:
-            elev = ''.join(c for c in elev if c.isdigit())
-        elev = int(elev)
-        if not elevation_meters:
-            # convert feet to meters
-            elev *= 0.3048
-        x, y = v
+    gridmet_fileseries, dt_series = gridmet_paths(root, dt_start, dt_end)
+
+    # one read of every daily raster for all the points, a (days, points) array of the values raster_extract()
+    # gives for each point and day
+    names = points['id'].tolist()
+    xs = points['x']
+    ys = points['y']
+    if cube is None:
+        series = np.array([sample_points(gmet_file, xs, ys, like_extract=True) for gmet_file in gridmet_fileseries])
+    else:
+        # needs zarr (or netCDF4), only imported when a cube is used
+        from SEEBop_os.gridmet_cube import GridmetCube
+        gridmet_cube = GridmetCube(cube)
+        series = gridmet_cube.points(xs, ys).reindex(pd.DatetimeIndex(dt_series)).values
+        gridmet_cube.close()
+
+    for i, (k, elev) in enumerate(zip(names, points[elevation_field].tolist())):
+        elev = parse_elevation(elev, meters=elevation_meters)
+        x, y = xs[i], ys[i]
         name = k
         if type(name) == str:
             name = name.strip(' ')
         print('name', name)
-        vals = []
-        dates = []
-        for gmet_file, dtime in zip(gridmet_fileseries, dt_series):
-            pixel_value = raster_extract(gmet_file, x=x, y=y)
-            vals.append(pixel_value)
-            dates.append(dtime)
+        vals = series[:, i]
+        dates = dt_series
         output_location = os.path.join(output_root, '{}.csv'.format(name))
 
         with open(output_location, 'w') as wfile:
@@ -255,6 +315,79 @@ def gridmet_extract_point(root, shape_root, shape_name, start, end, output_root,
             for v, d in zip(vals, dates):
                 wfile.write('{},{},{},{},{}\n'.format(v, d, x, y, elev))
 
+def _sample_shard(paths, xs, ys):
+    # one read of every daily raster of a shard for all the points, a missing day is NaN
+    values = np.full((len(paths), len(xs)), np.nan, dtype=np.float32)
+    for i, path in enumerate(paths):
+        if os.path.exists(path):
+            values[i] = sample_points(path, xs, ys)
+        else:
+            print('missing {}'.format(path))
+    return values
+
+def gridmet_extract_parquet(root, shape_root, shape_name, start, end, output_root, field='id',
+                            elevation_field='Elevation', elevation_meters=True, workers=None, processes=False,
+                            dataset_name='gridmet_eto.parquet', stations_per_group=64):
+    """
+    Parallel gridmet_extract_point() that writes one Parquet dataset instead of a csv per point. The dates are
+    sharded by year over a pool, every daily raster is opened once and sampled at all the points, and each year is
+    written to <output_root>/<dataset_name>/year=<YYYY>/part-0.parquet with the typed columns station, date (date32),
+    value, x, y (float64) and elevation (float32, meters), sorted by station in the order of its Arrow type (numeric
+    or string, as the field of the shapefile) so the min/max statistics of the row groups don't overlap. Read it with
+    gridmet_eto_reader().
+    :param workers: size of the pool, None for the default of the executor
+    :param processes: if True shard over processes instead of threads (GDAL releases the GIL while reading)
+    :param stations_per_group: stations per Parquet row group, readers skip the row groups of other stations
+    :return: path of the dataset
+    """
+    # optional dependency, only needed for the Parquet output
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+
+    dt_start = datetime(start[0], start[1], start[2])
+    dt_end = datetime(end[0], end[1], end[2])
+    points = read_points(os.path.join(shape_root, shape_name), field=field, columns=[elevation_field])
+    names = [n.strip(' ') if type(n) == str else n for n in points['id'].tolist()]
+    elevations = np.array([parse_elevation(e, meters=elevation_meters) for e in points[elevation_field].tolist()],
+                          dtype=np.float32)
+    xs, ys = points['x'], points['y']
+    # station major rows, sorted on the typed station column (e.g. 9 before 10) as the row group statistics are
+    stations = pa.array(names)
+    order = pc.sort_indices(stations).to_numpy()
+
+    gridmet_fileseries, dt_series = gridmet_paths(root, dt_start, dt_end)
+    shards = {}
+    for path, dt in zip(gridmet_fileseries, dt_series):
+        shards.setdefault(dt.year, []).append((path, dt.date()))
+    print('{} days in {} yearly shards for {} points'.format(len(dt_series), len(shards), len(names)))
+
+    dataset = os.path.join(output_root, dataset_name)
+    executor_class = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with executor_class(max_workers=workers) as executor:
+        futures = {executor.submit(_sample_shard, [p for p, d in days], xs, ys): year for year, days in shards.items()}
+        for future in as_completed(futures):
+            year = futures[future]
+            dates = [d for p, d in shards[year]]
+            values = future.result()[:, order]
+            ndays = len(dates)
+            table = pa.table({'station': stations.take(pa.array(np.repeat(order, ndays))),
+                              'date': pa.array(dates * len(order), type=pa.date32()),
+                              'value': pa.array(values.T.ravel(), type=pa.float32()),
+                              'x': pa.array(np.repeat(xs[order], ndays), type=pa.float64()),
+                              'y': pa.array(np.repeat(ys[order], ndays), type=pa.float64()),
+                              'elevation': pa.array(np.repeat(elevations[order], ndays), type=pa.float32())})
+            folder = os.path.join(dataset, 'year={}'.format(year))
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            # written to a temporary file first, then renamed
+            part = os.path.join(folder, 'part-0.parquet')
+            pq.write_table(table, part + '.tmp', row_group_size=stations_per_group * ndays,
+                           write_statistics=['station', 'date'])
+            os.replace(part + '.tmp', part)
+            print('wrote {}'.format(part))
+    return dataset
+
 def convert_raster_to_array(input_raster_path, raster=None, band=1):
     """
     Convert .tif raster into a numpy numerical array.
@@ -278,16 +411,22 @@ def convert_raster_to_array(input_raster_path, raster=None, band=1):
         print
         'Not a valid file: {}'.format(p)
 
-    raster_open = gdal.Open(p)
-    ras = raster_open.GetRasterBand(band).ReadAsArray()
+    # the caller owns (and may write to) the array, so only the open dataset is borrowed from the pool
+    with process_pool().checkout(p) as raster_open:
+        ras = raster_open.GetRasterBand(band).ReadAsArray()
     return ras
 
-def gridmet_eto_reader(gridmet_eto_loc, smoothing=False):
+def gridmet_eto_reader(gridmet_eto_loc, smoothing=False, station=None, start=None, end=None):
     """
     This function is for reading gridmet files generated by this script
-    :param gridmet_eto_loc: string path to gridmet file
+    :param gridmet_eto_loc: string path to gridmet file, or to a Parquet dataset of gridmet_extract_parquet()
+    :param station: the station to read from a Parquet dataset
+    :param start: optional first date (datetime.date) to read from a Parquet dataset
+    :param end: optional last date to read from a Parquet dataset
     :return: dataframe
     """
+    if station is not None:
+        return gridmet_parquet_reader(gridmet_eto_loc, station, start, end, smoothing=smoothing)
 
     gridmet_dict = {'ETo':[], 'date':[], 'Lon':[], 'Lat':[], 'elevation_m':[]}
 
@@ -316,6 +455,32 @@ def gridmet_eto_reader(gridmet_eto_loc, smoothing=False):
     print(gm_df)
     return gm_df
 
+def gridmet_parquet_reader(dataset_path, station, start=None, end=None, smoothing=False):
+    """
+    Read the series of one station from a Parquet dataset of gridmet_extract_parquet(). Only the year partitions
+    between start and end and the row groups holding the station are read.
+    :return: dataframe with the columns of gridmet_eto_reader()
+    """
+    # optional dependency, only needed for the Parquet datasets
+    import pyarrow.parquet as pq
+
+    filters = [('station', '=', station)]
+    if start is not None:
+        filters += [('year', '>=', start.year), ('date', '>=', start)]
+    if end is not None:
+        filters += [('year', '<=', end.year), ('date', '<=', end)]
+    table = pq.read_table(dataset_path, columns=['value', 'date', 'x', 'y', 'elevation'], filters=filters)
+    gm_df = table.to_pandas().rename(columns={'value': 'ETo', 'x': 'Lon', 'y': 'Lat', 'elevation': 'elevation_m'})
+
+    gm_df['dt'] = pd.to_datetime(gm_df['date'])
+    gm_df.sort_values('dt', inplace=True)
+    gm_df.set_index('dt', inplace=True)
+
+    if smoothing:
+        print('smoothing is set to True, so calculating 10day running average of ETo timeseries for gridmet')
+        gm_df = gm_df.rolling('10D').mean()
+    return gm_df
+
 # def gridmet_extract_points(root, shape_root, shape_name, start, end, output_root, field='id'):
 #     """
 #         writes multiple csvs corresponding to multiple shapes in a shapefile.
@@ -0,0 +1,211 @@
+# ===============================================================================
+# Copyright 2019 Gabriel Parrish, Matt Schauer and Gabriel Senay
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import os
+import json
+import hashlib
+from datetime import datetime
+# ============= standard library imports ========================
+from SEEBop_os.ssebop_engine import ancillary_paths, parse_scene_name, product_name, scene_pathrow, MODEL_VERSION, \
+    PRODUCTS
+
+"""Run manifest for incremental SSEBop reprocessing. Every finished scene is recorded with a digest of its inputs
+(tarball, Tmax/dT/ETo rasters, k factor and model version) and its output paths, so a rerun only recomputes the
+scenes whose inputs or parameters changed.
+
+Within a scene, SceneCheckpoint records the stages that are done (extraction, the NDVI/LST pass, the ETf/ETa pass) in
+a small state file, so a batch that died mid-scene resumes every scene at its first unfinished stage."""
+
+MANIFEST_NAME = 'run_manifest.json'
+
+# folder of the SceneCheckpoint state files in the output folder
+CHECKPOINT_FOLDER = 'checkpoints'
+
+
+def file_fingerprint(path, content=False):
+    """
+    :param path: string path to a file
+    :param content: if True hash the bytes of the file, otherwise only its name, size and modification time. The
+     multi GB scene tarballs are fingerprinted, the small ancillary rasters are content hashed.
+    :return: hex digest string, or None if the file does not exist
+    """
+    if not os.path.exists(path):
+        return None
+    sha = hashlib.sha1()
+    if content:
+        with open(path, 'rb') as rfile:
+            for chunk in iter(lambda: rfile.read(1 << 20), b''):
+                sha.update(chunk)
+    else:
+        stat = os.stat(path)
+        sha.update('{}|{}|{}'.format(os.path.basename(path), stat.st_size, int(stat.st_mtime)).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def scene_inputs(tarball, aux_inputdir, k, scene_options=None):
+    """
+    :param scene_options: dict of the ssebop_scene() options that change the products (cog, scaled, compress,
+     qa_rules, outputs)
+    :return: dict describing everything the outputs of a scene depend on
+    """
+    scenedate, landsat_number = parse_scene_name(os.path.basename(tarball))
+    inputs = {'tarball': file_fingerprint(tarball), 'k': float(k), 'model_version': MODEL_VERSION}
+    for option in ('cog', 'scaled', 'compress', 'qa_rules', 'outputs'):
+        if scene_options and option in scene_options:
+            inputs[option] = scene_options[option]
+    if 'outputs' in inputs:
+        inputs['outputs'] = [cat for cat in PRODUCTS if cat in inputs['outputs']]
+    for name, path in ancillary_paths(aux_inputdir, scenedate).items():
+        inputs[name] = file_fingerprint(path, content=True)
+    return inputs
+
+
+def inputs_digest(inputs):
+    """
+    :return: hex digest of a scene_inputs() dict
+    """
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def product_paths(output, scenedate, pathrow=None, products=PRODUCTS):
+    """
+    :param products: the products written, see the outputs option of ssebop_scene()
+    :return: dict of product -> path of the outputs of a scene, e.g. Outputs/ETa/eta20040703_033037.tif
+    """
+    return {cat: os.path.join(output, cat, product_name(cat, scenedate, pathrow)) for cat in products}
+
+
+class RunManifest(object):
+    """
+    JSON manifest of the finished scenes of an output folder, keyed by scene id (tarball name without .tar.gz)
+    """
+
+    def __init__(self, output):
+        """
+        :param output: root of the output folders, the manifest is Outputs/run_manifest.json
+        """
+        self.output = output
+        self.path = os.path.join(output, MANIFEST_NAME)
+        self.scenes = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as rfile:
+                self.scenes = json.load(rfile)
+
+    def is_current(self, tarball, digest):
+        """
+        :return: True if the scene was already processed from the same inputs and all its outputs still exist
+        """
+        entry = self.scenes.get(os.path.basename(tarball)[:-7])
+        if entry is None or entry['digest'] != digest:
+            return False
+        return all(os.path.exists(p) for p in entry['outputs'].values())
+
+    def record(self, result, inputs, digest):
+        """
+        Record a successful run_scene() result
+        """
+        basename = os.path.basename(result['tarball'])
+        scene_id = basename[:-7]
+        self.scenes[scene_id] = {'scenedate': result['scenedate'],
+                                 'digest': digest,
+                                 'inputs': inputs,
+                                 'outputs': product_paths(self.output, result['scenedate'], scene_pathrow(basename),
+                                                          inputs.get('outputs', PRODUCTS)),
+                                 'cfactor': result['cfactor'],
+                                 'cfactor_pixels': result['cfactor_pixels'],
+                                 'finished': datetime.now().isoformat()}
+
+    def save(self):
+        """
+        Write the manifest atomically: to a temporary file first, then renamed over the old one
+        """
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as wfile:
+            json.dump(self.scenes, wfile, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def write_cfactor_log(self):
+        """
+        Rewrite Outputs/Cfactors.txt from the manifest so reruns never duplicate rows
+        """
+        logpath = os.path.join(self.output, 'Cfactors.txt')
+        with open(logpath, 'w') as logfile:
+            logfile.write("SceneDate" + " " + "Cfactor" + " " + "Pixels" + "\n")
+            for entry in sorted(self.scenes.values(), key=lambda e: e['scenedate']):
+                logfile.write(str(entry['scenedate']) + " " + str(entry['cfactor']) + " " +
+                              str(entry['cfactor_pixels']) + "\n")
+
+
+class SceneCheckpoint(object):
+    """
+    State file of the finished stages of one scene, Outputs/checkpoints/<scene id>.json. Every stage is committed
+    with the paths of what it wrote (already renamed into place) and any values a later stage needs, e.g. the
+    c-factor. The state of a scene whose inputs changed is ignored.
+    """
+
+    def __init__(self, output, scene_id, digest):
+        """
+        :param output: root of the output folders
+        :param scene_id: tarball name without .tar.gz
+        :param digest: inputs_digest() of the scene
+        """
+        self.path = os.path.join(output, CHECKPOINT_FOLDER, scene_id + '.json')
+        self.digest = digest
+        self.stages = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as rfile:
+                    state = json.load(rfile)
+            except (IOError, OSError, ValueError):
+                state = {}
+            if state.get('digest') == digest:
+                self.stages = state['stages']
+
+    def finished(self, stage):
+        """
+        :return: dict of the values the stage was committed with, or None if it was not committed or one of its
+         outputs has gone. A stage whose outputs have gone is dropped from the state file.
+        """
+        values = self.stages.get(stage)
+        if values is None:
+            return None
+        if not all(os.path.exists(p) for p in values.get('outputs', {}).values()):
+            del self.stages[stage]
+            self._save()
+            return None
+        return values
+
+    def commit(self, stage, **values):
+        """
+        Record a finished stage. The state file is written atomically: to a temporary file first, then renamed over
+        the old one.
+        """
+        self.stages[stage] = values
+        self._save()
+
+    def _save(self):
+        # the workers of a batch may create the folder at the same time
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as wfile:
+            json.dump({'digest': self.digest, 'stages': self.stages}, wfile, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        """
+        Drop the state file once the scene is recorded in the manifest
+        """
+        self.stages = {}
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,196 @@
+# ===============================================================================
+# Copyright 2019 Gabriel Parrish, Matt Schauer and Gabriel Senay
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import os
+import glob
+import sqlite3
+# ============= standard library imports ========================
+from SEEBop_os.ssebop_engine import SENSOR_BANDS
+from SEEBop_os.landsat_archive import read_archive_mtl
+
+"""SQLite catalog of Landsat scene tarballs built from their MTL metadata. An archive is scanned once and the batch
+runner then selects and orders scenes with a query instead of slicing file names and opening tarballs."""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scenes (
+    scene_id TEXT PRIMARY KEY,
+    tarball TEXT NOT NULL,
+    tarball_size INTEGER,
+    tarball_mtime REAL,
+    landsat TEXT,
+    spacecraft TEXT,
+    path INTEGER,
+    row INTEGER,
+    date TEXT,
+    scenedate TEXT,
+    sun_elevation REAL,
+    earth_sun_distance REAL,
+    cloud_cover REAL,
+    cloud_cover_land REAL,
+    red_gain REAL,
+    red_offset REAL,
+    nir_gain REAL,
+    nir_offset REAL,
+    thermal_gain REAL,
+    thermal_offset REAL
+);
+CREATE INDEX IF NOT EXISTS scenes_path_row_date ON scenes (path, row, date);
+CREATE INDEX IF NOT EXISTS scenes_date ON scenes (date);
+CREATE INDEX IF NOT EXISTS scenes_cloud_cover ON scenes (cloud_cover);
+"""
+
+COLUMNS = ('scene_id', 'tarball', 'tarball_size', 'tarball_mtime', 'landsat', 'spacecraft', 'path', 'row', 'date',
+           'scenedate', 'sun_elevation', 'earth_sun_distance', 'cloud_cover', 'cloud_cover_land', 'red_gain',
+           'red_offset', 'nir_gain', 'nir_offset', 'thermal_gain', 'thermal_offset')
+
+
+def _float(mtl, key):
+    value = mtl.get(key)
+    return None if value is None else float(value)
+
+
+def mtl_record(tarball, mtl):
+    """
+    Turn the parsed MTL of a scene into a catalog row
+    :param tarball: string path to the scene .tar.gz
+    :param mtl: dict from parse_mtl()
+    :return: dict of COLUMNS -> value
+    """
+    spacecraft = mtl.get('SPACECRAFT_ID')
+    landsat = spacecraft[-1] if spacecraft else os.path.basename(tarball)[3:4]
+    date = mtl.get('DATE_ACQUIRED')
+    stat = os.stat(tarball)
+    record = {'scene_id': mtl.get('LANDSAT_PRODUCT_ID') or os.path.basename(tarball)[:-7],
+              'tarball': os.path.abspath(tarball),
+              'tarball_size': stat.st_size,
+              'tarball_mtime': stat.st_mtime,
+              'landsat': landsat,
+              'spacecraft': spacecraft,
+              'path': int(mtl['WRS_PATH']) if 'WRS_PATH' in mtl else None,
+              'row': int(mtl['WRS_ROW']) if 'WRS_ROW' in mtl else None,
+              'date': date,
+              'scenedate': date.replace('-', '') if date else None,
+              'sun_elevation': _float(mtl, 'SUN_ELEVATION'),
+              'earth_sun_distance': _float(mtl, 'EARTH_SUN_DISTANCE'),
+              'cloud_cover': _float(mtl, 'CLOUD_COVER'),
+              'cloud_cover_land': _float(mtl, 'CLOUD_COVER_LAND')}
+    # DN to radiance gains and offsets of the bands SSEBop uses
+    bands = SENSOR_BANDS.get(landsat, {})
+    for name in ('red', 'nir', 'thermal'):
+        band = bands.get(name, '')[1:]
+        record[name + '_gain'] = _float(mtl, 'RADIANCE_MULT_BAND_' + band)
+        record[name + '_offset'] = _float(mtl, 'RADIANCE_ADD_BAND_' + band)
+    return record
+
+
+def connect(db_path):
+    """
+    :return: sqlite3 connection to the catalog, with the table created if needed
+    """
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def build_catalog(db_path, directories, pattern='*.tar.gz'):
+    """
+    Index every scene tarball in the directories. Tarballs already indexed with the same size and modification time
+    are skipped, moved tarballs have their path updated and rows whose tarball no longer exists are dropped.
+    :param db_path: string path to the SQLite file
+    :param directories: folder or list of folders holding scene tarballs (e.g. the input and Backup folders)
+    :return: number of tarballs that were (re)indexed
+    """
+    if isinstance(directories, str):
+        directories = [directories]
+    conn = connect(db_path)
+    known = {row['tarball']: (row['tarball_size'], row['tarball_mtime'])
+             for row in conn.execute('SELECT tarball, tarball_size, tarball_mtime FROM scenes')}
+
+    indexed = 0
+    insert = 'INSERT OR REPLACE INTO scenes ({}) VALUES ({})'.format(', '.join(COLUMNS),
+                                                                     ', '.join('?' * len(COLUMNS)))
+    for directory in directories:
+        for tarball in sorted(glob.glob(os.path.join(directory, pattern))):
+            tarball = os.path.abspath(tarball)
+            stat = os.stat(tarball)
+            if known.get(tarball) == (stat.st_size, stat.st_mtime):
+                continue
+            try:
+                record = mtl_record(tarball, read_archive_mtl(tarball))
+            except Exception as e:
+                print('could not index {}: {}'.format(tarball, e))
+                continue
+            conn.execute(insert, [record[c] for c in COLUMNS])
+            indexed += 1
+
+    stale = [(row['scene_id'],) for row in conn.execute('SELECT scene_id, tarball FROM scenes')
+             if not os.path.exists(row['tarball'])]
+    conn.executemany('DELETE FROM scenes WHERE scene_id = ?', stale)
+    conn.commit()
+    conn.close()
+    print('indexed {} tarballs, dropped {} missing ones'.format(indexed, len(stale)))
+    return indexed
+
+
+def query_scenes(db_path, path=None, row=None, start=None, end=None, max_cloud=None, landsat=None,
+                 order_by='date'):
+    """
+    Select scenes from the catalog, e.g. query_scenes(db, path=33, row=37, start='2015-01-01', end='2018-12-31',
+    max_cloud=30)
+    :param start: first acquisition date 'YYYY-MM-DD' (inclusive)
+    :param end: last acquisition date 'YYYY-MM-DD' (inclusive)
+    :param max_cloud: keep scenes with CLOUD_COVER below this percentage
+    :param landsat: '5', '7', '8' or a list of them
+    :param order_by: column of COLUMNS, or a comma separated string or list of them, each optionally followed by
+     ASC or DESC, e.g. 'path, row, date DESC'
+    :return: list of dict rows
+    """
+    clauses = []
+    params = []
+    for column, op, value in (('path', '=', path), ('row', '=', row), ('date', '>=', start), ('date', '<=', end),
+                              ('cloud_cover', '<', max_cloud)):
+        if value is not None:
+            clauses.append('{} {} ?'.format(column, op))
+            params.append(value)
+    if landsat is not None:
+        landsat = [landsat] if isinstance(landsat, str) else list(landsat)
+        clauses.append('landsat IN ({})'.format(', '.join('?' * len(landsat))))
+        params.extend(landsat)
+
+    sql = 'SELECT * FROM scenes'
+    if clauses:
+        sql += ' WHERE ' + ' AND '.join(clauses)
+    sql += ' ORDER BY ' + _order_clause(order_by)
+
+    conn = connect(db_path)
+    rows = [dict(r) for r in conn.execute(sql, params)]
+    conn.close()
+    return rows
+
+
+def _order_clause(order_by):
+    """
+    :return: ORDER BY terms of order_by, checked against COLUMNS since they can't be bound as SQL parameters
+    """
+    terms = order_by.split(',') if isinstance(order_by, str) else list(order_by)
+    clause = []
+    for term in terms:
+        words = term.split()
+        if not words or len(words) > 2 or words[0] not in COLUMNS or \
+                (len(words) == 2 and words[1].upper() not in ('ASC', 'DESC')):
+            raise ValueError('invalid order_by term {!r}, expected one of {} optionally followed by ASC or '
+                             'DESC'.format(term, ', '.join(COLUMNS)))
+        clause.append(' '.join(words[:1] + [w.upper() for w in words[1:]]))
+    return ', '.join(clause)
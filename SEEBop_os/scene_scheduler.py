@@ -0,0 +1,262 @@
+# ===============================================================================
+# Copyright 2019 Gabriel Parrish, Matt Schauer and Gabriel Senay
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import os
+import shutil
+import tarfile
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from multiprocessing import Manager
+# ============= standard library imports ========================
+from SEEBop_os.ssebop_engine import process_scene, parse_scene_name, TILE_SIZE
+from SEEBop_os.landsat_archive import process_archive
+from SEEBop_os.run_manifest import scene_inputs, inputs_digest, SceneCheckpoint
+from SEEBop_os.pipeline_profile import SceneProfile, NULL_PROFILE, write_profiles, summary_table
+from SEEBop_os.ancillary_cache import SharedAncillaryStore, shared_root
+
+"""Fans Landsat scenes out to a pool of worker processes. Scenes are read straight from their tarballs (or unpacked
+into their own scratch folder) and the c-factors are collected back in the parent process, which is the only one
+writing the Cfactors.txt log. The warped Tmax, dT and ETo inputs are shared between the workers through a
+SharedAncillaryStore the parent creates and removes.
+
+A batch can be killed at any point and rerun. The workers commit every finished stage of a scene to its
+SceneCheckpoint, and only once the parent has recorded a scene (manifest and Cfactors.txt) is its tarball moved to
+Backup and its checkpoint and scratch folder removed. Until then the tarball stays where the next run looks for it
+and the scene resumes at its first unfinished stage.
+
+A worker process that dies outright (e.g. a crash inside GDAL) breaks the whole pool and every scene still in it.
+The scenes that had not started are submitted again to a new pool, and the scenes that were running are rerun each
+in a pool of its own, so only the scene that crashes is recorded as failed."""
+
+
+def run_scene(tarball, scratch, backup, aux_inputdir, output, k=1, tile_size=TILE_SIZE, extract=False,
+              scene_options=None, profile=True):
+    """
+    Process a single scene tarball. Runs in a worker process.
+    Errors are caught and returned so one bad scene does not take down the batch.
+    :param tarball: string path to the Landsat .tar.gz
+    :param scratch: root scratch folder, the scene is extracted into scratch/<scene id> when extracting
+    :param backup: not used, the parent moves the tarball once the scene is recorded, see commit_scene()
+    :param extract: if True unpack the tarball into the scene scratch folder instead of reading the bands straight
+     out of the archive through /vsitar/
+    :param scene_options: dict of further ssebop_engine.ssebop_scene() options, e.g. {'cog': True, 'scaled': True}
+    :param profile: if True time the stages of the scene, see pipeline_profile
+    :return: dict with 'tarball', 'scenedate', 'cfactor', 'cfactor_pixels', 'error', 'elapsed' and 'profile' keys
+    """
+    SceneStartTime = datetime.now()
+    basename = os.path.basename(tarball)
+    scenedate, landsat_number = parse_scene_name(basename)
+    result = {'tarball': tarball, 'scenedate': scenedate, 'cfactor': None, 'cfactor_pixels': None, 'error': None,
+              'elapsed': None, 'profile': None}
+    scene_profile = SceneProfile(basename) if profile else NULL_PROFILE
+
+    try:
+        checkpoint = SceneCheckpoint(output, basename[:-7],
+                                     inputs_digest(scene_inputs(tarball, aux_inputdir, k, scene_options)))
+        scene_options = dict(scene_options or {}, profile=scene_profile, checkpoint=checkpoint)
+        if extract:
+            # kept until the scene is recorded, a resumed scene is not extracted again
+            scenefolder = os.path.join(scratch, basename[:-7])
+            if checkpoint.finished('extract') is None:
+                print('Unzipping bands of {}'.format(basename))
+                shutil.rmtree(scenefolder, ignore_errors=True)
+                # Unzip/Extract .tar.gz file ----> Extracts all Bands, Metadata
+                with scene_profile.stage('extract'), tarfile.open(tarball) as tar:
+                    tar.extractall(path=scenefolder)
+                checkpoint.commit('extract', outputs={'scenefolder': scenefolder})
+            scenedate, cfactor, pixels = process_scene(scenefolder, basename, aux_inputdir, output, k=k,
+                                                       tile_size=tile_size, **scene_options)
+        else:
+            scenedate, cfactor, pixels = process_archive(tarball, aux_inputdir, output, k=k, tile_size=tile_size,
+                                                         **scene_options)
+        result['cfactor'] = cfactor
+        result['cfactor_pixels'] = pixels
+    except Exception:
+        result['error'] = traceback.format_exc()
+
+    result['elapsed'] = str(datetime.now() - SceneStartTime)
+    if profile:
+        result['profile'] = scene_profile.record()
+    return result
+
+
+def commit_scene(result, scratch, backup, output, manifest=None, inputs=None, digest=None):
+    """
+    Record a successful run_scene() result in the parent process: in the manifest (saved right away) or else
+    Cfactors.txt, then move the tarball to the backup folder and drop the checkpoint and scratch folder of the scene
+    :param inputs: scene_inputs() of the scene, with digest its inputs_digest(), when there is a manifest
+    """
+    tarball = result['tarball']
+    scene_id = os.path.basename(tarball)[:-7]
+    if manifest is None:
+        write_cfactor_log(output, [result])
+    else:
+        manifest.record(result, inputs, digest)
+        manifest.save()
+
+    # Move the .tar.gz file to the backup directory only once the scene has been recorded
+    if os.path.abspath(os.path.dirname(tarball)) != os.path.abspath(backup):
+        shutil.move(tarball, backup)
+    SceneCheckpoint(output, scene_id, digest).clear()
+    shutil.rmtree(os.path.join(scratch, scene_id), ignore_errors=True)
+
+
+def write_cfactor_log(output, results):
+    """
+    Append the c-factors of the successful scenes to Outputs/Cfactors.txt
+    :param output: root of the output folders
+    :param results: list of run_scene() result dicts
+    """
+    logpath = os.path.join(output, 'Cfactors.txt')
+    write_header = not os.path.exists(logpath)
+    with open(logpath, 'a') as logfile:
+        if write_header:
+            logfile.write("SceneDate" + " " + "Cfactor" + " " + "Pixels" + "\n")
+        for result in sorted(results, key=lambda r: r['scenedate']):
+            if result['error'] is None:
+                logfile.write(str(result['scenedate']) + " " + str(result['cfactor']) + " " +
+                              str(result['cfactor_pixels']) + "\n")
+
+
+def schedule_scenes(tarfiles, scratch, backup, aux_inputdir, output, k=1, tile_size=TILE_SIZE, workers=None,
+                    extract=False, manifest=None, scene_options=None, profile=True, shared_ancillary=True):
+    """
+    Process a batch of scene tarballs on a pool of worker processes.
+    :param tarfiles: list of paths to Landsat .tar.gz files
+    :param workers: number of worker processes. None uses every core, 1 runs the scenes serially in this process.
+    :param manifest: RunManifest. If given, scenes whose inputs are unchanged since they were last processed are
+     skipped and Cfactors.txt is rewritten from the manifest instead of appended to.
+    :param scene_options: dict of further ssebop_engine.ssebop_scene() options passed to every scene
+    :param profile: if True write the per stage timings of every scene to Outputs/pipeline_profile.jsonl and print
+     a summary table at the end of the batch
+    :param shared_ancillary: if True (and workers is not 1) the workers map one shared copy of the warped Tmax, dT
+     and ETo inputs instead of each holding its own
+    :return: list of run_scene() result dicts in the order the scenes finished
+    """
+    digests = {}
+    if manifest is not None:
+        todo = []
+        for tarball in tarfiles:
+            inputs = scene_inputs(tarball, aux_inputdir, k, scene_options)
+            digest = inputs_digest(inputs)
+            if manifest.is_current(tarball, digest):
+                print('{} is up to date'.format(os.path.basename(tarball)))
+                continue
+            digests[tarball] = (inputs, digest)
+            todo.append(tarball)
+        print('{} of {} scenes need processing'.format(len(todo), len(tarfiles)))
+        tarfiles = todo
+
+    results = []
+    store = None
+    if workers != 1 and shared_ancillary and 'cache' not in (scene_options or {}):
+        store = SharedAncillaryStore(shared_root())
+        scene_options = dict(scene_options or {}, cache=store)
+        print('sharing the ancillary inputs between the workers through {}'.format(store.root))
+
+    def finish(result):
+        results.append(_report(result))
+        if result['error'] is None:
+            commit_scene(result, scratch, backup, output, manifest, *digests.get(result['tarball'], (None, None)))
+
+    try:
+        if workers == 1:
+            for tarball in tarfiles:
+                finish(run_scene(tarball, scratch, backup, aux_inputdir, output, k, tile_size, extract, scene_options,
+                                 profile))
+        else:
+            args = (scratch, backup, aux_inputdir, output, k, tile_size, extract, scene_options, profile)
+            with Manager() as manager:
+                # scenes a worker has started, kept by the manager process so it outlives a crashed worker
+                started = manager.dict()
+                pending = list(tarfiles)
+                while pending:
+                    broken = _run_pool(pending, workers, started, args, finish)
+                    pending = [tarball for tarball, error in broken if tarball not in started]
+                    running = [(tarball, error) for tarball, error in broken if tarball in started]
+                    if len(running) == 1:
+                        finish(failed_result(*running[0]))
+                        running = []
+                    if running:
+                        print('a worker died, rerunning the {} scenes it may have been running one by one'.format(
+                            len(running)))
+                    for tarball, error in running:
+                        for alone, alone_error in _run_pool([tarball], 1, started, args, finish):
+                            finish(failed_result(alone, alone_error))
+    finally:
+        # the parent owns the shared inputs, workers only map them
+        if store is not None:
+            store.close()
+
+    if manifest is not None:
+        manifest.write_cfactor_log()
+
+    records = [r['profile'] for r in results if r['profile'] is not None]
+    if records:
+        write_profiles(output, records)
+        print(summary_table(records))
+
+    failed = [r for r in results if r['error'] is not None]
+    print('{} of {} scenes processed, {} failed'.format(len(results) - len(failed), len(results), len(failed)))
+    for r in failed:
+        print('FAILED {}'.format(r['tarball']))
+    return results
+
+
+def _run_started(started, tarball, *args):
+    # runs in the worker, the scene is marked as started before anything can crash
+    started[tarball] = os.getpid()
+    return run_scene(tarball, *args)
+
+
+def _run_pool(tarfiles, workers, started, args, finish):
+    """
+    Run scenes on a new process pool, finish() is called with the result of every scene that completes
+    :param started: managed dict the workers mark the scenes they start in
+    :param args: further run_scene() arguments
+    :return: list of (tarball, error) of the scenes lost when a worker process died and broke the pool
+    """
+    broken = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(_run_started, started, tarball, *args): tarball for tarball in tarfiles}
+        for future in as_completed(futures):
+            tarball = futures[future]
+            try:
+                result = future.result()
+            except BrokenProcessPool:
+                broken.append((tarball, traceback.format_exc()))
+                continue
+            except Exception:
+                result = failed_result(tarball, traceback.format_exc())
+            finish(result)
+    return broken
+
+
+def failed_result(tarball, error):
+    """
+    :return: run_scene() result dict of a scene that failed outside run_scene(), e.g. its worker process died
+    """
+    return {'tarball': tarball, 'scenedate': parse_scene_name(os.path.basename(tarball))[0], 'cfactor': None,
+            'cfactor_pixels': None, 'error': error, 'elapsed': None, 'profile': None}
+
+
+def _report(result):
+    if result['error'] is None:
+        print('scene {} done in {}, cfactor: {} from {} pixels'.format(result['scenedate'], result['elapsed'],
+                                                                      result['cfactor'], result['cfactor_pixels']))
+    else:
+        print('scene {} failed\n{}'.format(result['scenedate'], result['error']))
+    return result
@@ -0,0 +1,1098 @@
+# ===============================================================================
+# Copyright 2019 Gabriel Parrish, Matt Schauer and Gabriel Senay
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import os
+import math
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import numpy as np
+from osgeo import gdal
+# ============= standard library imports ========================
+from SEEBop_os.ancillary_cache import process_cache, subgrid_window
+from SEEBop_os.cog_writer import ProductWriter, FLOAT_NODATA, VSIMEM
+from SEEBop_os.pipeline_profile import NULL_PROFILE
+from SEEBop_os.qa_mask import QA_BANDS, clear_lut, clear_mask, mtl_collection
+from SEEBop_os.warp_plan import PLAN_FOLDER, apply_plan, process_plans
+
+"""NumPy/GDAL implementation of the SSEBop steps that used to be ArcPy map algebra in Landsat_SSEBop_ETa_OS.py.
+Every band is read and every product is written one block (GDAL window) at a time. The exceptions are the Tmax, dT
+and ETo inputs, which are whole-grid float32 arrays on the padded scene grid (about 300 MB each for a full scene).
+Memory use of a process is therefore about the blocks of its worker threads, plus the three inputs of the scene
+being run, plus the entries kept by the ancillary cache for later scenes (by default up to the inputs of two scenes,
+about 1.8 GB, see ancillary_cache.DEFAULT_MAX_BYTES). With a cache of max_bytes=0 the inputs are read block by block
+too and memory is bounded by the tile size alone, at the price of warping the inputs again for every scene."""
+
+# default edge length in pixels of the square blocks the scene is processed in
+TILE_SIZE = 1024
+
+# nodata value written to all float output rasters (the ArcGIS 32 bit float nodata)
+NODATA = FLOAT_NODATA
+
+# band file suffixes for the red, near infrared, thermal and quality assessment bands of each sensor
+SENSOR_BANDS = {'5': {'red': 'B3', 'nir': 'B4', 'thermal': 'B6', 'qa': 'BQA'},
+                '7': {'red': 'B3', 'nir': 'B4', 'thermal': 'B6_VCID_1', 'qa': 'BQA'},
+                '8': {'red': 'B4', 'nir': 'B5', 'thermal': 'B10', 'qa': 'BQA'}}
+
+# the BQA value of a clear pixel with low cloud, shadow, snow (and cirrus) confidence. The cloud mask used to keep
+# only these values, it now decodes the QA bits with qa_mask.py.
+CLEAR_QA = {'5': 672, '7': 672, '8': 2720}
+
+# LST radiance to temperature constants (K1, K2)
+THERMAL_CONSTANTS = {'5': (607.76, 1260.56), '7': (666.09, 1282.71), '8': (774.89, 1321.08)}
+
+# Band 3 and band 4 spectral irradiance for Landsat 5 and 7
+ESUN = {'5': (1533., 1039.), '7': (1533., 1039.)}
+
+# Bands 3, 4, 6 radiance constants (Landsat 5). Landsat 7 reads them from the MTL file.
+L5_RADIANCE = {'Lmin3': -1.17, 'Lmax3': 264., 'Lmin4': -1.51, 'Lmax4': 221., 'Lmin6': 1.238, 'Lmax6': 15.303}
+QCALMIN = 1.
+QCALDIFF = 254.
+
+# default c-factor used when the c-factor algorithm finds no qualifying pixels
+DEFAULT_CFACTOR = 0.985
+
+# output products in the order they are written, with their output folder names
+PRODUCTS = ('NDVI', 'LST', 'ETf', 'ETa')
+
+# version of the model outputs. Bump it whenever a change alters the products so incremental runs redo every scene.
+MODEL_VERSION = '2.1'
+
+
+def parse_scene_name(basename):
+    """
+    Get the scene date and Landsat number from a Collection 1 tarball name
+    :param basename: string name of the tarball e.g. LE07_L1TP_033037_20040703_20160914_01_T1.tar.gz
+    :return: tuple of (YYYYMMDD string, landsat number string)
+    """
+    scenedate = str(basename[-30:-22])  # returns YYYYMMDD ie 20040703
+    landsat_number = str(basename[3:4])
+    return scenedate, landsat_number
+
+
+def scene_pathrow(basename):
+    """
+    :param basename: string name of the tarball e.g. LE07_L1TP_033037_20040703_20160914_01_T1.tar.gz
+    :return: WRS-2 path/row string, e.g. '033037'
+    """
+    return str(basename[10:16])
+
+
+def parse_mtl(lines):
+    """
+    Parse the KEY = VALUE pairs out of a Landsat _MTL.txt metadata file
+    :param lines: iterable of lines from the metadata file
+    :return: dict of key -> string value, quotes stripped
+    """
+    mtl = {}
+    for line in lines:
+        if '=' not in line:
+            continue
+        key, value = line.split('=', 1)
+        mtl[key.strip()] = value.strip().strip('"')
+    return mtl
+
+
+def read_mtl(metadata_path):
+    """
+    :param metadata_path: string path to the _MTL.txt file
+    :return: dict of key -> string value
+    """
+    with open(metadata_path, 'r') as metafile:
+        return parse_mtl(metafile)
+
+
+def scene_coefficients(mtl, landsat_number):
+    """
+    Collect the constants needed for TOA reflectance, thermal radiance and LST of a scene.
+    :param mtl: dict from parse_mtl()
+    :param landsat_number: '5', '7' or '8'
+    :return: dict of coefficients
+    """
+    if landsat_number not in SENSOR_BANDS:
+        raise ValueError('Landsat {} is not supported'.format(landsat_number))
+
+    sunelev = float(mtl['SUN_ELEVATION'])
+    coeffs = {'landsat': landsat_number,
+              # cosine of the solar zenith angle. (the ArcPy version took the cosine of degrees as radians)
+              'zenith': math.cos(math.radians(90 - sunelev)),
+              'd2': float(mtl['EARTH_SUN_DISTANCE']) ** 2,
+              # layout of the quality band
+              'collection': mtl_collection(mtl)}
+    coeffs['K1'], coeffs['K2'] = THERMAL_CONSTANTS[landsat_number]
+
+    if landsat_number == '5':
+        radiance = dict(L5_RADIANCE)
+    elif landsat_number == '7':
+        radiance = {'Lmin3': float(mtl['RADIANCE_MINIMUM_BAND_3']),
+                    'Lmax3': float(mtl['RADIANCE_MAXIMUM_BAND_3']),
+                    'Lmin4': float(mtl['RADIANCE_MINIMUM_BAND_4']),
+                    'Lmax4': float(mtl['RADIANCE_MAXIMUM_BAND_4']),
+                    'Lmin6': float(mtl['RADIANCE_MINIMUM_BAND_6_VCID_1']),
+                    'Lmax6': float(mtl['RADIANCE_MAXIMUM_BAND_6_VCID_1'])}
+    else:
+        coeffs['ML10'] = float(mtl['RADIANCE_MULT_BAND_10'])
+        coeffs['AL10'] = float(mtl['RADIANCE_ADD_BAND_10'])
+        return coeffs
+
+    coeffs.update(radiance)
+    for b in ('3', '4', '6'):
+        coeffs['Ldiff' + b] = radiance['Lmax' + b] - radiance['Lmin' + b]
+    coeffs['esun3'], coeffs['esun4'] = ESUN[landsat_number]
+    return coeffs
+
+
+def dekad_of(scenedate):
+    """
+    :param scenedate: YYYYMMDD string
+    :return: dekadal code MMD used to name the tmax and dT rasters, e.g. '071' for the 1st-10th of July
+    """
+    month = scenedate[4:6]
+    day = int(scenedate[6:8])
+    if day <= 10:
+        dekad = '1'
+    elif day <= 20:
+        dekad = '2'
+    else:
+        dekad = '3'
+    return month + dekad
+
+
+def ancillary_periods(scenedate):
+    """
+    :param scenedate: YYYYMMDD string
+    :return: dict of 'tmax', 'dt' -> dekadal code and 'eto' -> day of year of the scene
+    """
+    dekadal = dekad_of(scenedate)
+    jdate = datetime.strptime(scenedate, '%Y%m%d').strftime('%j')
+    return {'tmax': dekadal, 'dt': dekadal, 'eto': jdate}
+
+
+def ancillary_paths(aux_inputdir, scenedate):
+    """
+    Find the appropriate input rasters for tmax, dt, and eto of a scene date
+    :param aux_inputdir: string path to the Inputs folder
+    :param scenedate: YYYYMMDD string
+    :return: dict of 'tmax', 'dt', 'eto' -> string path
+    """
+    periods = ancillary_periods(scenedate)
+    return {'tmax': os.path.join(aux_inputdir, 'tmax_dekadal', 'tmax{}.tif'.format(periods['tmax'])),
+            'dt': os.path.join(aux_inputdir, 'dT_dekadal', 'dt{}.tif'.format(periods['dt'])),
+            'eto': os.path.join(aux_inputdir, 'ETo_daily', 'eto{}.tif'.format(periods['eto']))}
+
+
+def block_windows(xsize, ysize, tile_size=TILE_SIZE):
+    """
+    Generate the (xoff, yoff, xcount, ycount) windows that cover a raster in row major order
+    :param xsize: raster columns
+    :param ysize: raster rows
+    :param tile_size: int edge length of the window, or a (cols, rows) tuple
+    """
+    if isinstance(tile_size, int):
+        tile_cols = tile_rows = tile_size
+    else:
+        tile_cols, tile_rows = tile_size
+    for yoff in range(0, ysize, tile_rows):
+        ycount = min(tile_rows, ysize - yoff)
+        for xoff in range(0, xsize, tile_cols):
+            yield xoff, yoff, min(tile_cols, xsize - xoff), ycount
+
+
+def run_tiles(compute, write, windows, kernels, threads=1):
+    """
+    Compute blocks on a thread pool and write them in window order from the calling thread. GDAL reads and the NumPy
+    ufuncs of the kernel release the GIL, so the blocks of one scene use several cores. Each block borrows a kernel
+    (its scratch buffers) from the pool and gives it back once it is written, so at most len(kernels) blocks are in
+    flight and nothing is allocated per block.
+    :param compute: callable(kernel, window) -> result, run on the pool. It must only use thread safe objects or
+     objects of its own thread (gdal datasets are not thread safe).
+    :param write: callable(window, kernel, result), run in the calling thread in window order
+    :param windows: iterable of (xoff, yoff, xcount, ycount)
+    :param kernels: list of SSEBopKernel, at least one more than threads so writing overlaps computing
+    :param threads: number of threads, 1 runs every block in the calling thread
+    """
+    if threads <= 1:
+        kernel = kernels[0]
+        for window in windows:
+            write(window, kernel, compute(kernel, window))
+        return
+
+    free = queue.Queue()
+    for kernel in kernels:
+        free.put(kernel)
+
+    def task(window):
+        kernel = free.get()
+        return kernel, compute(kernel, window)
+
+    def finish(pending):
+        window, future = pending.popleft()
+        kernel, result = future.result()
+        write(window, kernel, result)
+        free.put(kernel)
+
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        try:
+            for window in windows:
+                pending.append((window, pool.submit(task, window)))
+                if len(pending) >= len(kernels):
+                    finish(pending)
+            while pending:
+                finish(pending)
+        except BaseException:
+            for _, future in pending:
+                future.cancel()
+            # unblock the blocks still waiting for a kernel so the pool can shut down, their results are dropped
+            for kernel in kernels:
+                free.put(kernel)
+            raise
+
+
+# ============= per block model functions ========================
+
+def cloud_mask(qa, collection='C1', rules=None):
+    """
+    Classify the BQA - Landsat Quality Assessment Band into a boolean clear-sky mask
+    :param qa: BQA (Collection 1) or QA_PIXEL (Collection 2) block
+    :param collection: 'C1' or 'C2'
+    :param rules: QA bit rules, see qa_mask.build_lut()
+    :return: boolean array, True where the pixel is clear
+    """
+    return clear_mask(qa, collection, rules)
+
+
+def toa_ndvi(red, nir, coeffs):
+    """
+    Convert the raw red and nir bands to top-of-atmosphere reflectance and then calculate NDVI
+    :param red: red band DN block
+    :param nir: near infrared band DN block
+    :param coeffs: dict from scene_coefficients()
+    :return: float32 NDVI block
+    """
+    red = red.astype(np.float32)
+    nir = nir.astype(np.float32)
+    if coeffs['landsat'] == '8':
+        # TOA reflectance w/o correction for solar angle, then TOA planetary reflectance
+        red_reflect = (red * 0.00002 - 0.1) / coeffs['zenith']
+        nir_reflect = (nir * 0.00002 - 0.1) / coeffs['zenith']
+    else:
+        # DN to radiance, then radiance to reflectance
+        red_radiance = (coeffs['Ldiff3'] / QCALDIFF) * (red - QCALMIN) + coeffs['Lmin3']
+        red_reflect = (3.14159 * red_radiance * coeffs['d2']) / (coeffs['esun3'] * coeffs['zenith'])
+        nir_radiance = (coeffs['Ldiff4'] / QCALDIFF) * (nir - QCALMIN) + coeffs['Lmin4']
+        nir_reflect = (3.14159 * nir_radiance * coeffs['d2']) / (coeffs['esun4'] * coeffs['zenith'])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ndvi = (nir_reflect - red_reflect) / (nir_reflect + red_reflect)
+    return ndvi.astype(np.float32)
+
+
+def thermal_radiance(thermal, coeffs):
+    """
+    Calculate the radiance from the thermal band digital numbers (DN)
+    :param thermal: thermal band DN block (band 6 for L5/L7, band 10 for L8)
+    :param coeffs: dict from scene_coefficients()
+    :return: float32 radiance block
+    """
+    thermal = thermal.astype(np.float32)
+    if coeffs['landsat'] == '8':
+        return thermal * coeffs['ML10'] + coeffs['AL10']
+    return (coeffs['Ldiff6'] / QCALDIFF) * (thermal - QCALMIN) + coeffs['Lmin6']
+
+
+def emissivity(ndvi):
+    """
+    NDVI-derived emissivity. Emissivity correction algorithm based on NDVI, not LAI
+    :param ndvi: NDVI block
+    :return: float32 emissivity block, NaN where NDVI is NaN
+    """
+    # Assuming typical Soil Emissivity of 0.97 and Veg Emissivity of 0.99 and shape Factor mean value of 0.553
+    pv = ((ndvi - 0.2) / 0.3) ** 2
+    de = (1 - 0.97) * (1 - pv) * 0.55 * 0.99
+    range_emiss = (0.99 * pv) + (0.97 * (1 - pv)) + de
+
+    emiss = np.full(ndvi.shape, np.nan, dtype=np.float32)
+    emiss[ndvi < 0] = 0.985
+    emiss[(ndvi >= 0) & (ndvi < 0.2)] = 0.977
+    emiss[ndvi > 0.5] = 0.99
+    in_range = (ndvi >= 0.2) & (ndvi <= 0.5)
+    emiss[in_range] = range_emiss[in_range]
+    return emiss
+
+
+def surface_temp(radiance, ndvi, coeffs):
+    """
+    Create NDVI-corrected Emissivity and Land surface temperature
+    :param radiance: thermal radiance block from thermal_radiance()
+    :param ndvi: NDVI block
+    :param coeffs: dict from scene_coefficients()
+    :return: float32 LST block in degrees Kelvin
+    """
+    tnb = 0.866  # narrow band transmissivity of air
+    rp = 0.91  # path radiance
+    rsky = 1.32  # narrow band downward thermal radiation from a clear sky
+
+    emiss = emissivity(ndvi)
+    rc = ((radiance - rp) / tnb) - (rsky * (1 - emiss))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lst = coeffs['K2'] / np.log(((coeffs['K1'] * emiss) / rc) + 1)
+    return lst.astype(np.float32)
+
+
+def tcorr_candidates(ndvi, lst, tmax, clear):
+    """
+    Select the tcorr = LST / Tmax values of the well watered, clear pixels used by the c-factor
+    :return: 1D float64 array of qualifying tcorr values
+    """
+    with np.errstate(invalid='ignore'):
+        tdiff = tmax - lst
+        qualify = clear & (lst > 270) & (tdiff > -5) & (tdiff < 10) & (ndvi > 0.7) & (ndvi < 1.0)
+    return (lst[qualify] / tmax[qualify]).astype(np.float64)
+
+
+class CfactorStats(object):
+    """
+    Streaming, mergeable mean and variance of the qualifying tcorr values (Chan et al. parallel update of Welford's
+    algorithm). Feed it one block at a time with update(), combine partial results from other tiles with merge().
+    """
+
+    def __init__(self, count=0, mean=0., m2=0.):
+        self.count = count
+        self.mean = mean
+        # sum of squared differences from the mean
+        self.m2 = m2
+
+    def update(self, values):
+        """
+        Add a block of tcorr values
+        :param values: 1D array
+        """
+        n = values.size
+        if n == 0:
+            return self
+        block_mean = float(values.mean())
+        block_m2 = float(np.square(values - block_mean).sum())
+        return self.merge(CfactorStats(n, block_mean, block_m2))
+
+    def merge(self, other):
+        """
+        Fold the statistics of another set of pixels into this one
+        """
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count, self.mean, self.m2 = other.count, other.mean, other.m2
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        return self
+
+    @property
+    def std(self):
+        """population standard deviation, as the ArcPy Raster.standardDeviation"""
+        if self.count == 0:
+            return float('nan')
+        return math.sqrt(self.m2 / self.count)
+
+    def cfactor(self):
+        """
+        c-factor = mean(tcorr) - 2 * standard deviation(tcorr)
+        :return: float c-factor, or DEFAULT_CFACTOR when there are no qualifying pixels
+        """
+        if self.count > 0 and self.mean > 0.0:
+            return float(self.mean - (self.std * 2))
+        print('cfactor algorithm failed. using the default cfactor of {}'.format(DEFAULT_CFACTOR))
+        return DEFAULT_CFACTOR
+
+    def __repr__(self):
+        return 'CfactorStats(count={}, mean={}, std={})'.format(self.count, self.mean, self.std)
+
+
+def ssebop_etf(lst, tmax, dt, cfactor):
+    """
+    Calculate the SSEBop ET fraction
+    :return: float32 ETf block. NaN where ETf is >= 1.3 or any input is missing.
+    """
+    # restrict the range of dT to 6 - 25 degrees Kelvin
+    dtcon = np.clip(dt, 6, 25)
+    tcold = tmax * cfactor
+    thot = tcold + dtcon
+    etf = ((thot - lst) / dtcon).astype(np.float32)
+    with np.errstate(invalid='ignore'):
+        etf[etf < 0] = 0
+        etf[(etf > 1.05) & (etf < 1.3)] = 1.05
+        etf[etf >= 1.3] = np.nan
+    return etf
+
+
+def ssebop_eta(etf, eto, k):
+    """
+    Calculate the daily actual ET - requires the ETf and a k factor
+    :return: float32 ETa block
+    """
+    eta = (etf * (eto * float(k))).astype(np.float32)
+    with np.errstate(invalid='ignore'):
+        eta[eta < 0] = 0
+    return eta
+
+
+# ============= fused kernel ========================
+
+class SSEBopKernel(object):
+    """
+    Fused, allocation free version of the per block model functions above. The whole NDVI -> emissivity -> LST chain
+    and the ETf -> ETa chain are each computed with in-place ufuncs into scratch buffers that are allocated once per
+    scene and reused for every block. The per block functions above stay as the readable reference of the model.
+
+    Arrays returned by the kernel are views of its buffers and are overwritten by the next call.
+    """
+
+    # NDVI derived emissivity in the 0.2 - 0.5 NDVI range is linear in Pv:
+    # 0.99 * Pv + 0.97 * (1 - Pv) + (1 - 0.97) * (1 - Pv) * 0.55 * 0.99
+    EMISS_C0 = 0.97 + 0.03 * 0.55 * 0.99
+    EMISS_C1 = 0.99 - 0.97 - 0.03 * 0.55 * 0.99
+
+    # narrow band transmissivity of air, path radiance and narrow band downward thermal radiation from a clear sky
+    TNB = 0.866
+    RP = 0.91
+    RSKY = 1.32
+
+    FLOAT_BUFFERS = ('red', 'nir', 'thermal', 'tmax', 'dt', 'eto', 'ndvi', 'lst', 'etf', 'eta', 'work')
+    MASK_BUFFERS = ('mask', 'mask2')
+
+    def __init__(self, coeffs, tile_size=TILE_SIZE, debug=False, profile=None, qa_rules=None):
+        """
+        :param coeffs: dict from scene_coefficients()
+        :param tile_size: int edge length of the largest block, or a (cols, rows) tuple
+        :param debug: if True copies of the intermediate rasters are kept in self.intermediates after each call
+        :param profile: SceneProfile the cloud_mask, ndvi, lst, cfactor, etf and eta stages are timed in
+        :param qa_rules: QA bit rules of the cloud mask, default qa_mask.DEFAULT_RULES of the scene's collection
+        """
+        if isinstance(tile_size, int):
+            size = tile_size * tile_size
+        else:
+            size = tile_size[0] * tile_size[1]
+        self._flat = {name: np.empty(size, dtype=np.float32) for name in self.FLOAT_BUFFERS}
+        self._flat.update({name: np.empty(size, dtype=np.bool_) for name in self.MASK_BUFFERS})
+        self._flat['qa'] = np.empty(size, dtype=np.uint16)
+
+        # cloudy QA values, so the mask of a block is a single gather
+        self.cloudy_lut = ~clear_lut(coeffs.get('collection', 'C1'), qa_rules)
+        self.k1 = coeffs['K1']
+        self.k2 = coeffs['K2']
+        # DN -> TOA reflectance and DN -> thermal radiance folded into a single gain and offset per band
+        if coeffs['landsat'] == '8':
+            self.red_gain = self.nir_gain = 0.00002 / coeffs['zenith']
+            self.red_offset = self.nir_offset = -0.1 / coeffs['zenith']
+            self.thermal_gain = coeffs['ML10']
+            self.thermal_offset = coeffs['AL10']
+        else:
+            for band, esun in (('red', coeffs['esun3']), ('nir', coeffs['esun4'])):
+                b = '3' if band == 'red' else '4'
+                to_reflect = 3.14159 * coeffs['d2'] / (esun * coeffs['zenith'])
+                gain = coeffs['Ldiff' + b] / QCALDIFF
+                setattr(self, band + '_gain', gain * to_reflect)
+                setattr(self, band + '_offset', (coeffs['Lmin' + b] - gain * QCALMIN) * to_reflect)
+            self.thermal_gain = coeffs['Ldiff6'] / QCALDIFF
+            self.thermal_offset = coeffs['Lmin6'] - self.thermal_gain * QCALMIN
+
+        self.debug = debug
+        self.intermediates = {}
+        self.profile = profile or NULL_PROFILE
+
+    def buffer(self, name, shape):
+        """
+        :return: a contiguous (rows, cols) view of a scratch buffer, e.g. to read a band into with buf_obj=
+        """
+        return self._flat[name][:shape[0] * shape[1]].reshape(shape)
+
+    def _keep(self, name, arr):
+        if self.debug:
+            self.intermediates[name] = arr.copy()
+
+    def ndvi_lst(self, red, nir, thermal, qa):
+        """
+        Cloud masked TOA NDVI and LST of a block. red, nir and thermal are float32 blocks (ideally this kernel's
+        'red', 'nir' and 'thermal' buffers) and are overwritten.
+        :return: tuple of (ndvi, lst) views, NaN where cloudy
+        """
+        self.intermediates.clear()
+        shape = red.shape
+        ndvi = self.buffer('ndvi', shape)
+        lst = self.buffer('lst', shape)
+        work = self.buffer('work', shape)
+        cloudy = self.buffer('mask', shape)
+        interval = self.buffer('mask2', shape)
+
+        stage = self.profile.stage
+        with np.errstate(divide='ignore', invalid='ignore'), stage('ndvi'):
+            # TOA reflectance
+            red *= self.red_gain
+            red += self.red_offset
+            nir *= self.nir_gain
+            nir += self.nir_offset
+            self._keep('red_reflect', red)
+            self._keep('nir_reflect', nir)
+
+            np.subtract(nir, red, out=ndvi)
+            np.add(nir, red, out=nir)
+            np.divide(ndvi, nir, out=ndvi)
+
+        with np.errstate(divide='ignore', invalid='ignore'), stage('lst'):
+            # emissivity in the 0.2 - 0.5 range, then the constant values outside it. NaN NDVI stays NaN.
+            emiss = red
+            np.subtract(ndvi, 0.2, out=emiss)
+            emiss *= 1 / 0.3
+            np.square(emiss, out=emiss)
+            emiss *= self.EMISS_C1
+            emiss += self.EMISS_C0
+            np.less(ndvi, 0.2, out=interval)
+            np.copyto(emiss, 0.977, where=interval)
+            np.less(ndvi, 0, out=interval)
+            np.copyto(emiss, 0.985, where=interval)
+            np.greater(ndvi, 0.5, out=interval)
+            np.copyto(emiss, 0.99, where=interval)
+            self._keep('emissivity', emiss)
+
+            # thermal radiance, then corrected thermal radiance rc
+            rc = thermal
+            rc *= self.thermal_gain
+            rc += self.thermal_offset
+            self._keep('thermal_radiance', rc)
+            rc -= self.RP
+            rc *= 1 / self.TNB
+            rc -= self.RSKY
+            np.multiply(emiss, self.RSKY, out=work)
+            rc += work
+            self._keep('rc', rc)
+
+            # land surface temperature in degrees Kelvin
+            np.multiply(emiss, self.k1, out=work)
+            work /= rc
+            np.log1p(work, out=work)
+            np.divide(self.k2, work, out=lst)
+
+        with stage('cloud_mask'):
+            np.take(self.cloudy_lut, qa, out=cloudy, mode='clip')
+            np.copyto(ndvi, np.nan, where=cloudy)
+            np.copyto(lst, np.nan, where=cloudy)
+        return ndvi, lst
+
+    def tcorr(self, ndvi, lst, tmax):
+        """
+        tcorr = LST / Tmax of the well watered pixels used by the c-factor. Cloudy (NaN) pixels never qualify.
+        :return: 1D float64 array of qualifying tcorr values
+        """
+        shape = lst.shape
+        tdiff = self.buffer('work', shape)
+        qualify = self.buffer('mask', shape)
+        test = self.buffer('mask2', shape)
+        with np.errstate(invalid='ignore'), self.profile.stage('cfactor'):
+            np.subtract(tmax, lst, out=tdiff)
+            np.greater(tdiff, -5, out=qualify)
+            np.less(tdiff, 10, out=test)
+            qualify &= test
+            np.greater(lst, 270, out=test)
+            qualify &= test
+            np.greater(ndvi, 0.7, out=test)
+            qualify &= test
+            np.less(ndvi, 1.0, out=test)
+            qualify &= test
+            return lst[qualify].astype(np.float64) / tmax[qualify]
+
+    def etf_eta(self, lst, tmax, dt, eto, cfactor, k):
+        """
+        SSEBop ET fraction and actual ET of a block. dt is overwritten.
+        :return: tuple of (etf, eta) views
+        """
+        self.intermediates.clear()
+        shape = lst.shape
+        etf = self.buffer('etf', shape)
+        eta = self.buffer('eta', shape)
+        over = self.buffer('mask', shape)
+        stage = self.profile.stage
+        with np.errstate(invalid='ignore'), stage('etf'):
+            # restrict the range of dT to 6 - 25 degrees Kelvin
+            np.clip(dt, 6, 25, out=dt)
+            # ETf = (Thot - LST) / dT with Thot = Tmax * c + dT
+            np.multiply(tmax, cfactor, out=etf)
+            etf += dt
+            etf -= lst
+            etf /= dt
+            self._keep('etf_raw', etf)
+            # 1.3 and above is nodata, 1.05 - 1.3 is capped at 1.05, below 0 is 0
+            np.greater_equal(etf, 1.3, out=over)
+            np.copyto(etf, np.nan, where=over)
+            np.minimum(etf, 1.05, out=etf)
+            np.maximum(etf, 0, out=etf)
+
+        with stage('eta'):
+            np.multiply(eto, float(k), out=eta)
+            eta *= etf
+            np.maximum(eta, 0, out=eta)
+        return etf, eta
+
+
+# ============= raster IO ========================
+
+def read_block(band, window, out=None):
+    """
+    :param band: gdal band
+    :param window: (xoff, yoff, xcount, ycount)
+    :param out: optional float32 array of shape (ycount, xcount) to read into instead of allocating
+    :return: float32 array of the window with the band nodata set to NaN
+    """
+    xoff, yoff, xcount, ycount = window
+    if out is None:
+        out = np.empty((ycount, xcount), dtype=np.float32)
+    band.ReadAsArray(xoff, yoff, xcount, ycount, buf_obj=out)
+    nodata = band.GetNoDataValue()
+    if nodata is not None:
+        np.copyto(out, np.nan, where=out == nodata)
+    return out
+
+
+def scene_grid(ds):
+    """
+    :param ds: gdal dataset
+    :return: (projection, geotransform, xsize, ysize) tuple describing the grid of the dataset
+    """
+    return ds.GetProjection(), tuple(ds.GetGeoTransform()), ds.RasterXSize, ds.RasterYSize
+
+
+def align_to_grid(raster_path, grid, resample_alg='near', vrt_path=''):
+    """
+    Warp an ancillary raster (tmax, dT, ETo) onto a scene grid. This replaces the arcpy MINOF extent/cellSize
+    environment. The result is a virtual (VRT) dataset so blocks are only resampled as they are read.
+    :param raster_path: string path to the ancillary raster
+    :param grid: (projection, geotransform, xsize, ysize) from scene_grid()
+    :param vrt_path: optional .vrt file to save the warp to, so other readers can open it. Default in memory.
+    :return: gdal dataset on the grid
+    """
+    src = gdal.Open(raster_path)
+    if src is None:
+        raise IOError("Can't open the datasource from {}".format(raster_path))
+    projection, gt, xsize, ysize = grid
+    xmin = gt[0]
+    ymax = gt[3]
+    xmax = xmin + gt[1] * xsize
+    ymin = ymax + gt[5] * ysize
+    src_nodata = src.GetRasterBand(1).GetNoDataValue()
+    return gdal.Warp(vrt_path, src, format='VRT', dstSRS=projection, outputBounds=(xmin, ymin, xmax, ymax),
+                     width=xsize, height=ysize, resampleAlg=resample_alg, srcNodata=src_nodata, dstNodata=NODATA,
+                     outputType=gdal.GDT_Float32)
+
+
+def open_product(path, grid):
+    """
+    Open a product raster on a target grid, e.g. a scene ETf on a basin mosaic grid. A product on the same lattice
+    as the grid is only windowed (a VRT, no resampling), anything else is warped. Scaled int16 products are decoded
+    by read_product_block() with their scale/offset metadata.
+    :return: tuple of (gdal dataset on grid, scale, offset)
+    """
+    src = gdal.Open(path)
+    if src is None:
+        raise IOError("Can't open the datasource from {}".format(path))
+    band = src.GetRasterBand(1)
+    scale = band.GetScale() or 1.
+    offset = band.GetOffset() or 0.
+    src_grid = scene_grid(src)
+    if src_grid == tuple(grid):
+        return src, scale, offset
+    window = subgrid_window(src_grid, grid, contained=False)
+    if window is not None:
+        return gdal.Translate('', src, format='VRT', srcWin=window), scale, offset
+    return align_to_grid(path, grid), scale, offset
+
+
+def read_product_block(product, window, out):
+    """
+    :param product: tuple from open_product()
+    :return: float32 block with nodata as NaN
+    """
+    ds, scale, offset = product
+    read_block(ds.GetRasterBand(1), window, out=out)
+    if scale != 1. or offset != 0.:
+        out *= scale
+        out += offset
+    return out
+
+
+def load_ancillary(aux_inputdir, scenedate, grid, cache=None, plans=None):
+    """
+    Get the Tmax, dT and ETo inputs of a scene on the scene grid.
+    :param grid: (projection, geotransform, xsize, ysize) of the scene
+    :param cache: AncillaryCache or SharedAncillaryStore. None uses the process wide cache. With a cache whose
+     max_bytes is 0 the inputs are returned as virtual warped datasets that are read block by block instead.
+    :param plans: warp_plan.WarpPlanCache the inputs are resampled with. None uses the plans saved in
+     Inputs/warp_plans.
+    :return: dict of 'tmax', 'dt', 'eto' -> float32 array or gdal dataset, for read_aux_block()
+    """
+    if cache is None:
+        cache = process_cache()
+    if plans is None:
+        plans = process_plans(os.path.join(aux_inputdir, PLAN_FOLDER))
+    periods = ancillary_periods(scenedate)
+    aux = {}
+    for name, path in ancillary_paths(aux_inputdir, scenedate).items():
+        if cache.max_bytes == 0:
+            aux[name] = align_to_grid(path, grid)
+        else:
+            aux[name] = cache.get(name, periods[name], grid, lambda g, path=path: read_planned(path, g, plans),
+                                  source=path)
+    return aux
+
+
+def read_aligned(raster_path, grid):
+    """
+    :return: the whole ancillary raster warped onto grid as a float32 array with nodata as NaN
+    """
+    ds = align_to_grid(raster_path, grid)
+    return read_block(ds.GetRasterBand(1), (0, 0, grid[2], grid[3]))
+
+
+def read_planned(raster_path, grid, plans):
+    """
+    Same result as read_aligned() through a nearest neighbour warp plan: the plan of a (source grid, scene grid) pair
+    is made once and every later input on the same grids is a gather.
+    :param plans: warp_plan.WarpPlanCache
+    :return: the whole ancillary raster on grid as a float32 array with nodata as NaN
+    """
+    src = gdal.Open(raster_path)
+    if src is None:
+        raise IOError("Can't open the datasource from {}".format(raster_path))
+    plan = plans.get(scene_grid(src), grid)
+    return apply_plan(plan, read_block(src.GetRasterBand(1), (0, 0, src.RasterXSize, src.RasterYSize)))
+
+
+def read_aux_block(src, window, out):
+    """
+    Copy a window of an ancillary input from load_ancillary() into out
+    """
+    if isinstance(src, np.ndarray):
+        xoff, yoff, xcount, ycount = window
+        np.copyto(out, src[yoff:yoff + ycount, xoff:xoff + xcount])
+        return out
+    return read_block(src.GetRasterBand(1), window, out=out)
+
+
+def create_output(path, ref_ds):
+    """
+    Create a plain 32 bit float GeoTIFF on the grid of ref_ds for block-by-block writing. Used for the debug
+    intermediates, the products go through cog_writer.ProductWriter.
+    :return: gdal dataset open for writing
+    """
+    driver = gdal.GetDriverByName('GTiff')
+    out_ds = driver.Create(path, ref_ds.RasterXSize, ref_ds.RasterYSize, 1, gdal.GDT_Float32,
+                           options=['TILED=YES', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256', 'BIGTIFF=IF_SAFER'])
+    if out_ds is None:
+        raise IOError("Can't create {}".format(path))
+    out_ds.SetGeoTransform(ref_ds.GetGeoTransform())
+    out_ds.SetProjection(ref_ds.GetProjection())
+    out_ds.GetRasterBand(1).SetNoDataValue(NODATA)
+    return out_ds
+
+
+def write_block(band, arr, window):
+    """
+    Write a float32 block to a band. NaN in arr are replaced with the output nodata value in place.
+    """
+    np.copyto(arr, NODATA, where=np.isnan(arr))
+    band.WriteArray(arr, window[0], window[1])
+
+
+def product_name(cat, scenedate, pathrow=None):
+    """
+    :return: file name of a product, e.g. etf20040703.tif, or etf20040703_033037.tif for the product of a single
+     path/row so scenes of the same day do not overwrite each other
+    """
+    if pathrow:
+        return '{}{}_{}.tif'.format(cat.lower(), scenedate, pathrow)
+    return cat.lower() + scenedate + '.tif'
+
+
+def output_path(output, cat, scenedate, pathrow=None):
+    """
+    :return: path of a product, e.g. Outputs/ETf/etf20040703_033037.tif. The category folder is created if needed.
+    """
+    outfolder = os.path.join(output, cat)
+    if not os.path.exists(outfolder):
+        os.makedirs(outfolder)
+    return os.path.join(outfolder, product_name(cat, scenedate, pathrow))
+
+
+def match_scene_files(names, landsat_number):
+    """
+    Find the red, nir, thermal, quality (BQA or QA_PIXEL) and MTL files of a scene among a list of file names.
+    Collection 1 bands end in upper case .TIF so the match ignores case.
+    :param names: list of file (or archive member) names
+    :return: dict of 'red', 'nir', 'thermal', 'qa', 'mtl' -> matching name
+    """
+    suffixes = {k: ['_{}.tif'.format(v).lower()] for k, v in SENSOR_BANDS[landsat_number].items() if k != 'qa'}
+    suffixes['qa'] = ['_{}.tif'.format(QA_BANDS[c]).lower() for c in sorted(QA_BANDS)]
+    suffixes['mtl'] = ['_mtl.txt']
+    matches = {}
+    for key, options in suffixes.items():
+        for name in names:
+            if any(name.lower().endswith(suffix) for suffix in options):
+                matches[key] = name
+                break
+        else:
+            raise IOError('no file ending in {} for the scene'.format(' or '.join(options)))
+    return matches
+
+
+def band_paths(scenefolder, landsat_number):
+    """
+    :param scenefolder: folder the scene tarball was unpacked in
+    :return: dict of 'red', 'nir', 'thermal', 'qa', 'mtl' -> string path
+    """
+    return {k: os.path.join(scenefolder, v) for k, v in
+            match_scene_files(os.listdir(scenefolder), landsat_number).items()}
+
+
+def open_bands(paths):
+    """
+    :param paths: dict of 'red', 'nir', 'thermal', 'qa' -> any path gdal can open
+    :return: dict of 'red', 'nir', 'thermal', 'qa' -> gdal band, and of '<name>_ds' -> its dataset
+    """
+    bands = {}
+    for name in ('red', 'nir', 'thermal', 'qa'):
+        ds = gdal.Open(paths[name])
+        if ds is None:
+            raise IOError("Can't open the datasource from {}".format(paths[name]))
+        bands[name] = ds.GetRasterBand(1)
+        bands[name + '_ds'] = ds
+    return bands
+
+
+def process_scene(scenefolder, basename, aux_inputdir, output, k=1, tile_size=TILE_SIZE, **kwargs):
+    """
+    Run SSEBop on one unpacked Landsat scene and write the NDVI, LST, ETf and ETa products.
+    :param scenefolder: folder containing the unpacked bands and metadata
+    :param basename: name of the scene tarball
+    :param kwargs: further options of ssebop_scene() (debug, cache, cog, scaled, compress, profile)
+    :return: tuple of (scenedate, cfactor, number of pixels the c-factor was computed from)
+    """
+    scenedate, landsat_number = parse_scene_name(basename)
+    with (kwargs.get('profile') or NULL_PROFILE).stage('metadata'):
+        paths = band_paths(scenefolder, landsat_number)
+        mtl = read_mtl(paths['mtl'])
+    return ssebop_scene(paths, mtl, scenedate, landsat_number, aux_inputdir, output, k=k,
+                        tile_size=tile_size, pathrow=scene_pathrow(basename), **kwargs)
+
+
+def ssebop_scene(paths, mtl, scenedate, landsat_number, aux_inputdir, output, k=1, tile_size=TILE_SIZE,
+                 debug=False, cache=None, cog=True, scaled=False, compress='DEFLATE', profile=None, pathrow=None,
+                 qa_rules=None, threads=1, outputs=PRODUCTS, in_memory=False, checkpoint=None):
+    """
+    Run SSEBop on one Landsat scene and write the NDVI, LST, ETf and ETa products.
+
+    The scene is read in two passes over the blocks. The first pass writes the cloud masked NDVI and LST and gathers
+    the c-factor statistics in a single streaming pass, the second reads the LST back with Tmax, dT and ETo to write
+    ETf and ETa. Both passes run through an SSEBopKernel so no per block arrays are allocated. With threads > 1 the
+    blocks of each pass are computed on a thread pool (see run_tiles()) and written in order, the c-factor is the
+    same as with a single thread.
+
+    :param paths: dict of 'red', 'nir', 'thermal', 'qa' -> any path gdal can open (plain or /vsitar/)
+    :param mtl: dict of the scene metadata from parse_mtl()
+    :param scenedate: YYYYMMDD string
+    :param landsat_number: '5', '7' or '8'
+    :param aux_inputdir: folder with the tmax_dekadal, dT_dekadal and ETo_daily inputs
+    :param output: root of the output folders
+    :param k: k factor applied to ETo
+    :param tile_size: block edge length in pixels, or a (cols, rows) tuple e.g. full width strips
+    :param debug: if True also write the kernel intermediates (reflectance, emissivity, radiance, raw ETf) to
+     Outputs/debug
+    :param cache: AncillaryCache for the Tmax, dT and ETo inputs, see load_ancillary()
+    :param cog: write the products as Cloud Optimized GeoTIFFs with internal overviews
+    :param scaled: store the products as int16 with scale/offset metadata instead of float32
+    :param compress: GeoTIFF compression of the products
+    :param profile: pipeline_profile.SceneProfile the stages of the scene are timed in
+    :param pathrow: WRS-2 path/row added to the product names, see product_name()
+    :param qa_rules: QA bit rules of the cloud mask, see qa_mask.build_lut()
+    :param threads: number of threads the blocks of the scene are computed on, e.g. the number of cores to reprocess
+     a single scene. Keep it at 1 when the scenes already run in parallel processes.
+    :param outputs: the products written to disk. An LST that is not requested is still made for the ETf pass, in an
+     in-memory (/vsimem/) dataset that is dropped at the end. Products that are not requested otherwise aren't made.
+    :param in_memory: keep the working files of the COG or scaled outputs in /vsimem/ instead of next to the outputs,
+     which saves a write and a read of every product at the cost of an uncompressed copy of them in memory
+    :param checkpoint: run_manifest.SceneCheckpoint. The NDVI/LST pass is committed to it with the float32 working
+     file of the LST (when LST is among the outputs and the working files are on disk), the ETf/ETa pass once all
+     the products are renamed into place. A rerun of the scene starts after the last committed pass with the
+     c-factor it recorded.
+    :return: tuple of (scenedate, cfactor, number of pixels the c-factor was computed from)
+    """
+    unknown = set(outputs) - set(PRODUCTS)
+    if unknown:
+        raise ValueError('unknown products {}, the products are {}'.format(sorted(unknown), PRODUCTS))
+    profile = profile or NULL_PROFILE
+    coeffs = scene_coefficients(mtl, landsat_number)
+    threads = max(1, int(threads or 1))
+    # one kernel per block in flight, see run_tiles()
+    kernels = [SSEBopKernel(coeffs, tile_size, debug=debug, profile=profile, qa_rules=qa_rules)
+               for _ in range(1 if threads == 1 else threads + 2)]
+
+    print('Landsat {} Image'.format(landsat_number))
+    print('Calendar Date: {}'.format(scenedate))
+
+    done = checkpoint.finished('etf_eta') if checkpoint is not None else None
+    if done is not None:
+        print('{} was already processed, cfactor: {}'.format(scenedate, done['cfactor']))
+        return scenedate, done['cfactor'], done['count']
+    # the first pass can only be skipped when its LST working file was kept on disk
+    keep_lst = checkpoint is not None and 'LST' in outputs and not in_memory
+    first_pass = checkpoint.finished('ndvi_lst') if keep_lst else None
+
+    ref_ds = open_bands(paths)['qa_ds']
+    grid = scene_grid(ref_ds)
+
+    with profile.stage('ancillary'):
+        aux = load_ancillary(aux_inputdir, scenedate, grid, cache)
+
+    work_dir = VSIMEM if in_memory else None
+    # a resumed scene reopens the LST working file of the first pass, its NDVI is already final
+    resumed = {}
+    if first_pass is not None:
+        try:
+            resumed['LST'] = ProductWriter(output_path(output, 'LST', scenedate, pathrow), grid, 'LST', cog=cog,
+                                           scaled=scaled, compress=compress, work_dir=work_dir, resume=True)
+        except IOError as e:
+            # the working file went away since the checkpoint was read, the NDVI and LST pass is done again
+            print('{}, redoing the NDVI and LST pass'.format(e))
+            first_pass = None
+    products = {cat: resumed[cat] if cat in resumed else
+                ProductWriter(output_path(output, cat, scenedate, pathrow), grid, cat, cog=cog, scaled=scaled,
+                              compress=compress, work_dir=work_dir)
+                for cat in PRODUCTS if cat in outputs and not (first_pass is not None and cat == 'NDVI')}
+    if 'LST' not in outputs:
+        # the ETf pass still needs it
+        products['LST'] = ProductWriter('{}/lst{}_{}_{}.tif'.format(VSIMEM, scenedate, pathrow, id(products)), grid,
+                                        'LST', cog=False, scaled=False, work_dir=VSIMEM)
+    debug_outputs = {}
+    debug_dir = os.path.join(output, 'debug')
+    local = threading.local()
+
+    def thread_inputs():
+        # gdal datasets can't be shared between threads, every thread opens its own bands (and virtual ancillary
+        # inputs when they are not cached arrays)
+        if not hasattr(local, 'bands'):
+            local.bands = open_bands(paths)
+            shared = threads == 1 or all(isinstance(a, np.ndarray) for a in aux.values())
+            local.aux = aux if shared else load_ancillary(aux_inputdir, scenedate, grid, cache)
+        return local.bands, local.aux
+
+    def write_intermediates(kernel, window):
+        for name, arr in kernel.intermediates.items():
+            if name not in debug_outputs:
+                debug_outputs[name] = create_output(output_path(debug_dir, name, scenedate, pathrow), ref_ds)
+            write_block(debug_outputs[name].GetRasterBand(1), arr, window)
+
+    def ndvi_lst(kernel, window):
+        bands, inputs = thread_inputs()
+        xoff, yoff, xcount, ycount = window
+        shape = (ycount, xcount)
+        with profile.stage('read'):
+            qa = bands['qa'].ReadAsArray(xoff, yoff, xcount, ycount, buf_obj=kernel.buffer('qa', shape))
+            red = bands['red'].ReadAsArray(xoff, yoff, xcount, ycount, buf_obj=kernel.buffer('red', shape))
+            nir = bands['nir'].ReadAsArray(xoff, yoff, xcount, ycount, buf_obj=kernel.buffer('nir', shape))
+            thermal = bands['thermal'].ReadAsArray(xoff, yoff, xcount, ycount,
+                                                   buf_obj=kernel.buffer('thermal', shape))
+
+        ndvi, lst = kernel.ndvi_lst(red, nir, thermal, qa)
+
+        with profile.stage('read'):
+            tmax = read_aux_block(inputs['tmax'], window, kernel.buffer('tmax', shape))
+        return ndvi, lst, kernel.tcorr(ndvi, lst, tmax)
+
+    def write_ndvi_lst(window, kernel, result):
+        ndvi, lst, tcorr = result
+        # in window order, so the c-factor does not depend on the number of threads
+        with profile.stage('cfactor'):
+            stats.update(tcorr)
+        with profile.stage('write'):
+            if 'NDVI' in products:
+                products['NDVI'].write(ndvi, window)
+            products['LST'].write(lst, window)
+            write_intermediates(kernel, window)
+
+    def etf_eta(kernel, window):
+        bands, inputs = thread_inputs()
+        if not hasattr(local, 'lst'):
+            # the float32 LST written by the first pass, through a dataset of this thread
+            local.lst = gdal.Open(products['LST'].work_path)
+        shape = (window[3], window[2])
+        with profile.stage('read'):
+            lst = read_block(local.lst.GetRasterBand(1), window, out=kernel.buffer('lst', shape))
+            tmax = read_aux_block(inputs['tmax'], window, kernel.buffer('tmax', shape))
+            dt = read_aux_block(inputs['dt'], window, kernel.buffer('dt', shape))
+            eto = read_aux_block(inputs['eto'], window, kernel.buffer('eto', shape))
+        return kernel.etf_eta(lst, tmax, dt, eto, cfactor, k)
+
+    def write_etf_eta(window, kernel, result):
+        etf, eta = result
+        with profile.stage('write'):
+            for cat, arr in (('ETf', etf), ('ETa', eta)):
+                if cat in products:
+                    products[cat].write(arr, window)
+            write_intermediates(kernel, window)
+
+    if first_pass is None:
+        print('Creating cloud masked NDVI and land surface temperature')
+        stats = CfactorStats()
+        run_tiles(ndvi_lst, write_ndvi_lst, block_windows(grid[2], grid[3], tile_size), kernels, threads)
+        cfactor, count = stats.cfactor(), stats.count
+        print('cfactor: {} from {} pixels'.format(cfactor, count))
+        with profile.stage('write'):
+            products['LST'].flush()
+            if keep_lst and 'NDVI' in products:
+                finished = {'NDVI': products.pop('NDVI').close()}
+            else:
+                finished = {}
+        if keep_lst:
+            # the LST is finished only after the ETf pass, which reads its full precision working file
+            finished['LST'] = products['LST'].work_path
+            checkpoint.commit('ndvi_lst', outputs=finished, cfactor=cfactor, count=count)
+    else:
+        cfactor, count = first_pass['cfactor'], first_pass['count']
+        print('resuming {} after the NDVI and LST pass, cfactor: {}'.format(scenedate, cfactor))
+
+    if 'ETf' in outputs or 'ETa' in outputs:
+        print('calculating SSEBop ET Fraction and actual ET with k-factor of {}'.format(k))
+        local = threading.local()
+        run_tiles(etf_eta, write_etf_eta, block_windows(grid[2], grid[3], tile_size), kernels, threads)
+        local = None
+
+    print('writing the products')
+    with profile.stage('write'):
+        for cat, writer in products.items():
+            if cat in outputs:
+                writer.close()
+            else:
+                writer.discard()
+        # housekeeping - closing the datasets flushes them to disk
+        for ds in debug_outputs.values():
+            ds.FlushCache()
+    products = debug_outputs = aux = ref_ds = None
+    if checkpoint is not None:
+        checkpoint.commit('etf_eta', outputs={cat: output_path(output, cat, scenedate, pathrow) for cat in outputs},
+                          cfactor=cfactor, count=count)
+
+    return scenedate, cfactor, count
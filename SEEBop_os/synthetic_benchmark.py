@@ -0,0 +1,448 @@
+# ===============================================================================
+# Copyright 2019 Gabriel Parrish, Matt Schauer and Gabriel Senay
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import os
+import json
+import shutil
+import tarfile
+import tempfile
+from datetime import datetime, timedelta
+import numpy as np
+from osgeo import gdal, osr
+# ============= standard library imports ========================
+from SEEBop_os.ssebop_engine import SENSOR_BANDS, CLEAR_QA, L5_RADIANCE, QCALMIN, QCALDIFF, SSEBopKernel, \
+    TILE_SIZE, ancillary_paths, emissivity, parse_mtl, scene_coefficients
+from SEEBop_os.scene_scheduler import schedule_scenes
+from SEEBop_os.pipeline_profile import stage_totals, ordered_stages, summary_table
+
+"""Offline throughput benchmark of the SSEBop pipeline on synthetic scenes.
+
+make_scene() writes a Collection 1 style tarball (red, nir, thermal, BQA GeoTIFFs and an _MTL.txt) whose digital
+numbers are the inverse of the model: smooth NDVI and LST fields with noise, water, cloud banks and the slanted
+nodata fill of a real WRS-2 scene. make_ancillary() writes the matching dekadal Tmax/dT and daily ETo rasters on a
+coarse geographic grid, so the warp onto the scene grid is exercised as well. run() processes a batch through the
+scheduler and reports scenes/hour, MB/s and the per stage timings, and optionally compares them with a saved
+baseline to catch performance regressions."""
+
+# UTM zone 13N, the scenes are centred on its central meridian
+SCENE_EPSG = 32613
+SCENE_CENTER = (500000., 3762000.)  # about 105 W, 34 N
+SCENE_CENTER_LONLAT = (-105., 34.)
+PIXEL_SIZE = 30.
+
+# pixel size in degrees of the synthetic Tmax, dT and ETo inputs (about 4 km, like gridMET)
+ANCILLARY_PIXEL = 0.04
+
+# Collection 1 BQA values of a high confidence cloud
+CLOUD_QA = {'5': 752, '7': 752, '8': 2800}
+
+# band 3, 4 and 6 radiance ranges written to the MTL of the synthetic Landsat 7 scenes
+L7_RADIANCE = {'3': (-5.0, 234.4), '4': (-5.1, 241.1), '6_VCID_1': (0., 17.04)}
+
+# band 10 radiance rescaling of the synthetic Landsat 8 scenes
+L8_THERMAL = (3.342e-4, 0.1)
+
+SENSOR_PREFIX = {'5': 'LT05', '7': 'LE07', '8': 'LC08'}
+
+# rows generated and written at a time
+STRIP_ROWS = 512
+
+
+def scene_name(landsat_number, date, path=33, row=37):
+    """
+    :param date: datetime of the acquisition
+    :return: Collection 1 product id, e.g. LC08_L1TP_033037_20150703_20170226_01_T1
+    """
+    return '{}_L1TP_{:03d}{:03d}_{}_{}_01_T1'.format(SENSOR_PREFIX[landsat_number], path, row,
+                                                     date.strftime('%Y%m%d'), '20190101')
+
+
+def scene_geotransform(xsize, ysize):
+    return (SCENE_CENTER[0] - xsize * PIXEL_SIZE / 2, PIXEL_SIZE, 0.,
+            SCENE_CENTER[1] + ysize * PIXEL_SIZE / 2, 0., -PIXEL_SIZE)
+
+
+def srs_wkt(epsg):
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(epsg)
+    return srs.ExportToWkt()
+
+
+def smooth_field(x, y, phases, wavelengths):
+    """
+    Sum of products of sines, a cheap stand-in for a spatially correlated field. Values are in about -1 - 1.
+    :param x: column coordinates (broadcastable with y)
+    :param y: row coordinates
+    """
+    field = 0.
+    for (px, py), (lx, ly) in zip(phases, wavelengths):
+        field = field + np.sin(2 * np.pi * x / lx + px) * np.sin(2 * np.pi * y / ly + py)
+    return field / len(phases)
+
+
+class SyntheticScene(object):
+    """
+    Surface of one synthetic scene: NDVI, LST and clouds as functions of the pixel coordinates, so any strip of the
+    scene can be generated on its own.
+    """
+
+    def __init__(self, xsize, ysize, cloud_cover=0.15, seed=0):
+        """
+        :param cloud_cover: fraction of the valid pixels under cloud
+        """
+        self.xsize = xsize
+        self.ysize = ysize
+        self.cloud_cover = cloud_cover
+        self.random = np.random.RandomState(seed)
+        # fields: ~3 - 20 km land cover patches, 5 - 30 km cloud banks
+        self.ndvi_waves = [(self.random.uniform(0, 2 * np.pi, 2), self.random.uniform(100, 700, 2)) for _ in range(3)]
+        self.cloud_waves = [(self.random.uniform(0, 2 * np.pi, 2), self.random.uniform(150, 1000, 2))
+                            for _ in range(2)]
+        self.cloud_threshold = self._cloud_threshold()
+
+    def _cloud(self, x, y):
+        return smooth_field(x, y, *zip(*self.cloud_waves))
+
+    def _cloud_threshold(self):
+        if self.cloud_cover <= 0:
+            return np.inf
+        x, y = np.meshgrid(np.linspace(0, self.xsize, 300), np.linspace(0, self.ysize, 300))
+        return np.percentile(self._cloud(x, y), 100 * (1 - self.cloud_cover))
+
+    def strip(self, yoff, rows):
+        """
+        :return: dict of 'ndvi', 'lst' (K), 'cloud' and 'fill' arrays of rows x xsize pixels starting at row yoff
+        """
+        x = np.arange(self.xsize, dtype=np.float64)[None, :]
+        y = np.arange(yoff, yoff + rows, dtype=np.float64)[:, None]
+        field = smooth_field(x, y, *zip(*self.ndvi_waves))
+        # mostly sparse to moderate vegetation with irrigated fields (> 0.7) and some water (< 0)
+        ndvi = 0.35 + 0.6 * field + self.random.normal(0, 0.04, (rows, self.xsize))
+        ndvi = np.clip(ndvi, -0.3, 0.92).astype(np.float32)
+        # wet, vegetated pixels are cooler
+        lst = 315. - 16. * np.clip(ndvi, 0, 1) + self.random.normal(0, 1., (rows, self.xsize))
+        lst = lst.astype(np.float32)
+        # slanted nodata fill of a WRS-2 scene
+        skew = 0.12 * self.xsize
+        fill = (x < skew * (1 - y / self.ysize)) | (x > self.xsize - skew * y / self.ysize)
+        cloud = self._cloud(x, y) > self.cloud_threshold
+        return {'ndvi': ndvi, 'lst': lst, 'cloud': cloud & ~fill, 'fill': fill}
+
+
+def scene_mtl(landsat_number, date, name, xsize, ysize, sun_elevation, earth_sun_distance, cloud_cover):
+    """
+    :return: dict of the _MTL.txt keys the pipeline and the scene catalog read
+    """
+    mtl = {'LANDSAT_PRODUCT_ID': name,
+           'SPACECRAFT_ID': 'LANDSAT_{}'.format(landsat_number),
+           'WRS_PATH': int(name[10:13]),
+           'WRS_ROW': int(name[13:16]),
+           'DATE_ACQUIRED': date.strftime('%Y-%m-%d'),
+           'REFLECTIVE_SAMPLES': xsize,
+           'REFLECTIVE_LINES': ysize,
+           'SUN_ELEVATION': sun_elevation,
+           'EARTH_SUN_DISTANCE': earth_sun_distance,
+           'CLOUD_COVER': round(100 * cloud_cover, 2),
+           'CLOUD_COVER_LAND': round(100 * cloud_cover, 2)}
+    for key, band in SENSOR_BANDS[landsat_number].items():
+        if key != 'qa':
+            mtl['FILE_NAME_BAND_' + band[1:]] = '{}_{}.TIF'.format(name, band)
+    if landsat_number == '8':
+        mtl['RADIANCE_MULT_BAND_10'], mtl['RADIANCE_ADD_BAND_10'] = L8_THERMAL
+        for band in ('4', '5'):
+            mtl['REFLECTANCE_MULT_BAND_' + band], mtl['REFLECTANCE_ADD_BAND_' + band] = 2.0e-5, -0.1
+    else:
+        ranges = L7_RADIANCE if landsat_number == '7' else {
+            '3': (L5_RADIANCE['Lmin3'], L5_RADIANCE['Lmax3']), '4': (L5_RADIANCE['Lmin4'], L5_RADIANCE['Lmax4']),
+            '6': (L5_RADIANCE['Lmin6'], L5_RADIANCE['Lmax6'])}
+        for band, (lmin, lmax) in ranges.items():
+            mtl['RADIANCE_MINIMUM_BAND_' + band] = lmin
+            mtl['RADIANCE_MAXIMUM_BAND_' + band] = lmax
+            mtl['RADIANCE_MULT_BAND_' + band] = (lmax - lmin) / QCALDIFF
+            mtl['RADIANCE_ADD_BAND_' + band] = lmin - (lmax - lmin) / QCALDIFF * QCALMIN
+    return mtl
+
+
+def write_mtl(path, mtl):
+    with open(path, 'w') as wfile:
+        wfile.write('GROUP = L1_METADATA_FILE\n')
+        for key, value in mtl.items():
+            if isinstance(value, str):
+                value = '"{}"'.format(value)
+            wfile.write('    {} = {}\n'.format(key, value))
+        wfile.write('END_GROUP = L1_METADATA_FILE\nEND\n')
+
+
+def digital_numbers(surface, kernel, landsat_number):
+    """
+    Invert the model: digital numbers of the red, nir and thermal bands that give back the surface NDVI and LST
+    :param surface: dict from SyntheticScene.strip()
+    :param kernel: SSEBopKernel of the scene, for its folded DN -> reflectance and DN -> radiance gains
+    :return: dict of 'red', 'nir', 'thermal' DN arrays of the sensor's data type
+    """
+    ndvi = surface['ndvi']
+    # nir reflectance rising with NDVI, red from the NDVI definition
+    nir = 0.22 + 0.2 * ndvi
+    red = nir * (1 - ndvi) / (1 + ndvi)
+
+    emiss = emissivity(ndvi)
+    k1, k2 = kernel.k1, kernel.k2
+    rc = emiss * k1 / np.expm1(k2 / surface['lst'])
+    radiance = (rc + kernel.RSKY * (1 - emiss)) * kernel.TNB + kernel.RP
+
+    dtype, dn_max = (np.uint16, 65535) if landsat_number == '8' else (np.uint8, 255)
+    dns = {}
+    for name, value in (('red', red), ('nir', nir), ('thermal', radiance)):
+        dn = np.round((value - getattr(kernel, name + '_offset')) / getattr(kernel, name + '_gain'))
+        dn = np.clip(dn, 1, dn_max)
+        dn[surface['fill']] = 0
+        dns[name] = dn.astype(dtype)
+    return dns
+
+
+def make_scene(outdir, landsat_number, date, xsize=7000, ysize=7000, cloud_cover=0.15, seed=0, compresslevel=6):
+    """
+    Write a synthetic Collection 1 scene tarball
+    :param outdir: folder the .tar.gz is written to
+    :param landsat_number: '5', '7' or '8'
+    :param date: datetime of the acquisition
+    :param xsize: scene columns (a real scene is about 7000 - 8000 x 7000 - 8000)
+    :param ysize: scene rows
+    :param cloud_cover: fraction of the scene under cloud
+    :param compresslevel: gzip level of the tarball
+    :return: string path to the tarball
+    """
+    name = scene_name(landsat_number, date)
+    mtl = scene_mtl(landsat_number, date, name, xsize, ysize, sun_elevation=62.5, earth_sun_distance=1.0165,
+                    cloud_cover=cloud_cover)
+    # the kernel holds the DN -> reflectance and radiance gains the digital numbers are inverted with
+    kernel = SSEBopKernel(scene_coefficients(parse_mtl('{} = {}'.format(k, v) for k, v in mtl.items()),
+                                             landsat_number), tile_size=1)
+
+    scenedir = tempfile.mkdtemp(prefix=name + '_')
+    try:
+        driver = gdal.GetDriverByName('GTiff')
+        gt = scene_geotransform(xsize, ysize)
+        wkt = srs_wkt(SCENE_EPSG)
+        datasets = {}
+        for key, band in SENSOR_BANDS[landsat_number].items():
+            if key == 'qa' or landsat_number == '8':
+                data_type = gdal.GDT_UInt16
+            else:
+                data_type = gdal.GDT_Byte
+            ds = driver.Create(os.path.join(scenedir, '{}_{}.TIF'.format(name, band)), xsize, ysize, 1, data_type)
+            ds.SetGeoTransform(gt)
+            ds.SetProjection(wkt)
+            datasets[key] = ds
+
+        surface = SyntheticScene(xsize, ysize, cloud_cover, seed)
+        for yoff in range(0, ysize, STRIP_ROWS):
+            rows = min(STRIP_ROWS, ysize - yoff)
+            strip = surface.strip(yoff, rows)
+            for key, dn in digital_numbers(strip, kernel, landsat_number).items():
+                datasets[key].GetRasterBand(1).WriteArray(dn, 0, yoff)
+            qa = np.full((rows, xsize), CLEAR_QA[landsat_number], dtype=np.uint16)
+            qa[strip['cloud']] = CLOUD_QA[landsat_number]
+            qa[strip['fill']] = 1
+            datasets['qa'].GetRasterBand(1).WriteArray(qa, 0, yoff)
+        for ds in datasets.values():
+            ds.FlushCache()
+        datasets = None
+
+        write_mtl(os.path.join(scenedir, name + '_MTL.txt'), mtl)
+        tarball = os.path.join(outdir, name + '.tar.gz')
+        with tarfile.open(tarball, 'w:gz', compresslevel=compresslevel) as tar:
+            for filename in sorted(os.listdir(scenedir)):
+                tar.add(os.path.join(scenedir, filename), arcname=filename)
+    finally:
+        shutil.rmtree(scenedir, ignore_errors=True)
+    return tarball
+
+
+def ancillary_grid(xsize, ysize, margin=1.):
+    """
+    :return: (projection, geotransform, xsize, ysize) of a geographic grid covering a scene plus margin degrees
+    """
+    lon, lat = SCENE_CENTER_LONLAT
+    half_lat = ysize * PIXEL_SIZE / 111000. / 2 + margin
+    half_lon = xsize * PIXEL_SIZE / (111000. * np.cos(np.radians(lat))) / 2 + margin
+    cols = int(np.ceil(2 * half_lon / ANCILLARY_PIXEL))
+    rows = int(np.ceil(2 * half_lat / ANCILLARY_PIXEL))
+    gt = (lon - half_lon, ANCILLARY_PIXEL, 0., lat + half_lat, 0., -ANCILLARY_PIXEL)
+    return srs_wkt(4326), gt, cols, rows
+
+
+def make_ancillary(aux_inputdir, scenedates, xsize=7000, ysize=7000, seed=0):
+    """
+    Write the tmax_dekadal, dT_dekadal and ETo_daily rasters the scene dates need
+    :param aux_inputdir: Inputs folder
+    :param scenedates: list of YYYYMMDD strings
+    """
+    projection, gt, cols, rows = ancillary_grid(xsize, ysize)
+    random = np.random.RandomState(seed)
+    x = np.arange(cols)[None, :]
+    y = np.arange(rows)[:, None]
+    # Tmax near the cool end of the synthetic LST so the well watered pixels qualify for the c-factor
+    means = {'tmax': (305., 4.), 'dt': (15., 4.), 'eto': (6., 1.5)}
+    driver = gdal.GetDriverByName('GTiff')
+    for scenedate in scenedates:
+        for product, path in ancillary_paths(aux_inputdir, scenedate).items():
+            if os.path.exists(path):
+                continue
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            mean, amplitude = means[product]
+            waves = [(random.uniform(0, 2 * np.pi, 2), random.uniform(20, 80, 2)) for _ in range(2)]
+            arr = (mean + amplitude * smooth_field(x, y, *zip(*waves))).astype(np.float32)
+            ds = driver.Create(path, cols, rows, 1, gdal.GDT_Float32, options=['COMPRESS=DEFLATE'])
+            ds.SetGeoTransform(gt)
+            ds.SetProjection(projection)
+            ds.GetRasterBand(1).WriteArray(arr)
+            ds = None
+
+
+def benchmark_report(results, wall, input_bytes, pixels):
+    """
+    :param results: run_scene() result dicts
+    :param wall: seconds the batch took
+    :param input_bytes: size of the tarballs
+    :param pixels: scene pixels processed
+    :return: JSON serialisable dict with the batch throughput and the per stage totals and rates
+    """
+    done = [r for r in results if r['error'] is None]
+    records = [r['profile'] for r in done if r['profile'] is not None]
+    stages = stage_totals(records)
+    for total in stages.values():
+        total['mb_per_s'] = (total['bytes_read'] + total['bytes_written']) / 1e6 / total['wall'] if total['wall'] \
+            else 0.
+        total['s_per_mpixel'] = total['wall'] / (pixels / 1e6) if pixels else 0.
+    return {'scenes': len(done),
+            'failed': len(results) - len(done),
+            'wall': wall,
+            'scenes_per_hour': 3600. * len(done) / wall if wall else 0.,
+            'input_mb_per_s': input_bytes / 1e6 / wall if wall else 0.,
+            'mpixels_per_s': pixels / 1e6 / wall if wall else 0.,
+            'peak_rss': max([r['peak_rss'] or 0 for r in records] or [0]),
+            'stages': stages}
+
+
+def compare_benchmarks(report, baseline, tolerance=0.15):
+    """
+    :param report: benchmark_report() dict
+    :param baseline: benchmark_report() dict of an earlier run on the same machine and configuration
+    :param tolerance: allowed slow down, 0.15 = 15 %
+    :return: list of (what, baseline value, current value) that got slower or bigger than the tolerance
+    """
+    regressions = []
+    if report['scenes_per_hour'] < baseline['scenes_per_hour'] * (1 - tolerance):
+        regressions.append(('scenes/hour', baseline['scenes_per_hour'], report['scenes_per_hour']))
+    if report['peak_rss'] > baseline['peak_rss'] * (1 + tolerance):
+        regressions.append(('peak RSS', baseline['peak_rss'], report['peak_rss']))
+    for name, total in report['stages'].items():
+        before = baseline['stages'].get(name)
+        # ignore stages too short to time reliably
+        if before is None or before['wall'] < 0.5:
+            continue
+        if total['s_per_mpixel'] > before['s_per_mpixel'] * (1 + tolerance):
+            regressions.append((name + ' s/Mpixel', before['s_per_mpixel'], total['s_per_mpixel']))
+    return regressions
+
+
+def print_report(report):
+    print('{scenes} scenes ({failed} failed) in {wall:.1f} s: {scenes_per_hour:.1f} scenes/hour, '
+          '{input_mb_per_s:.1f} MB/s of tarballs, {mpixels_per_s:.2f} Mpixels/s, '
+          'peak RSS {peak:.0f} MB'.format(peak=report['peak_rss'] / 1e6, **report))
+    header = '{:<12}{:>12}{:>10}{:>11}'.format('stage', 's/Mpixel', 'MB/s', 'peak MB')
+    print(header)
+    print('-' * len(header))
+    for name in ordered_stages(report['stages']):
+        t = report['stages'][name]
+        print('{:<12}{:>12.4f}{:>10.1f}{:>11.1f}'.format(name, t['s_per_mpixel'], t['mb_per_s'], t['peak_rss'] / 1e6))
+
+
+def run():
+    # ================= configuration =================
+    workdir = os.path.join(tempfile.gettempdir(), 'ssebop_benchmark')
+    n_scenes = 4
+    sensors = ('5', '7', '8')
+    # a full scene is about 7500 x 7500, smaller scenes give a quick smoke benchmark
+    xsize = ysize = 2000
+    cloud_cover = 0.15
+    tile_size = TILE_SIZE
+    # 1 keeps the stage timings free of contention between workers
+    workers = 1
+    scene_options = {'cog': True, 'scaled': False, 'compress': 'DEFLATE'}
+    # save the report of a known good run here and later runs are checked against it
+    baseline_path = os.path.join(workdir, 'baseline.json')
+    # =================================================
+
+    scenes = os.path.join(workdir, 'scenes')
+    aux_inputdir = os.path.join(workdir, 'Inputs')
+    output = os.path.join(workdir, 'Outputs')
+    scratch = os.path.join(workdir, 'Scratch')
+    for folder in (scenes, aux_inputdir, scratch):
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+    # products of the previous run would otherwise just be overwritten, a stale profile log would be appended to
+    shutil.rmtree(output, ignore_errors=True)
+    os.makedirs(output)
+
+    # one scene every 8 days so every scene falls on its own ETo day
+    start = datetime(2015, 5, 1)
+    tarfiles = []
+    for i in range(n_scenes):
+        landsat_number = sensors[i % len(sensors)]
+        date = start + timedelta(days=8 * i)
+        tarball = os.path.join(scenes, scene_name(landsat_number, date) + '.tar.gz')
+        if not os.path.exists(tarball):
+            print('making synthetic scene {}'.format(os.path.basename(tarball)))
+            tarball = make_scene(scenes, landsat_number, date, xsize, ysize, cloud_cover, seed=i)
+        tarfiles.append(tarball)
+    make_ancillary(aux_inputdir, [os.path.basename(t)[-30:-22] for t in tarfiles], xsize, ysize)
+
+    input_bytes = sum(os.path.getsize(t) for t in tarfiles)
+    # the scheduler moves finished tarballs to the backup folder, using the scene folder keeps them in place
+    t0 = datetime.now()
+    results = schedule_scenes(tarfiles, scratch, scenes, aux_inputdir, output, tile_size=tile_size, workers=workers,
+                              scene_options=scene_options, profile=True)
+    wall = (datetime.now() - t0).total_seconds()
+
+    records = [r['profile'] for r in results if r['profile'] is not None]
+    print(summary_table(records))
+    report = benchmark_report(results, wall, input_bytes, n_scenes * xsize * ysize)
+    report['config'] = {'n_scenes': n_scenes, 'sensors': sensors, 'xsize': xsize, 'ysize': ysize,
+                        'tile_size': tile_size, 'workers': workers, 'scene_options': scene_options}
+    print_report(report)
+
+    report_path = os.path.join(workdir, 'benchmark_{}.json'.format(datetime.now().strftime('%Y%m%d_%H%M%S')))
+    with open(report_path, 'w') as wfile:
+        json.dump(report, wfile, indent=1, sort_keys=True)
+    print('report written to {}'.format(report_path))
+
+    if os.path.exists(baseline_path):
+        with open(baseline_path, 'r') as rfile:
+            baseline = json.load(rfile)
+        if baseline.get('config') != json.loads(json.dumps(report['config'])):
+            print('baseline {} was run with a different configuration, not compared'.format(baseline_path))
+        else:
+            regressions = compare_benchmarks(report, baseline)
+            for what, before, now in regressions:
+                print('REGRESSION {}: {:.4g} -> {:.4g}'.format(what, before, now))
+            if not regressions:
+                print('no regressions against {}'.format(baseline_path))
+    shutil.rmtree(scratch, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,257 @@
+# ===============================================================================
+# Copyright 2019 Gabriel Parrish, Matt Schauer and Gabriel Senay
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import os
+import json
+import numpy as np
+from osgeo import gdal
+# ============= standard library imports ========================
+from SEEBop_os.ancillary_cache import subgrid_window, _grid_digest, _grid_from_json
+
+"""Reusable warp plans from the coarse Tmax/dT/ETo grids to the 30 m Landsat grids.
+
+Every Tmax, dT and ETo raster is on the same source grid and every scene of a WRS-2 path/row is on the same lattice,
+so the source pixel each scene pixel samples never changes. A plan records it once: for nearest neighbour the flat
+index of the source pixel of every target pixel, for bilinear the index of the upper left neighbour and the weights
+of the right and lower ones. Applying a plan is a vectorized gather instead of a GDAL warp with its coordinate
+transforms.
+
+Plans are made by warping rasters of source pixel indices (or coordinates) with GDAL, so they reproduce
+align_to_grid() exactly. They are saved as .npy files with a .json sidecar in Inputs/warp_plans and memory mapped
+back, and a plan for a padded grid serves any later scene grid inside it on the same lattice. The indices are
+relative to the window of the source the target covers, uint16 when that window is small enough."""
+
+PLAN_FOLDER = 'warp_plans'
+
+METHODS = ('near', 'bilinear')
+
+# nodata of the warped index raster
+NEAR_NODATA = np.iinfo(np.uint32).max
+
+# plan caches by folder
+_process_plans = {}
+
+
+def _source_dataset(src_grid, arrays, data_type):
+    projection, gt, xsize, ysize = src_grid
+    ds = gdal.GetDriverByName('MEM').Create('', xsize, ysize, len(arrays), data_type)
+    ds.SetGeoTransform(gt)
+    ds.SetProjection(projection)
+    for i, arr in enumerate(arrays):
+        ds.GetRasterBand(i + 1).WriteArray(arr)
+    return ds
+
+
+def _warp(src, grid, resample_alg, data_type, nodata):
+    # same target as ssebop_engine.align_to_grid()
+    projection, gt, xsize, ysize = grid
+    bounds = (gt[0], gt[3] + gt[5] * ysize, gt[0] + gt[1] * xsize, gt[3])
+    return gdal.Warp('', src, format='MEM', dstSRS=projection, outputBounds=bounds, width=xsize, height=ysize,
+                     resampleAlg=resample_alg, dstNodata=nodata, outputType=data_type)
+
+
+def build_plan(src_grid, grid, method='near'):
+    """
+    :param src_grid: (projection, geotransform, xsize, ysize) of the ancillary rasters
+    :param grid: target grid, e.g. a padded scene grid
+    :param method: 'near' or 'bilinear'
+    :return: dict of 'window' (xoff, yoff, xsize, ysize) of the source pixels the plan reads, 'index' (rows, cols)
+     array of flat indices into that window (the dtype maximum outside the source) and for bilinear the float32
+     'fx' and 'fy' weights of the right and lower neighbours
+    """
+    if method not in METHODS:
+        raise ValueError('method must be one of {}'.format(METHODS))
+    src_xsize, src_ysize = src_grid[2], src_grid[3]
+    plan = {}
+    if method == 'near':
+        indices = np.arange(src_xsize * src_ysize, dtype=np.uint32).reshape(src_ysize, src_xsize)
+        ds = _warp(_source_dataset(src_grid, [indices], gdal.GDT_UInt32), grid, 'near', gdal.GDT_UInt32,
+                   NEAR_NODATA)
+        flat = ds.GetRasterBand(1).ReadAsArray()
+        valid = flat != NEAR_NODATA
+        rows, cols = np.divmod(np.where(valid, flat, 0), np.uint32(src_xsize))
+        reach = 1
+    else:
+        # bilinear interpolation of the pixel centre coordinates gives the fractional source position
+        cols = np.broadcast_to(np.arange(src_xsize, dtype=np.float64) + 0.5, (src_ysize, src_xsize))
+        rows = np.broadcast_to(np.arange(src_ysize, dtype=np.float64)[:, None] + 0.5, (src_ysize, src_xsize))
+        ds = _warp(_source_dataset(src_grid, [cols, rows], gdal.GDT_Float64), grid, 'bilinear', gdal.GDT_Float64,
+                   float('nan'))
+        x = ds.GetRasterBand(1).ReadAsArray()
+        y = ds.GetRasterBand(2).ReadAsArray()
+        valid = np.isfinite(x) & np.isfinite(y)
+        x = np.clip(np.where(valid, x, 0.5) - 0.5, 0, src_xsize - 1)
+        y = np.clip(np.where(valid, y, 0.5) - 0.5, 0, src_ysize - 1)
+        # upper left neighbour, kept one pixel inside the right and bottom edges
+        cols = np.minimum(np.floor(x), max(src_xsize - 2, 0)).astype(np.uint32)
+        rows = np.minimum(np.floor(y), max(src_ysize - 2, 0)).astype(np.uint32)
+        plan['fx'] = np.clip(x - cols, 0, 1).astype(np.float32)
+        plan['fy'] = np.clip(y - rows, 0, 1).astype(np.float32)
+        reach = 2
+    ds = None
+
+    if valid.any():
+        xoff, yoff = int(cols[valid].min()), int(rows[valid].min())
+        xsize = min(int(cols[valid].max()) + reach, src_xsize) - xoff
+        ysize = min(int(rows[valid].max()) + reach, src_ysize) - yoff
+    else:
+        xoff = yoff = xsize = ysize = 0
+    dtype = np.uint16 if xsize * ysize < np.iinfo(np.uint16).max else np.uint32
+    index = ((rows - yoff) * xsize + (cols - xoff)).astype(dtype)
+    index[~valid] = np.iinfo(dtype).max
+    plan.update({'window': (xoff, yoff, xsize, ysize), 'index': index})
+    return plan
+
+
+def plan_window(plan, window):
+    """
+    :param window: (xoff, yoff, xsize, ysize) of the target grid
+    :return: the plan of a window of its target grid, the arrays are views
+    """
+    xoff, yoff, xsize, ysize = window
+    sub = dict(plan)
+    for name in ('index', 'fx', 'fy'):
+        if name in plan:
+            sub[name] = plan[name][yoff:yoff + ysize, xoff:xoff + xsize]
+    return sub
+
+
+def apply_plan(plan, src, out=None):
+    """
+    Resample a source raster with a plan
+    :param plan: dict from build_plan() or WarpPlanCache.get()
+    :param src: float32 array of the whole source raster with nodata as NaN
+    :param out: optional float32 array of the shape of the plan to write into
+    :return: float32 array on the target grid, NaN outside the source or where the source is nodata
+    """
+    index = plan['index']
+    if out is None:
+        out = np.empty(index.shape, dtype=np.float32)
+    xoff, yoff, xsize, ysize = plan['window']
+    if xsize * ysize == 0:
+        out.fill(np.nan)
+        return out
+    values = np.ascontiguousarray(src[yoff:yoff + ysize, xoff:xoff + xsize], dtype=np.float32).ravel()
+    outside = index == np.iinfo(index.dtype).max
+
+    if 'fx' not in plan:
+        values.take(index, out=out, mode='clip')
+    else:
+        fx, fy = plan['fx'], plan['fy']
+        # weighted sum of the valid neighbours, renormalized where some are nodata as GDAL does
+        total = np.zeros(index.shape, dtype=np.float32)
+        weight = np.zeros(index.shape, dtype=np.float32)
+        for step, w in ((0, (1 - fx) * (1 - fy)), (1, fx * (1 - fy)), (xsize, (1 - fx) * fy), (xsize + 1, fx * fy)):
+            v = values.take(index + np.asarray(step, dtype=index.dtype), mode='clip')
+            known = np.isfinite(v)
+            total += np.where(known, v * w, 0)
+            weight += np.where(known, w, 0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            np.divide(total, weight, out=out)
+    out[outside] = np.nan
+    return out
+
+
+class WarpPlanCache(object):
+    """
+    Warp plans saved to a folder and memory mapped back. Several processes may share the folder, a plan two of
+    them build at the same time is written twice with the same content.
+    """
+
+    ARRAYS = ('index', 'fx', 'fy')
+
+    def __init__(self, root):
+        """
+        :param root: folder of the plans, e.g. Inputs/warp_plans
+        """
+        self.root = root
+        self.hits = 0
+        self.misses = 0
+        self._mapped = {}
+
+    def get(self, src_grid, grid, method='near'):
+        """
+        :param src_grid: (projection, geotransform, xsize, ysize) of the ancillary rasters
+        :param grid: target grid
+        :return: plan of grid, see build_plan()
+        """
+        src_grid = _grid_from_json(src_grid)
+        prefix = '{}_{}_'.format(method, _grid_digest(src_grid))
+        found = self._find(prefix, grid)
+        if found is not None:
+            self.hits += 1
+            return found
+        self.misses += 1
+
+        print('building a {} warp plan for a {} x {} grid'.format(method, grid[2], grid[3]))
+        plan = build_plan(src_grid, grid, method)
+        base = os.path.join(self.root, prefix + _grid_digest(grid))
+        try:
+            self._save(base, plan, src_grid, grid, method)
+        except (IOError, OSError) as e:
+            print('could not save the warp plan to {}: {}'.format(self.root, e))
+        return plan
+
+    def _find(self, prefix, grid):
+        if not os.path.isdir(self.root):
+            return None
+        for name in os.listdir(self.root):
+            if not (name.startswith(prefix) and name.endswith('.json')):
+                continue
+            base = os.path.join(self.root, name[:-5])
+            try:
+                with open(base + '.json', 'r') as rfile:
+                    meta = json.load(rfile)
+            except (IOError, OSError, ValueError):
+                continue
+            window = subgrid_window(_grid_from_json(meta['grid']), grid)
+            if window is not None:
+                return plan_window(self._load(base, meta), window)
+        return None
+
+    def _load(self, base, meta):
+        if base not in self._mapped:
+            plan = {'window': tuple(meta['window'])}
+            for name in meta['arrays']:
+                plan[name] = np.load('{}_{}.npy'.format(base, name), mmap_mode='r')
+            self._mapped[base] = plan
+        return self._mapped[base]
+
+    def _save(self, base, plan, src_grid, grid, method):
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        arrays = [name for name in self.ARRAYS if name in plan]
+        tag = os.getpid()
+        for name in arrays:
+            tmp = '{}_{}.{}.tmp.npy'.format(base, name, tag)
+            np.save(tmp, plan[name])
+            os.replace(tmp, '{}_{}.npy'.format(base, name))
+        # the sidecar is written last, its presence marks a complete plan
+        meta = {'method': method, 'source': src_grid, 'grid': grid, 'window': plan['window'], 'arrays': arrays}
+        tmp = '{}.{}.json.tmp'.format(base, tag)
+        with open(tmp, 'w') as wfile:
+            json.dump(meta, wfile)
+        os.replace(tmp, base + '.json')
+
+    def __repr__(self):
+        return 'WarpPlanCache({}, hits={}, misses={})'.format(self.root, self.hits, self.misses)
+
+
+def process_plans(root):
+    """
+    :return: the plan cache of a folder shared by every scene run in this process
+    """
+    if root not in _process_plans:
+        _process_plans[root] = WarpPlanCache(root)
+    return _process_plans[root]
@@ -0,0 +1,358 @@
+# ===============================================================================
+# Copyright 2019 Gabriel Parrish, Matt Schauer and Gabriel Senay
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+import os
+import shutil
+import tempfile
+import traceback
+from datetime import datetime
+import numpy as np
+import dask
+import dask.array as da
+from dask.diagnostics import ProgressBar
+import rioxarray as rioxa
+import xarray as xr
+# ============= standard library imports ========================
+from SEEBop_os.ssebop_engine import DEFAULT_CFACTOR, PRODUCTS, SSEBopKernel, align_to_grid, \
+    ancillary_paths, ancillary_periods, output_path, parse_scene_name, scene_coefficients, scene_pathrow
+from SEEBop_os.landsat_archive import archive_paths
+from SEEBop_os.cog_writer import ProductWriter
+from SEEBop_os.qa_mask import clear_lut
+from SEEBop_os.scene_scheduler import commit_scene, failed_result, _report
+from SEEBop_os.run_manifest import scene_inputs, inputs_digest
+from SEEBop_os.ancillary_cache import subgrid_window
+
+"""Optional xarray/dask backend: runs SSEBop over a stack of aligned Landsat scenes (the tarballs of one path/row)
+as lazy array operations instead of the hand scheduled blocks of ssebop_engine.ssebop_scene().
+
+The bands of every scene are opened with rioxarray straight out of the tarballs as chunked DataArrays and stacked on
+a 'scene' dimension (the outer join of the scene footprints on their common UTM lattice). Cloud mask, NDVI, LST,
+c-factor, ETf and ETa are one dask graph: the c-factor is a per scene mean - 2 * std reduction over the y and x
+dimensions inside that graph, so a chunk's ETf only waits on the c-factor of its own scene. The local threaded
+scheduler then keeps every core busy across scenes and chunks. The arithmetic is the one of SSEBopKernel, with the
+same folded gains, and the products are cropped back to the grid of their own scene and written through
+cog_writer.ProductWriter, so they are the same rasters the engine writes.
+
+A scene that can't be opened, or is not on the lattice of its path/row, fails on its own. A stack that fails is run
+again scene by scene, so only the scenes that fail alone are recorded as failed. Scenes are recorded and their
+tarballs moved to Backup as with the engine, see scene_scheduler.commit_scene().
+
+Needs rioxarray, xarray and dask on top of GDAL, the default engine does not."""
+
+# chunks the bands are read in. Each chunk is one dask task, so keep a few of them per core.
+CHUNKS = {'band': 1, 'x': 2048, 'y': 2048}
+
+# per scene coefficients of SSEBopKernel carried as variables of the stack
+KERNEL_COEFFICIENTS = ('red_gain', 'red_offset', 'nir_gain', 'nir_offset', 'thermal_gain', 'thermal_offset', 'k1',
+                       'k2')
+
+
+def open_band(path, chunks=CHUNKS):
+    """
+    :param path: any path rasterio can open, plain or /vsitar/
+    :return: lazy float32 (y, x) DataArray of a single band raster
+    """
+    return rioxa.open_rasterio(path, chunks=chunks).squeeze('band', drop=True).astype(np.float32)
+
+
+def open_clear(path, collection, qa_rules=None, chunks=CHUNKS):
+    """
+    :param path: quality band (BQA or QA_PIXEL) of a scene
+    :return: lazy float32 (y, x) DataArray, 1 where the pixel is clear and 0 where not, from the QA lookup table
+    """
+    qa = rioxa.open_rasterio(path, chunks=chunks).squeeze('band', drop=True)
+    lut = clear_lut(collection, qa_rules)
+    return qa.copy(data=qa.data.map_blocks(lut.take, mode='clip', dtype=np.bool_)).astype(np.float32)
+
+
+def open_scene(tarball, chunks=CHUNKS, qa_rules=None):
+    """
+    Open the red, nir, thermal and quality bands of a scene tarball without unpacking it
+    :param tarball: string path to the Landsat .tar.gz
+    :param qa_rules: QA bit rules of the cloud mask, see qa_mask.build_lut()
+    :return: xr.Dataset of the lazy bands, the clear sky mask and the kernel coefficients of the scene as scalar
+     variables
+    """
+    basename = os.path.basename(tarball)
+    scenedate, landsat_number = parse_scene_name(basename)
+    paths, mtl = archive_paths(tarball)
+    coeffs = scene_coefficients(mtl, landsat_number)
+    kernel = SSEBopKernel(coeffs, tile_size=1)
+    scene = xr.Dataset({band: open_band(paths[band], chunks) for band in ('red', 'nir', 'thermal')})
+    scene['clear'] = open_clear(paths['qa'], coeffs['collection'], qa_rules, chunks)
+    for name in KERNEL_COEFFICIENTS:
+        # float32 so the products stay float32, as in the kernel buffers
+        scene[name] = np.float32(getattr(kernel, name))
+    return scene.assign_coords(scene=basename, scenedate=scenedate, pathrow=scene_pathrow(basename))
+
+
+def open_stack(scenes, chunks=CHUNKS):
+    """
+    Stack scenes on a 'scene' dimension. The scenes must share the projection and pixel lattice (e.g. one path/row),
+    the stack covers the union of their footprints and is NaN outside each scene.
+    :param scenes: list of xr.Dataset from open_scene()
+    :return: xr.Dataset with (scene, y, x) bands and (scene,) coefficients
+    """
+    stack = xr.concat(scenes, dim='scene', join='outer', coords=['scenedate', 'pathrow'], compat='override')
+    # keep a single chunk per scene along the stack, the outer join may have re-chunked x and y
+    return stack.chunk({'scene': 1, 'y': chunks['y'], 'x': chunks['x']}).rio.write_crs(scenes[0].rio.crs)
+
+
+def stack_grid(stack):
+    """
+    :return: (projection, geotransform, xsize, ysize) of the stack, as ssebop_engine.scene_grid()
+    """
+    transform = stack.rio.transform(recalc=True)
+    return stack.rio.crs.to_wkt(), tuple(transform.to_gdal()), stack.rio.width, stack.rio.height
+
+
+def open_ancillary(stack, aux_inputdir, vrt_dir, chunks=CHUNKS):
+    """
+    Warp the Tmax, dT and ETo inputs of every scene of the stack onto the stack grid. The warps are VRT files (one per
+    dekad or day, shared by the scenes of the same period) that are opened lazily like the bands.
+    :param vrt_dir: folder for the VRT files
+    :return: dict of 'tmax', 'dt', 'eto' -> lazy float32 (scene, y, x) DataArray, NaN where nodata
+    """
+    grid = stack_grid(stack)
+    aux = {}
+    for name in ('tmax', 'dt', 'eto'):
+        layers = []
+        for scenedate in stack.scenedate.values:
+            vrt_path = os.path.join(vrt_dir, '{}{}.vrt'.format(name, ancillary_periods(scenedate)[name]))
+            if not os.path.exists(vrt_path):
+                # dropping the dataset writes the VRT file
+                align_to_grid(ancillary_paths(aux_inputdir, scenedate)[name], grid, vrt_path=vrt_path)
+            layer = rioxa.open_rasterio(vrt_path, chunks=chunks, masked=True).squeeze('band', drop=True)
+            # the VRT is on the stack grid, take its coordinates so the layers align exactly
+            layers.append(layer.astype(np.float32).assign_coords(x=stack.x, y=stack.y))
+        aux[name] = xr.concat(layers, dim=stack.scene).chunk({'scene': 1})
+    return aux
+
+
+def ssebop_stack(stack, aux, k=1):
+    """
+    Express the SSEBop model over a stack as lazy array operations, the xarray counterpart of SSEBopKernel
+    :param stack: xr.Dataset from open_stack()
+    :param aux: dict from open_ancillary()
+    :param k: k factor applied to ETo
+    :return: xr.Dataset of the (scene, y, x) NDVI, LST, ETf and ETa and of the (scene,) cfactor and count
+    """
+    kernel = SSEBopKernel
+    tmax, dt, eto = aux['tmax'], aux['dt'], aux['eto']
+
+    # TOA reflectance and NDVI
+    red = stack.red * stack.red_gain + stack.red_offset
+    nir = stack.nir * stack.nir_gain + stack.nir_offset
+    ndvi = (nir - red) / (nir + red)
+
+    # emissivity, linear in Pv in the 0.2 - 0.5 NDVI range. NaN NDVI stays NaN.
+    emiss = ((ndvi - 0.2) / 0.3) ** 2 * kernel.EMISS_C1 + kernel.EMISS_C0
+    emiss = xr.where(ndvi > 0.5, 0.99, xr.where(ndvi < 0, 0.985, xr.where(ndvi < 0.2, 0.977, emiss)))
+
+    # corrected thermal radiance and land surface temperature in degrees Kelvin
+    rc = (stack.thermal * stack.thermal_gain + stack.thermal_offset - kernel.RP) / kernel.TNB - kernel.RSKY + \
+        emiss * kernel.RSKY
+    lst = stack.k2 / np.log1p(stack.k1 * emiss / rc)
+
+    # cloud mask. Pixels outside a scene footprint are NaN and never clear.
+    clear = stack.clear == 1
+    ndvi = ndvi.where(clear)
+    lst = lst.where(clear)
+
+    # c-factor: a per scene reduction of tcorr = LST / Tmax over the well watered pixels
+    tdiff = tmax - lst
+    qualify = (tdiff > -5) & (tdiff < 10) & (lst > 270) & (ndvi > 0.7) & (ndvi < 1.0)
+    tcorr = (lst.astype(np.float64) / tmax).where(qualify)
+    count = qualify.sum(('y', 'x'))
+    mean = tcorr.mean(('y', 'x'))
+    # population standard deviation, as CfactorStats
+    std = tcorr.std(('y', 'x'))
+    cfactor = xr.where((count > 0) & (mean > 0), mean - 2 * std, DEFAULT_CFACTOR)
+
+    # ETf = (Thot - LST) / dT, 1.3 and above is nodata, 1.05 - 1.3 is capped at 1.05, below 0 is 0
+    dtcon = dt.clip(6, 25)
+    etf = (tmax * cfactor.astype(np.float32) + dtcon - lst) / dtcon
+    etf = etf.where(~(etf >= 1.3)).clip(0, 1.05)
+    eta = (eto * float(k) * etf).clip(min=0)
+
+    return xr.Dataset({'NDVI': ndvi.astype(np.float32), 'LST': lst.astype(np.float32),
+                       'ETf': etf.astype(np.float32), 'ETa': eta.astype(np.float32),
+                       'cfactor': cfactor, 'count': count})
+
+
+class WriterTarget(object):
+    """
+    dask.array.store() target that hands the chunks of one product to a ProductWriter
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def __setitem__(self, key, value):
+        rows, cols = key
+        window = (cols.start, rows.start, cols.stop - cols.start, rows.stop - rows.start)
+        # ProductWriter.write() replaces NaN in place, never in a chunk dask may still hold
+        self.writer.write(np.array(value, dtype=np.float32), window)
+
+
+def compute_stack(products, grid, scene_grids, output, cog=True, scaled=False, compress='DEFLATE',
+                  scheduler='threads', workers=None):
+    """
+    Compute the products of a stack and write them as Outputs/<product>/<product><date>_<pathrow>.tif
+    :param products: xr.Dataset from ssebop_stack()
+    :param grid: stack grid from stack_grid()
+    :param scene_grids: grid of every scene of the stack, its products are cropped back to it
+    :param scheduler: local dask scheduler, 'threads' or 'synchronous' (to debug). The GDAL writers live in this
+     process so the process based schedulers can't be used.
+    :param workers: number of threads, None uses every core
+    :return: list of (scenedate, cfactor, number of pixels the c-factor was computed from) per scene
+    """
+    writers = []
+    sources = []
+    for i, scenedate in enumerate(products.scenedate.values):
+        pathrow = str(products.pathrow.values[i])
+        xoff, yoff, xsize, ysize = subgrid_window(grid, scene_grids[i])
+        for cat in PRODUCTS:
+            writers.append(ProductWriter(output_path(output, cat, str(scenedate), pathrow), scene_grids[i], cat,
+                                         cog=cog, scaled=scaled, compress=compress))
+            sources.append(products[cat].isel(scene=i).data[yoff:yoff + ysize, xoff:xoff + xsize])
+    # one lock around every write, gdal datasets are not thread safe
+    store = da.store(sources, [WriterTarget(w) for w in writers], lock=True, compute=False)
+
+    try:
+        with dask.config.set(scheduler=scheduler, num_workers=workers), ProgressBar():
+            _, cfactors, counts = dask.compute(store, products.cfactor.data, products.count.data)
+    except Exception:
+        for writer in writers:
+            writer.discard()
+        raise
+    for writer in writers:
+        writer.close()
+    return [(str(scenedate), float(cfactor), int(count))
+            for scenedate, cfactor, count in zip(products.scenedate.values, cfactors, counts)]
+
+
+def run_stack(scenes, scene_grids, aux_inputdir, output, k=1, chunks=CHUNKS, scratch=None, scheduler='threads',
+              workers=None, cog=True, scaled=False, compress='DEFLATE'):
+    """
+    Stack opened scenes, run SSEBop over the stack and write the products of every scene
+    :param scenes: list of xr.Dataset from open_scene(), on one projection and pixel lattice
+    :param scene_grids: grid of every scene, from stack_grid()
+    :return: list of (scenedate, cfactor, number of pixels the c-factor was computed from) per scene
+    """
+    vrt_dir = tempfile.mkdtemp(prefix='stack_', dir=scratch)
+    try:
+        stack = open_stack(scenes, chunks)
+        products = ssebop_stack(stack, open_ancillary(stack, aux_inputdir, vrt_dir, chunks), k)
+        return compute_stack(products, stack_grid(stack), scene_grids, output, cog, scaled, compress, scheduler,
+                             workers)
+    finally:
+        shutil.rmtree(vrt_dir, ignore_errors=True)
+
+
+def process_stack(tarfiles, backup, aux_inputdir, output, k=1, chunks=CHUNKS, scratch=None, scheduler='threads',
+                  workers=None, cog=True, scaled=False, compress='DEFLATE', qa_rules=None, manifest=None):
+    """
+    Run SSEBop over Landsat tarballs with the xarray backend, one stack per path/row. Every scene is recorded as
+    soon as its stack is written, its c-factor appended to Outputs/Cfactors.txt (or recorded in the manifest) and
+    its tarball moved to backup, see scene_scheduler.commit_scene().
+    :param tarfiles: list of Landsat .tar.gz paths
+    :param backup: folder the tarballs are moved to once their scene is recorded
+    :param aux_inputdir: folder with the tmax_dekadal, dT_dekadal and ETo_daily inputs
+    :param output: root of the output folders
+    :param chunks: dict of the 'x' and 'y' chunk sizes
+    :param scratch: folder for the warped ancillary VRTs, default the system temp folder
+    :param scheduler: local dask scheduler, see compute_stack()
+    :param workers: number of threads, None uses every core
+    :param cog: write the products as Cloud Optimized GeoTIFFs with internal overviews
+    :param scaled: store the products as int16 with scale/offset metadata instead of float32
+    :param compress: GeoTIFF compression of the products
+    :param qa_rules: QA bit rules of the cloud mask, see qa_mask.build_lut()
+    :param manifest: RunManifest. If given, scenes whose inputs are unchanged since they were last processed (by
+     either backend) are left out of the stacks and Cfactors.txt is rewritten from the manifest at the end.
+    :return: list of result dicts as scene_scheduler.run_scene()
+    """
+    scratch = tempfile.gettempdir() if scratch is None else scratch
+    digests = {}
+    if manifest is not None:
+        # the options of the digest, as the engine computes it for the same products
+        options = {'cog': cog, 'scaled': scaled, 'compress': compress, 'qa_rules': qa_rules, 'outputs': PRODUCTS}
+        todo = []
+        for tarball in tarfiles:
+            inputs = scene_inputs(tarball, aux_inputdir, k, options)
+            digest = inputs_digest(inputs)
+            if manifest.is_current(tarball, digest):
+                print('{} is up to date'.format(os.path.basename(tarball)))
+                continue
+            digests[tarball] = (inputs, digest)
+            todo.append(tarball)
+        print('{} of {} scenes need processing'.format(len(todo), len(tarfiles)))
+        tarfiles = todo
+
+    stacks = {}
+    for tarball in tarfiles:
+        stacks.setdefault(scene_pathrow(os.path.basename(tarball)), []).append(tarball)
+
+    results = []
+    options = {'k': k, 'chunks': chunks, 'scratch': scratch, 'scheduler': scheduler, 'workers': workers,
+               'cog': cog, 'scaled': scaled, 'compress': compress}
+
+    def finish(result):
+        results.append(_report(result))
+        if result['error'] is None:
+            commit_scene(result, scratch, backup, output, manifest, *digests.get(result['tarball'], (None, None)))
+
+    for pathrow in sorted(stacks):
+        opened = []
+        for tarball in sorted(stacks[pathrow]):
+            try:
+                scene = open_scene(tarball, chunks, qa_rules)
+                grid = stack_grid(scene)
+                if opened and subgrid_window(opened[0][2], grid, contained=False) is None:
+                    raise ValueError('{} is not on the projection and pixel lattice of path/row {}'.format(
+                        os.path.basename(tarball), pathrow))
+            except Exception:
+                finish(failed_result(tarball, traceback.format_exc()))
+                continue
+            opened.append((tarball, scene, grid))
+        if not opened:
+            continue
+
+        print('stacking {} scenes of path/row {}'.format(len(opened), pathrow))
+        start = datetime.now()
+        try:
+            runs = [(opened, run_stack([s for _, s, _ in opened], [g for _, _, g in opened], aux_inputdir, output,
+                                       **options))]
+        except Exception:
+            if len(opened) == 1:
+                finish(failed_result(opened[0][0], traceback.format_exc()))
+                continue
+            print('the stack of path/row {} failed, running its scenes one by one\n{}'.format(
+                pathrow, traceback.format_exc()))
+            runs = []
+            for one in opened:
+                try:
+                    runs.append(([one], run_stack([one[1]], [one[2]], aux_inputdir, output, **options)))
+                except Exception:
+                    finish(failed_result(one[0], traceback.format_exc()))
+
+        elapsed = str(datetime.now() - start)
+        for scenes, stats in runs:
+            for (tarball, _, _), (scenedate, cfactor, pixels) in zip(scenes, stats):
+                finish({'tarball': tarball, 'scenedate': scenedate, 'cfactor': cfactor, 'cfactor_pixels': pixels,
+                        'error': None, 'elapsed': elapsed, 'profile': None})
+
+    if manifest is not None:
+        manifest.write_cfactor_log()
+    return results